@@ -0,0 +1,1353 @@
+"""Micro-benchmarks for the PyIRC server hot paths.
+
+Run ``python bench.py --help`` to list the available benchmarks.
+"""
+
+import argparse
+import asyncio
+import bisect
+import itertools
+import logging
+import os
+import random
+import selectors
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from datetime import datetime
+
+from client import IRCClient
+from compact import (
+    COMPRESS_LEVEL,
+    CompactSession,
+    CompressionStats,
+    Deflater,
+    message_frame,
+    text_frames,
+)
+from directory import ChannelDirectory, Sessions
+from framing import RECV_SIZE, encode_line
+from history import HistoryStore
+from keepalive import KeepAlive
+from loadgen import process_rss
+from profiler import functions, read_collapsed, top
+from ratelimit import CHANNEL, DEFAULT_LIMITS, RateLimiter
+from search import SEARCH_MAX_BYTES, SearchIndex
+from storage import SNAPSHOT_FILE, MessageLog
+from server import IRCServer, timestamp
+from tls import client_context, self_signed_certificate
+from traffic import CLOSE, DATA, OPEN, read_trace, replay
+
+
+class NullConnection:
+    """Stand-in for a client socket that discards everything sent to it"""
+
+    __slots__ = ("sent", "compact")
+
+    def __init__(self):
+        self.sent = 0
+        self.compact = None
+
+    def send(self, data):
+        self.sent += 1
+        return len(data)
+
+    def close(self):
+        pass
+
+    def getpeername(self):
+        return ("127.0.0.1", 0)
+
+
+def make_server(total_clients, channel_members, channel="general"):
+    """Build a server with fake connections, channel_members of them spread over channel"""
+    server = IRCServer(port=0)
+    server.server_socket.close()
+    stride = max(1, total_clients // max(1, channel_members))
+    for i in range(total_clients):
+        nick = f"user{i}"
+        connection = NullConnection()
+        server.clients[connection] = nick
+        session = server.nicknames.add(nick, connection)
+        if i % stride == 0 and len(server.channels[channel]) < channel_members:
+            server.channels.join(session, channel)
+    return server
+
+
+def linear_scan_broadcast(server, channel, message):
+    """The previous broadcast_to_channel lookup: one scan of all clients per member"""
+    for nick in server.channels[channel].nicknames():
+        for sock, nickname in server.clients.items():
+            if nickname == nick:
+                sock.send(message.encode("utf-8"))
+                break
+
+
+def legacy_fanout(server, channel, nickname, text, exclude):
+    """The previous channel message path: new timestamp, one encode per recipient"""
+    stamp = datetime.now().strftime("%H:%M:%S")
+    message = f"[{stamp}] [{channel}] {nickname}: {text}"
+    for nick in server.channels[channel].nicknames():
+        connection = server.nicknames[nick].connection
+        if connection is not None and connection is not exclude:
+            connection.send((message + "\n").encode("utf-8"))
+
+
+def current_fanout(server, channel, nickname, text, exclude):
+    """The broadcast handle_channel_message makes for a channel message"""
+    message = f"[{timestamp()}] [{channel}] {nickname}: {text}"
+    server.broadcast_payload(channel, encode_line(message), exclude)
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_broadcast(options):
+    """Broadcast cost to a fixed-size channel as the number of connected clients grows"""
+    members = options.members
+    print(f"channel members: {members}")
+    print(f"{'clients':>10} {'registry (us)':>15} {'linear scan (us)':>18}")
+    for total in options.clients:
+        server = make_server(total, members)
+        message = "[12:00:00] [general] bench: hello"
+        indexed = timed(
+            lambda: server.broadcast_to_channel("general", message),
+            options.repeat,
+        )
+        scanned = timed(
+            lambda: linear_scan_broadcast(server, "general", message),
+            max(1, options.repeat // 10),
+        )
+        print(f"{total:>10} {indexed * 1e6:>15.1f} {scanned * 1e6:>18.1f}")
+
+
+def bench_fanout(options):
+    """One channel message fanned out to a large channel, before and after encode-once"""
+    server = make_server(options.members, options.members)
+    sender = server.nicknames["user0"].connection
+    text = "x" * options.length
+    print(f"channel members: {options.members}, message length: {options.length}")
+    for name, fanout in (
+        ("per-recipient", legacy_fanout),
+        ("encode-once", current_fanout),
+    ):
+        elapsed = timed(
+            lambda: fanout(server, "general", "user0", text, sender), options.repeat
+        )
+        print(f"{name:>14}: {elapsed * 1e3:8.3f} ms per message")
+
+
+def bench_history(options):
+    """Fill the history of many channels, compare the budget to real memory use"""
+    store = HistoryStore(options.depth, options.budget * 2**20)
+    rng = random.Random(1)
+    channels = [f"room{i}" for i in range(options.channels)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(options.messages):
+        # Skewed traffic: low numbered channels are the busiest
+        channel = channels[int(len(channels) * rng.random() ** 2)]
+        text = f"[12:00:00] [{channel}] user{i}: " + "x" * rng.randrange(20, 200)
+        store.append(channel, encode_line(text))
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    busiest = channels[0]
+    payload = encode_line("[12:00:00] [room0] user: " + "x" * 100)
+    appended = timed(lambda: store.append(busiest, payload), 100000)
+    replayed = timed(lambda: store.replay(busiest), 10000)
+    print(f"channels: {options.channels}, depth: {options.depth}")
+    print(f"messages: {options.messages}, budget: {options.budget} MiB")
+    print(f"accounted: {store.total / 2**20:.1f} MiB")
+    print(f"traced memory: {used / 2**20:.1f} MiB")
+    print(f"channels kept: {len(store.buffers)}, evictions: {store.evictions}")
+    print(f"append: {appended * 1e6:.2f} us")
+    print(f"replay of {len(store.buffers[busiest])} messages: {replayed * 1e6:.1f} us")
+
+
+def bench_log(options):
+    """Append to the message log, then time startup with and without a snapshot"""
+    directory = tempfile.mkdtemp(prefix="pyirc-log-", dir=options.dir)
+    try:
+        message_log = MessageLog(directory)
+        message_log.open()
+        channels = [f"room{i}" for i in range(options.channels)]
+        started = time.perf_counter()
+        for i in range(options.messages):
+            channel = channels[i % len(channels)]
+            message_log.append_message(
+                channel, encode_line(f"[12:00:00] [{channel}] user{i}: hello {i}")
+            )
+        queued = time.perf_counter() - started
+        message_log.close()
+        elapsed = time.perf_counter() - started
+        print(f"messages: {options.messages}, channels: {options.channels}")
+        print(f"append: {queued / options.messages * 1e6:.2f} us per message")
+        print(
+            f"committed: {options.messages / elapsed:.0f} messages/s"
+            f" in {message_log.commits} group commits"
+        )
+
+        for label in ("with snapshot", "log only"):
+            started = time.perf_counter()
+            reopened = MessageLog(directory)
+            reopened.open()
+            opened = time.perf_counter() - started
+            recent = timed(lambda: reopened.recent(channels[-1], 50), 100)
+            reopened.close()
+            print(
+                f"startup {label}: {opened * 1e3:.1f} ms,"
+                f" last 50 messages of a channel: {recent * 1e6:.0f} us"
+            )
+            os.remove(os.path.join(directory, SNAPSHOT_FILE))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_search(options):
+    """Index a million channel messages in memory, then time /search queries"""
+    rng = random.Random(1)
+    # Zipf-like vocabulary: a few words are everywhere, most are rare
+    vocabulary = [f"w{i}" for i in range(options.vocabulary)]
+    weights = list(itertools.accumulate(1 / (i + 1) for i in range(options.vocabulary)))
+    channels = [f"room{i}" for i in range(options.channels)]
+    index = SearchIndex(max_bytes=options.max_bytes)
+    before = process_rss(os.getpid())
+    elapsed = 0
+    clock = time.perf_counter
+    for i in range(options.messages):
+        words = " ".join(rng.choices(vocabulary, cum_weights=weights, k=options.words))
+        channel = channels[i % len(channels)]
+        payload = encode_line(f"[12:00:00] [{channel}] user{i % 500}: {words}")
+        started = clock()
+        index.add(channel, payload)
+        elapsed += clock() - started
+    used = process_rss(os.getpid()) - before
+    print(f"messages: {options.messages}, channels: {options.channels}")
+    print(f"indexing: {elapsed / options.messages * 1e6:.1f} us per message")
+    print(
+        f"memory: {used / 2**20:.0f} MiB, {used / index.documents:.0f} bytes"
+        f" per searchable message, {index.documents} of them"
+    )
+
+    for label, query in (
+        ("common word", "w0"),
+        ("two common words", "w0 w1"),
+        ("common and rare", "w0 w5000"),
+        ("rare pair", "w3000 w5000"),
+        ("no match", "w0 nosuchword"),
+    ):
+        elapsed = timed(lambda: index.search(channels[0], query), options.repeat)
+        hits = len(index.search(channels[0], query))
+        print(f"{label:>18}: {elapsed * 1e3:7.3f} ms, {hits} hits")
+
+
+def bench_ratelimit(options):
+    """Cost of the token-bucket checks made for every line a client sends"""
+    limiter = RateLimiter({**DEFAULT_LIMITS, CHANNEL: (100.0, 200)})
+    connections = [NullConnection() for _ in range(options.connections)]
+    rng = random.Random(1)
+    order = [rng.choice(connections) for _ in range(options.checks)]
+    clock = time.monotonic
+    started = time.perf_counter()
+    for connection in order:
+        limiter.check(connection, "message", clock())
+    per_check = (time.perf_counter() - started) / options.checks
+    started = time.perf_counter()
+    for i in range(options.checks):
+        limiter.check_channel("general", clock())
+    per_channel = (time.perf_counter() - started) / options.checks
+    print(f"connections: {options.connections}, checks: {options.checks}")
+    print(f"per connection and class: {per_check * 1e6:.2f} us")
+    print(f"per channel: {per_channel * 1e6:.2f} us")
+
+
+def bench_listing(options):
+    """/list and /users on a large server, whole listings against cached pages"""
+    server = IRCServer(port=0)
+    server.server_socket.close()
+    for i in range(options.channels):
+        server.channels.create(f"room{i}")
+    members = server.channels["general"]
+    for i in range(options.members):
+        server.channels.join(server.nicknames.add(f"user{i}"), "general")
+    user1 = server.nicknames["user1"].id
+    connection = NullConnection()
+
+    def whole_list():
+        ", ".join(
+            [
+                f"#{channel} ({len(members)} users)"
+                for channel, members in list(server.channels.items())
+            ]
+        )
+
+    def whole_users():
+        ", ".join(sorted(members.nicknames()))
+
+    def churn():
+        members.discard(user1)
+        members.add(user1)
+
+    rows = [
+        ("/list, whole listing", timed(whole_list, 20)),
+        ("/list, first page", timed(lambda: server.on_list(connection, "x"), 1000)),
+        ("/users, whole sorted listing", timed(whole_users, 20)),
+        (
+            "/users, first page",
+            timed(lambda: server.on_users(connection, "x", "general"), 1000),
+        ),
+        (
+            "/users, page after a part and join",
+            timed(lambda: (churn(), server.on_users(connection, "x", "general")), 1000),
+        ),
+        ("part and join", timed(churn, 10000)),
+    ]
+    print(f"channels: {options.channels}, members of general: {options.members}")
+    for label, elapsed in rows:
+        print(f"{label:<36} {elapsed * 1e6:10.1f} us")
+
+
+class LegacyMembers(set):
+    """The previous Members: a set of nicknames, also kept in a sorted list"""
+
+    __slots__ = ("names", "version", "directory", "cache")
+
+    def __init__(self):
+        super().__init__()
+        self.names = []
+        self.version = 0
+        self.directory = None
+        self.cache = {}
+
+
+def legacy_state(channels, placements):
+    """Memberships as the server kept them before sessions: dicts of strings"""
+    clients = {}  # {connection: nickname}
+    nicknames = {}  # {nickname: connection}
+    directory = {channel: LegacyMembers() for channel in channels}
+    names = sorted(channels)
+    client_channels = {}  # {nickname: set of channels}
+    for nickname, connection, joined in placements:
+        clients[connection] = nickname
+        nicknames[nickname] = connection
+        client_channels[nickname] = set(joined)
+        for channel in joined:
+            members = directory[channel]
+            set.add(members, nickname)
+            bisect.insort(members.names, nickname)
+    return clients, nicknames, directory, names, client_channels
+
+
+def compact_state(channels, placements):
+    """The same memberships as sessions and arrays of ids"""
+    clients = {}
+    sessions = Sessions()
+    directory = ChannelDirectory(sessions)
+    for channel in channels:
+        directory.create(channel)
+    for nickname, connection, joined in placements:
+        clients[connection] = nickname
+        session = sessions.add(nickname, connection)
+        for channel in joined:
+            directory.join(session, channel)
+    return clients, sessions, directory
+
+
+def bench_memory(options):
+    """Memory held by a million channel memberships, as sets of nicknames and as id arrays"""
+    rng = random.Random(1)
+    channels = [f"channel-{i}" for i in range(options.channels)]
+    per_nickname = options.memberships // options.nicknames
+    placements = [
+        (f"user-{i}", NullConnection(), rng.sample(channels, per_nickname))
+        for i in range(options.nicknames)
+    ]
+    memberships = per_nickname * options.nicknames
+    nickname, _, joined = placements[0]
+    channel = next(channel for channel in channels if channel not in joined)
+
+    def legacy_churn(state):
+        clients, nicknames, directory, names, client_channels = state
+        members = directory[channel]
+        set.add(members, nickname)
+        bisect.insort(members.names, nickname)
+        client_channels[nickname].add(channel)
+        set.discard(members, nickname)
+        del members.names[bisect.bisect_left(members.names, nickname)]
+        client_channels[nickname].discard(channel)
+
+    def compact_churn(state):
+        clients, sessions, directory = state
+        session = sessions[nickname]
+        directory.join(session, channel)
+        directory.part(session, channel)
+
+    def legacy_member(state):
+        return nickname in state[2][channel]
+
+    def compact_member(state):
+        return state[1][nickname].is_in(state[2][channel].id)
+
+    print(
+        f"channels: {options.channels}, nicknames: {options.nicknames},"
+        f" memberships: {memberships}"
+    )
+    print(
+        f"{'':<18} {'memory (MiB)':>13} {'per membership (B)':>19}"
+        f" {'build (s)':>10} {'join+part (us)':>15} {'member test (us)':>17}"
+    )
+    for label, build, churn, member in (
+        ("sets of nicknames", legacy_state, legacy_churn, legacy_member),
+        ("arrays of ids", compact_state, compact_churn, compact_member),
+    ):
+        # The names and connections are the same in both, and not counted
+        started = time.perf_counter()
+        state = build(channels, placements)
+        built = time.perf_counter() - started
+        churned = timed(lambda: churn(state), 100000)
+        tested = timed(lambda: member(state), 100000)
+        del state
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        state = build(channels, placements)
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        del state
+        print(
+            f"{label:<18} {used / 2**20:13.1f} {used / memberships:19.1f}"
+            f" {built:10.2f} {churned * 1e6:15.2f} {tested * 1e6:17.2f}"
+        )
+
+
+class RecordingConnection(NullConnection):
+    """NullConnection that keeps everything sent to it"""
+
+    __slots__ = ("chunks",)
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def send(self, data):
+        self.chunks.append(data)
+        return len(data)
+
+
+def client_read_cpu(stream, compact):
+    """CPU seconds an IRCClient spends turning stream into events"""
+    client = IRCClient(protocol="compact" if compact else "text")
+
+    async def read():
+        reader = asyncio.StreamReader(limit=RECV_SIZE)
+        for start in range(0, len(stream), RECV_SIZE):
+            reader.feed_data(stream[start : start + RECV_SIZE])
+        reader.feed_eof()
+        started = time.process_time()
+        if compact:
+            await client.read_frames(reader)
+        else:
+            await client.read_lines(reader)
+        return time.process_time() - started
+
+    return asyncio.run(read())
+
+
+def bench_protocol(options):
+    """Bytes on the wire and CPU per channel message, text against compact framing"""
+    rng = random.Random(1)
+    server = IRCServer(port=0)
+    server.server_socket.close()
+    channels = [f"channel-{i}" for i in range(options.channels)]
+    for channel in channels:
+        server.channels.create(channel)
+    nicknames = [f"user-{i}" for i in range(options.nicknames)]
+    words = [
+        "".join(rng.choices("etaoinshrdlu", k=rng.randint(2, 9))) for _ in range(500)
+    ]
+    texts = [
+        " ".join(rng.choices(words, k=rng.randint(2, options.words * 2)))
+        for _ in range(1000)
+    ]
+    text_reader = RecordingConnection()
+    compact_reader = RecordingConnection()
+    compact_reader.compact = CompactSession()
+    for nick, connection in (("text", text_reader), ("compact", compact_reader)):
+        server.clients[connection] = nick
+        session = server.nicknames.add(nick, connection)
+        for channel in channels:
+            server.channels.join(session, channel)
+
+    # Both readers are in every channel, so each message reaches them both
+    for i in range(options.messages):
+        channel = rng.choice(channels)
+        nickname = rng.choice(nicknames)
+        text = rng.choice(texts)
+        server.broadcast_payload(
+            channel,
+            encode_line(f"[{timestamp()}] [{channel}] {nickname}: {text}"),
+            fields=(int(time.time()), nickname, text),
+        )
+
+    # Server side: one broadcast to a channel of the same clients, first
+    # speaking text and then compact
+    server.channels.create("members")
+    connections = []
+    for i in range(options.members):
+        nick = f"member-{i}"
+        connection = NullConnection()
+        connections.append(connection)
+        server.clients[connection] = nick
+        server.channels.join(server.nicknames.add(nick, connection), "members")
+
+    def broadcast():
+        text = rng.choice(texts)
+        server.broadcast_payload(
+            "members",
+            encode_line(f"[{timestamp()}] [members] user-1: {text}"),
+            fields=(int(time.time()), "user-1", text),
+        )
+
+    members = {"text": timed(broadcast, options.repeat)}
+    for connection in connections:
+        connection.compact = CompactSession()
+    broadcast()  # bind the ids outside the timing
+    members["compact"] = timed(broadcast, options.repeat)
+
+    text_stream = b"".join(text_reader.chunks)
+    compact_stream = b"".join(compact_reader.chunks)
+    print(
+        f"messages: {options.messages}, channels: {options.channels},"
+        f" nicknames: {options.nicknames}"
+    )
+    print(f"{'':<34} {'text':>10} {'compact':>10}")
+    rows = [
+        (
+            "bytes per message",
+            len(text_stream) / options.messages,
+            len(compact_stream) / options.messages,
+        ),
+        (
+            "client parse (us per message)",
+            client_read_cpu(text_stream, False) / options.messages * 1e6,
+            client_read_cpu(compact_stream, True) / options.messages * 1e6,
+        ),
+        (
+            f"broadcast to {options.members} (us)",
+            members["text"] * 1e6,
+            members["compact"] * 1e6,
+        ),
+    ]
+    for label, text, compact in rows:
+        print(f"{label:<34} {text:>10.2f} {compact:>10.2f}")
+
+
+def bench_compression(options):
+    """Compressed size and CPU of bulk replies, alone and in one connection's stream"""
+    rng = random.Random(1)
+    server = IRCServer(port=0)
+    server.server_socket.close()
+    words = [
+        "".join(rng.choices("etaoinshrdlu", k=rng.randint(2, 9))) for _ in range(500)
+    ]
+    nicknames = [f"{rng.choice(words)}{rng.randrange(100)}" for _ in range(5000)]
+    for i in range(options.channels):
+        server.channels.create(f"{rng.choice(words)}-{i}")
+    for nickname in dict.fromkeys(nicknames):
+        server.channels.join(server.nicknames.add(nickname), "general")
+    connection = RecordingConnection()
+
+    def text(length):
+        return " ".join(rng.choices(words, k=rng.randint(2, length)))
+
+    def listing():
+        server.on_list(connection, "x", "*", rng.choice(server.channels.names))
+        return connection.chunks.pop()
+
+    def users():
+        server.on_users(connection, "x", "general", "*", rng.choice(nicknames))
+        return connection.chunks.pop()
+
+    def replay():
+        lines = [
+            f"[{timestamp()}] [dev] {rng.choice(nicknames)}: {text(12)}"
+            for _ in range(50)
+        ]
+        return encode_line("\n".join(lines))
+
+    def chat():
+        # A busy channel: the messages queued for a compact client by one flush
+        return b"".join(
+            message_frame(
+                int(time.time()),
+                rng.randrange(1, 20),
+                rng.randrange(1, 1000),
+                text(12),
+            )
+            for _ in range(20)
+        )
+
+    kinds = {
+        "/help": lambda: text_frames(server.commands.help_reply(False)),
+        "/list page": lambda: text_frames(listing()),
+        "/users page": lambda: text_frames(users()),
+        "history replay": lambda: text_frames(replay()),
+        "20 chat messages": chat,
+    }
+
+    # Fresh payloads of every kind through the stream of one connection
+    stats = CompressionStats()
+    deflater = Deflater(stats, threshold=0)
+    sizes = dict.fromkeys(kinds, 0)
+    alone = dict.fromkeys(kinds, 0)
+    streamed = dict.fromkeys(kinds, 0)
+    seconds = dict.fromkeys(kinds, 0.0)
+    for _ in range(options.repeat):
+        for name, build in kinds.items():
+            payload = build()
+            sizes[name] += len(payload)
+            alone[name] += len(zlib.compress(payload, COMPRESS_LEVEL))
+            before = stats.compressed, stats.seconds
+            deflater(payload)
+            streamed[name] += stats.compressed - before[0]
+            seconds[name] += stats.seconds - before[1]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    deflaters = [Deflater(stats, threshold=0) for _ in range(100)]
+    for deflater in deflaters:
+        deflater(kinds["/help"]())
+    per_connection = (tracemalloc.get_traced_memory()[0] - before) / len(deflaters)
+    tracemalloc.stop()
+
+    print(f"{'payload':<18} {'bytes':>8} {'zlib alone':>11} {'stream':>8} {'us':>8}")
+    for name in kinds:
+        print(
+            f"{name:<18} {sizes[name] / options.repeat:>8.0f}"
+            f" {alone[name] / options.repeat:>11.0f}"
+            f" {streamed[name] / options.repeat:>8.0f}"
+            f" {seconds[name] / options.repeat * 1e6:>8.1f}"
+        )
+    print(f"stream ratio: {stats.ratio:.1f}")
+    print(f"compressor memory per connection: {per_connection / 1024:.0f} KiB")
+
+
+def process_cpu(pid):
+    """CPU seconds used so far by pid, user and system"""
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def free_port():
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def bench_tls(options):
+    """Handshake cost and channel throughput over TLS compared with plaintext"""
+    directory = tempfile.mkdtemp(prefix="pyirc-tls-")
+    certfile, keyfile = self_signed_certificate(directory)
+    port, tls_port = free_port(), free_port()
+    unlimited = ["message=0", "membership=0", "channel=0", "query=0"]
+    command = [sys.executable, os.path.join(os.path.dirname(__file__), "server.py")]
+    command += ["--mode", options.mode, "--port", str(port), "--ping-interval", "0"]
+    command += ["--tls-port", str(tls_port), "--tls-cert", certfile]
+    command += ["--tls-key", keyfile]
+    for limit in unlimited:
+        command += ["--rate-limit", limit]
+    server = subprocess.Popen(command, stderr=subprocess.DEVNULL)
+    context = client_context(certfile)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        def connect(tls, session=None):
+            sock = socket.create_connection(("127.0.0.1", tls_port if tls else port))
+            if tls:
+                sock = context.wrap_socket(
+                    sock, server_hostname="localhost", session=session
+                )
+            sock.recv(4096)  # welcome line, also delivers the session tickets
+            return sock
+
+        print(f"{'':<28} {'wall (ms)':>10} {'server CPU (ms)':>16}")
+        session = connect(True).session
+        for label, tls, resume in (
+            ("plain connect", False, False),
+            ("TLS full handshake", True, False),
+            ("TLS resumed session", True, True),
+        ):
+            cpu = process_cpu(server.pid)
+            started = time.perf_counter()
+            for _ in range(options.connections):
+                sock = connect(tls, session if resume else None)
+                if resume:
+                    session = sock.session
+                sock.close()
+            elapsed = (time.perf_counter() - started) / options.connections
+            cpu = (process_cpu(server.pid) - cpu) / options.connections
+            print(f"{label:<28} {elapsed * 1e3:10.2f} {cpu * 1e3:16.2f}")
+
+        text = "x" * options.size
+        print(
+            f"\n{options.messages} messages of {options.size} bytes "
+            f"to {options.receivers} receivers"
+        )
+        print(f"{'':<28} {'msgs/s':>10} {'MB/s':>8} {'server CPU/msg (us)':>20}")
+        for label, tls in (("plain", False), ("TLS", True)):
+            sockets = [connect(tls) for _ in range(options.receivers + 1)]
+            for i, sock in enumerate(sockets):
+                sock.sendall(encode_line(f"/nick bench{i}"))
+            time.sleep(0.5)
+
+            def drain(sock):
+                # Count the bench messages, the sender gets its own echoed too
+                seen = 0
+                pending = b""
+                while seen < options.messages:
+                    data = pending + sock.recv(65536)
+                    end = data.rfind(b"\n") + 1
+                    seen += data.count(b" bench: ", 0, end)
+                    pending = data[end:]
+
+            readers = [threading.Thread(target=drain, args=(sock,)) for sock in sockets]
+            for reader in readers:
+                reader.start()
+            cpu = process_cpu(server.pid)
+            started = time.perf_counter()
+            line = encode_line(f"bench: {text}")
+            for _ in range(options.messages):
+                sockets[0].sendall(line)
+            for reader in readers:
+                reader.join()
+            elapsed = time.perf_counter() - started
+            cpu = process_cpu(server.pid) - cpu
+            delivered = options.messages * len(sockets)
+            size = delivered * (options.size + 40)
+            print(
+                f"{label:<28} {options.messages / elapsed:10.0f} "
+                f"{size / elapsed / 2**20:8.1f} {cpu / options.messages * 1e6:20.1f}"
+            )
+            for sock in sockets:
+                sock.close()
+            time.sleep(0.5)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(directory)
+
+
+def server_pids(port):
+    """Server processes started with --port port, the current one after a restart"""
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/cmdline", "rb") as cmdline:
+                argv = cmdline.read().split(b"\0")
+        except OSError:
+            continue
+        if b"--port" in argv and argv[argv.index(b"--port") + 1] == str(port).encode():
+            pids.append(int(entry))
+    return pids
+
+
+def bench_restart(options):
+    """Pause seen by clients during a hot restart, and what survives it"""
+    port = free_port()
+    command = [sys.executable, os.path.join(os.path.dirname(__file__), "server.py")]
+    command += ["--mode", options.mode, "--port", str(port), "--ping-interval", "0"]
+    for limit in ("message=0", "membership=0", "channel=0", "query=0"):
+        command += ["--rate-limit", limit]
+    subprocess.Popen(command, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        idle = []
+        for i in range(options.connections):
+            sock = socket.create_connection(("127.0.0.1", port))
+            # Out of #general, so they only have to be kept, not read
+            sock.sendall(encode_line(f"/nick idle{i}") + encode_line("/leave general"))
+            idle.append(sock)
+        probe = socket.create_connection(("127.0.0.1", port))
+        probe.sendall(encode_line("/nick probe"))
+        data = b""
+        while b"Welcome probe!" not in data:
+            data += probe.recv(4096)
+        time.sleep(1.0)
+        # Including the probe, which may have seen the last idle clients arrive
+        for sock in idle + [probe]:
+            sock.setblocking(False)
+            try:
+                while sock.recv(65536):
+                    pass
+            except BlockingIOError:
+                pass
+        probe.setblocking(True)
+
+        def round_trip(sequence):
+            started = time.perf_counter()
+            probe.sendall(encode_line(f"seq {sequence}"))
+            data = b""
+            while not data.endswith(b"\n"):
+                data += probe.recv(4096)
+            if not data.endswith(f"probe: seq {sequence}\n".encode()):
+                raise AssertionError(f"Expected seq {sequence}, got {data!r}")
+            return time.perf_counter() - started
+
+        print(f"{options.mode} mode, {options.connections} idle clients")
+        print(f"{'':<10} {'pause (ms)':>11} {'idle clients kept':>18} {'echoes':>8}")
+        sequence = itertools.count()
+        for restart in range(1, options.restarts + 1):
+            normal = max(round_trip(next(sequence)) for _ in range(100))
+            (pid,) = server_pids(port)
+            os.kill(pid, signal.SIGHUP)
+            started = time.perf_counter()
+            pause = 0.0
+            echoes = 0
+            while time.perf_counter() - started < 3.0 or server_pids(port) == [pid]:
+                pause = max(pause, round_trip(next(sequence)))
+                echoes += 1
+            kept = 0
+            for sock in idle:
+                try:
+                    kept += sock.recv(1) != b""
+                except BlockingIOError:
+                    kept += 1
+            print(
+                f"restart {restart:<2} {pause * 1e3:11.1f} {kept:18} {echoes:8}"
+                f"   (before: {normal * 1e3:.1f} ms)"
+            )
+    finally:
+        for pid in server_pids(port):
+            os.kill(pid, signal.SIGKILL)
+
+
+def process_threads(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("Threads:"):
+                return int(line.split()[1])
+    return 0
+
+
+def bench_threads(options):
+    """Threads, memory and fan-out CPU of a thread-mode server with many clients"""
+    port = free_port()
+    command = [sys.executable, os.path.join(os.path.dirname(__file__), "server.py")]
+    command += ["--port", str(port), "--ping-interval", "0"]
+    for limit in ("message=0", "membership=0", "channel=0", "query=0"):
+        command += ["--rate-limit", limit]
+    server = subprocess.Popen(command, stderr=subprocess.DEVNULL)
+    selector = selectors.DefaultSelector()
+
+    def drain(until):
+        # Lines read from every client, until each has read until of them
+        counts = dict.fromkeys(clients, 0)
+        while min(counts.values()) < until:
+            for key, _ in selector.select(10):
+                data = key.fileobj.recv(65536)
+                if not data:
+                    raise ConnectionError("Server closed a connection")
+                counts[key.fileobj] += data.count(b"\n")
+
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        idle_threads = process_threads(server.pid)
+        idle_rss = process_rss(server.pid)
+        clients = []
+        for i in range(options.clients):
+            sock = socket.create_connection(("127.0.0.1", port))
+            sock.sendall(encode_line(f"/nick client{i}"))
+            selector.register(sock, selectors.EVENT_READ)
+            clients.append(sock)
+        time.sleep(1.0)
+        # The welcome and the joins of everyone after them
+        drain(2)
+        time.sleep(0.5)
+        for key in list(selector.get_map().values()):
+            key.fileobj.setblocking(False)
+            try:
+                while key.fileobj.recv(65536):
+                    pass
+            except BlockingIOError:
+                pass
+            key.fileobj.setblocking(True)
+        threads = process_threads(server.pid) - idle_threads
+        rss = process_rss(server.pid) - idle_rss
+        print(f"thread mode, {options.clients} clients in one channel")
+        print(f"threads: {threads} ({threads / options.clients:.1f} per client)")
+        print(
+            f"memory: {rss / 2**20:.1f} MiB ({rss / options.clients / 1024:.0f} KiB per client)"
+        )
+
+        sender = clients[0]
+        cpu = process_cpu(server.pid)
+        started = time.perf_counter()
+        for sequence in range(options.messages):
+            sender.sendall(encode_line(f"message {sequence}"))
+        drain(options.messages)
+        elapsed = time.perf_counter() - started
+        cpu = process_cpu(server.pid) - cpu
+        delivered = options.messages * options.clients
+        print(
+            f"{options.messages} messages to all: {elapsed:.2f}s, server CPU {cpu:.2f}s,"
+            f" {cpu / delivered * 1e6:.1f} us per delivery"
+        )
+    finally:
+        server.kill()
+        server.wait()
+
+
+class Peer:
+    __slots__ = ("last_seen",)
+
+
+def chat_trace(options, channels):
+    """A seeded chat session as traffic.py events: join, then talk"""
+    rng = random.Random(options.seed)
+    words = [
+        "".join(rng.choices("etaoinshrdlu", k=rng.randint(2, 9))) for _ in range(500)
+    ]
+    nicknames = [f"user{i}" for i in range(options.clients)]
+    joined = {nick: rng.sample(channels, options.joins) for nick in nicknames}
+    events = []
+    for nick in nicknames:
+        lines = [f"/nick {nick}"] + [f"/join {channel}" for channel in joined[nick]]
+        events.append([0.0, nick, OPEN])
+        events.append([0.0, nick, DATA, "".join(f"{line}\n" for line in lines)])
+    for _ in range(options.messages):
+        nick = rng.choice(nicknames)
+        roll = rng.random()
+        if roll < 0.02:
+            line = "/list"
+        elif roll < 0.04:
+            line = f"/users {rng.choice(joined[nick])}"
+        elif roll < 0.14:
+            line = f"/msg {rng.choice(nicknames)} {rng.choice(words)}"
+        else:
+            text = " ".join(rng.choices(words, k=rng.randint(2, 12)))
+            line = f"#{rng.choice(joined[nick])} {text}"
+        events.append([0.0, nick, DATA, line + "\n"])
+    events += [[0.0, nick, CLOSE] for nick in nicknames]
+    return events
+
+
+PROFILE_COVERAGE = 0.5  # share of the server's CPU a profile must account for
+
+
+def bench_profile(options):
+    """Replay a traffic trace against server.py, without and then with the profiler"""
+    port = free_port()
+    directory = tempfile.mkdtemp(prefix="pyirc-profile-")
+    command = [sys.executable, os.path.join(os.path.dirname(__file__), "server.py")]
+    command += ["--mode", options.mode, "--port", str(port), "--ping-interval", "0"]
+    command += ["--profile-dir", directory]
+    command += ["--profile-interval", str(options.interval)]
+    for limit in ("message=0", "membership=0", "channel=0", "query=0", "command=0"):
+        command += ["--rate-limit", limit]
+    server = subprocess.Popen(command, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                admin = socket.create_connection(("127.0.0.1", port))
+                break
+            except OSError:
+                time.sleep(0.1)
+        admin_file = admin.makefile("rb")
+
+        def command(line, expected):
+            admin.sendall(encode_line(line))
+            while True:
+                reply = admin_file.readline().decode()
+                if expected in reply:
+                    return reply.strip()
+
+        command("/nick admin", "Welcome admin!")
+        channels = [f"room{i}" for i in range(options.channels)]
+        for channel in channels:
+            command(f"/createchannel {channel}", f"Channel {channel} created")
+        if options.trace:
+            events = read_trace(options.trace)
+        else:
+            events = chat_trace(options, channels)
+
+        print(f"{options.mode} mode, {len(events)} events")
+        print(f"{'':<16} {'replay (s)':>11} {'server CPU (s)':>15}")
+        # The first replay also warms the server up: history, search index
+        runs = (
+            ("warm-up", False),
+            ("without profiler", False),
+            ("with profiler", True),
+        )
+        for label, profiled in runs:
+            if profiled:
+                command("/profile start", "Profiling")
+            cpu = process_cpu(server.pid)
+            counts = asyncio.run(replay("127.0.0.1", port, events))
+            cpu = process_cpu(server.pid) - cpu
+            if profiled:
+                path = command("/profile stop", "Profile written to").split()[-1]
+            print(f"{label:<16} {counts['seconds']:11.2f} {cpu:15.2f}")
+        if options.output:
+            shutil.copyfile(path, options.output)
+            print(f"profile saved to {options.output}")
+        stacks = read_collapsed(path)
+        profiled = sum(stacks.values()) / 1e6
+        print(f"profiled: {profiled:.2f}s of {cpu:.2f}s server CPU")
+        print()
+        print("\n".join(top(stacks, options.limit)))
+        # Every command goes through handle_lines, in either mode
+        handled = any(
+            name.startswith("IRCServer.handle_lines ") for name in functions(stacks)
+        )
+        if profiled < cpu * PROFILE_COVERAGE or not handled:
+            raise SystemExit("FAILED: the profile misses most of the server's work")
+    finally:
+        server.kill()
+        server.wait()
+        shutil.rmtree(directory)
+
+
+def bench_keepalive(options):
+    """Keepalive timers for many connections, some of which stop answering"""
+    keepalive = KeepAlive(options.interval, options.timeout)
+    rng = random.Random(1)
+    before = process_rss(os.getpid())
+    peers = [Peer() for _ in range(options.connections)]
+    # Connections arrive over one ping interval
+    batch = len(peers) // options.interval + 1
+    added = 0
+    for start in range(0, len(peers), batch):
+        started = time.perf_counter()
+        for peer in peers[start : start + batch]:
+            keepalive.add(peer)
+        added += time.perf_counter() - started
+        keepalive.tick(keepalive.now + 1)
+    added /= len(peers)
+    used = process_rss(os.getpid()) - before
+
+    # Most clients keep talking or answer their pings, the rest went away
+    dead = set(rng.sample(peers, int(len(peers) * options.dead)))
+    live = [peer for peer in peers if peer not in dead]
+    ticks = []
+    pinged = reaped = 0
+    for _ in range(options.interval + options.timeout + 2):
+        now = keepalive.now
+        for peer in rng.sample(live, len(live) // options.interval):
+            peer.last_seen = now
+        started = time.perf_counter()
+        ping, reap = keepalive.tick(now + 1)
+        ticks.append(time.perf_counter() - started)
+        for peer in ping:
+            if peer not in dead:
+                peer.last_seen = keepalive.now
+        pinged += len(ping)
+        reaped += len(reap)
+    print(f"connections: {len(peers)}, dead: {len(dead)}")
+    print(
+        f"add: {added * 1e6:.2f} us, memory: {used / len(peers):.0f} bytes per connection"
+    )
+    print(f"pinged: {pinged}, reaped: {reaped}, timers left: {len(keepalive.wheel)}")
+    ticks.sort()
+    print(
+        f"tick: median {ticks[len(ticks) // 2] * 1e3:.1f} ms, max {ticks[-1] * 1e3:.1f} ms"
+    )
+
+
+class ErrorCounter(logging.Handler):
+    """Swallows the server's log records, counting the crash reports"""
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.errors = 0
+
+    def emit(self, record):
+        if record.levelno >= logging.ERROR:
+            self.errors += 1
+
+
+def start_server(mode):
+    """Run an IRCServer on an ephemeral port in a background thread"""
+    # No rate limits, the churn is meant to hit the server as hard as it can
+    server = IRCServer(port=0, rate_limits={})
+    target = server.start_async if mode == "async" else server.start
+    threading.Thread(target=target, daemon=True).start()
+    return server, server.server_socket.getsockname()
+
+
+def drain(sock):
+    """Read whatever the server sent until it goes quiet or closes"""
+    try:
+        while sock.recv(65536):
+            pass
+    except OSError:
+        pass
+
+
+def churn(address, worker, channels, deadline, counts):
+    """Connect, join, chat, part and quit in a loop until the deadline"""
+    rng = random.Random(worker)
+    iteration = 0
+    while time.monotonic() < deadline:
+        iteration += 1
+        rooms = rng.sample(channels, min(3, len(channels)))
+        # Workers share nicknames so that registrations collide
+        nick = f"w{worker % 8}_{iteration % 4}"
+        lines = [f"/nick {nick}"]
+        for room in rooms:
+            lines += [f"/join {room}", f"#{room} hello from {worker}", "/list"]
+            lines.append(f"/users {room}")
+        lines += [f"/part {room}" for room in rooms[1:]]
+        lines.append(f"/nick {nick}_renamed")
+        lines.append("/quit")
+        try:
+            sock = socket.create_connection(address)
+            sock.settimeout(2)
+            if rng.random() < 0.2:
+                # Hang up halfway through without saying goodbye
+                lines = lines[: len(lines) // 2]
+                sock.sendall("".join(line + "\n" for line in lines).encode())
+                sock.close()
+            else:
+                sock.sendall("".join(line + "\n" for line in lines).encode())
+                drain(sock)
+                sock.close()
+            counts[worker] += len(lines)
+        except OSError:
+            pass
+
+
+def create_channels(address, deadline):
+    """Keep creating channels as admin so /list races with channel creation"""
+    sock = socket.create_connection(address)
+    sock.sendall(b"/nick admin\n")
+    threading.Thread(target=drain, args=(sock,), daemon=True).start()
+    created = 0
+    while time.monotonic() < deadline:
+        created += 1
+        sock.sendall(f"/createchannel extra{created}\n".encode())
+        time.sleep(0.001)
+    sock.close()
+
+
+def bench_stress(options):
+    """Churn join/part/nick/quit from many threads, then check the server state"""
+    sink = ErrorCounter()
+    logger = logging.getLogger("pyirc")
+    logger.addHandler(sink)
+    logger.propagate = False
+    # Switch threads far more often than the default 5ms to widen race windows
+    sys.setswitchinterval(options.switch_interval)
+    server, address = start_server(options.mode)
+    channels = [f"room{i}" for i in range(options.channels)]
+    for channel in channels:
+        server.create_channel(channel)
+    time.sleep(0.2)
+
+    # Idle members that receive every broadcast while the churn goes on
+    listeners = []
+    for i in range(options.listeners):
+        sock = socket.create_connection(address)
+        lines = [f"/nick listener{i}"] + [f"/join {c}" for c in channels]
+        sock.sendall("".join(line + "\n" for line in lines).encode())
+        threading.Thread(target=drain, args=(sock,), daemon=True).start()
+        listeners.append(sock)
+
+    counts = [0] * options.workers
+    deadline = time.monotonic() + options.duration
+    workers = [
+        threading.Thread(target=churn, args=(address, i, channels, deadline, counts))
+        for i in range(options.workers)
+    ]
+    workers.append(threading.Thread(target=create_channels, args=(address, deadline)))
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    for sock in listeners:
+        # close() alone does not send a FIN while drain() is blocked in recv
+        sock.shutdown(socket.SHUT_RDWR)
+        sock.close()
+    settle = time.monotonic() + 5
+    while server.clients and time.monotonic() < settle:
+        time.sleep(0.05)
+
+    leftovers = {
+        "clients": len(server.clients),
+        "nicknames": len(server.nicknames),
+        "joined": sum(len(session.channels) for session in server.nicknames.values()),
+        "members": sum(len(members) for members in server.channels.values()),
+    }
+    print(f"mode: {options.mode}, workers: {options.workers}")
+    print(f"commands: {sum(counts)} in {elapsed:.1f}s ({sum(counts) / elapsed:.0f}/s)")
+    print(f"handler crashes: {sink.errors}")
+    print(f"state left behind: {leftovers}")
+    if sink.errors or any(leftovers.values()):
+        raise SystemExit("FAILED")
+    print("OK")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PyIRC server benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    broadcast = subparsers.add_parser("broadcast", help=bench_broadcast.__doc__)
+    broadcast.add_argument("--members", type=int, default=100)
+    broadcast.add_argument(
+        "--clients", type=int, nargs="+", default=[100, 1000, 10000, 50000]
+    )
+    broadcast.add_argument("--repeat", type=int, default=200)
+    broadcast.set_defaults(func=bench_broadcast)
+
+    fanout = subparsers.add_parser("fanout", help=bench_fanout.__doc__)
+    fanout.add_argument("--members", type=int, default=5000)
+    fanout.add_argument("--length", type=int, default=200)
+    fanout.add_argument("--repeat", type=int, default=200)
+    fanout.set_defaults(func=bench_fanout)
+
+    history = subparsers.add_parser("history", help=bench_history.__doc__)
+    history.add_argument("--channels", type=int, default=10000)
+    history.add_argument("--depth", type=int, default=50)
+    history.add_argument("--messages", type=int, default=1000000)
+    history.add_argument("--budget", type=int, default=32, help="MiB")
+    history.set_defaults(func=bench_history)
+
+    message_log = subparsers.add_parser("log", help=bench_log.__doc__)
+    message_log.add_argument("--messages", type=int, default=1000000)
+    message_log.add_argument("--channels", type=int, default=1000)
+    message_log.add_argument("--dir", help="where to create the temporary log")
+    message_log.set_defaults(func=bench_log)
+
+    search = subparsers.add_parser("search", help=bench_search.__doc__)
+    search.add_argument("--messages", type=int, default=1000000)
+    search.add_argument("--channels", type=int, default=10)
+    search.add_argument("--vocabulary", type=int, default=20000)
+    search.add_argument("--words", type=int, default=8, help="words per message")
+    search.add_argument("--repeat", type=int, default=100)
+    search.add_argument(
+        "--max-bytes",
+        type=int,
+        default=SEARCH_MAX_BYTES,
+        help="memory budget of the index",
+    )
+    search.set_defaults(func=bench_search)
+
+    ratelimit = subparsers.add_parser("ratelimit", help=bench_ratelimit.__doc__)
+    ratelimit.add_argument("--connections", type=int, default=10000)
+    ratelimit.add_argument("--checks", type=int, default=1000000)
+    ratelimit.set_defaults(func=bench_ratelimit)
+
+    listing = subparsers.add_parser("listing", help=bench_listing.__doc__)
+    listing.add_argument("--channels", type=int, default=50000)
+    listing.add_argument("--members", type=int, default=100000)
+    listing.set_defaults(func=bench_listing)
+
+    memory = subparsers.add_parser("memory", help=bench_memory.__doc__)
+    memory.add_argument("--channels", type=int, default=100000)
+    memory.add_argument("--nicknames", type=int, default=100000)
+    memory.add_argument("--memberships", type=int, default=1000000)
+    memory.set_defaults(func=bench_memory)
+
+    tls = subparsers.add_parser("tls", help=bench_tls.__doc__)
+    tls.add_argument("--mode", choices=("thread", "async"), default="async")
+    tls.add_argument("--connections", type=int, default=200)
+    tls.add_argument("--messages", type=int, default=20000)
+    tls.add_argument("--receivers", type=int, default=10)
+    tls.add_argument("--size", type=int, default=100)
+    tls.set_defaults(func=bench_tls)
+
+    keepalive = subparsers.add_parser("keepalive", help=bench_keepalive.__doc__)
+    keepalive.add_argument("--connections", type=int, default=1000000)
+    keepalive.add_argument("--interval", type=int, default=60)
+    keepalive.add_argument("--timeout", type=int, default=30)
+    keepalive.add_argument("--dead", type=float, default=0.1)
+    keepalive.set_defaults(func=bench_keepalive)
+
+    protocol = subparsers.add_parser("protocol", help=bench_protocol.__doc__)
+    protocol.add_argument("--messages", type=int, default=200000)
+    protocol.add_argument("--channels", type=int, default=50)
+    protocol.add_argument("--nicknames", type=int, default=500)
+    protocol.add_argument("--words", type=int, default=6, help="average per message")
+    protocol.add_argument("--members", type=int, default=5000)
+    protocol.add_argument("--repeat", type=int, default=200)
+    protocol.set_defaults(func=bench_protocol)
+
+    compression = subparsers.add_parser("compression", help=bench_compression.__doc__)
+    compression.add_argument("--channels", type=int, default=1000)
+    compression.add_argument("--repeat", type=int, default=200)
+    compression.set_defaults(func=bench_compression)
+
+    restart = subparsers.add_parser("restart", help=bench_restart.__doc__)
+    restart.add_argument("--mode", choices=("thread", "async"), default="async")
+    restart.add_argument("--connections", type=int, default=2000)
+    restart.add_argument("--restarts", type=int, default=3)
+    restart.set_defaults(func=bench_restart)
+
+    threads = subparsers.add_parser("threads", help=bench_threads.__doc__)
+    threads.add_argument("--clients", type=int, default=1000)
+    threads.add_argument("--messages", type=int, default=200)
+    threads.set_defaults(func=bench_threads)
+
+    profile = subparsers.add_parser("profile", help=bench_profile.__doc__)
+    profile.add_argument("--mode", choices=("thread", "async"), default="async")
+    profile.add_argument(
+        "--trace", nargs="+", help="recorded trace files instead of a generated chat"
+    )
+    profile.add_argument("--clients", type=int, default=500)
+    profile.add_argument("--channels", type=int, default=20)
+    profile.add_argument("--joins", type=int, default=3, help="channels per client")
+    profile.add_argument("--messages", type=int, default=50000)
+    profile.add_argument("--seed", type=int, default=1)
+    profile.add_argument("--interval", type=float, default=0.001)
+    profile.add_argument("--limit", type=int, default=15, help="functions shown")
+    profile.add_argument("--output", help="keep the collapsed stacks in this file")
+    profile.set_defaults(func=bench_profile)
+
+    stress = subparsers.add_parser("stress", help=bench_stress.__doc__)
+    stress.add_argument("--mode", choices=("thread", "async"), default="thread")
+    stress.add_argument("--workers", type=int, default=32)
+    stress.add_argument("--listeners", type=int, default=8)
+    stress.add_argument("--channels", type=int, default=4)
+    stress.add_argument("--duration", type=float, default=5.0)
+    stress.add_argument("--switch-interval", type=float, default=1e-5)
+    stress.set_defaults(func=bench_stress)
+
+    options = parser.parse_args()
+    options.func(options)
+
+
+if __name__ == "__main__":
+    main()
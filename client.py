@@ -1,175 +1,537 @@
-import socket
-import threading
+"""PyIRC client: an asyncio core usable as a library, and a terminal UI on top.
+
+``IRCClient`` owns one connection. It reads the server's lines through a
+LineFramer, turns each into an Event and hands it to the callbacks
+registered for its kind, answers keepalive PINGs itself, and reconnects
+with exponential backoff when the connection drops, registering its
+nickname and rejoining its channels again. Nothing in it blocks or prints,
+so one event loop can drive hundreds of clients:
+
+    async def main():
+        bots = [IRCClient(nickname=f"bot{i}", channels=["dev"]) for i in range(300)]
+        for bot in bots:
+            bot.on("private", lambda bot, event: bot.msg(event.nickname, "pong"))
+        await asyncio.gather(*(bot.run() for bot in bots))
+
+With ``protocol="compact"`` the client asks the server for the compact
+binary framing (compact.py) on every connect; channel messages then arrive
+already split into their fields instead of as lines to parse, and the
+replies that change the client's state come as STATE frames naming the
+nickname or channel, which the client's state follows. Over text the client
+recognises those replies by their wording. Adding ``compress=True`` has the
+server compress large replies and busy traffic.
+
+Run ``python client.py`` for the interactive terminal client.
+"""
+
+import argparse
+import asyncio
+import inspect
+import os
+import random
+import re
 import sys
+import threading
 import time
-import os
+
+from compact import (
+    COMPRESSION_ZLIB,
+    JOINED,
+    LEFT,
+    MESSAGE,
+    PROTOCOL_COMPACT,
+    PROTOCOL_TEXT,
+    REGISTERED,
+    RENAMED,
+    STATE,
+    FrameDecoder,
+)
+from framing import RECV_SIZE, LineFramer, encode_line
+from tls import client_context
+
+BACKOFF_INITIAL = 0.5  # seconds before the first reconnect attempt
+BACKOFF_MAX = 30.0  # longest wait between reconnect attempts
+QUIT_TIMEOUT = 2.0  # seconds the terminal client waits for the server's goodbye
+NICK_RETRIES = 4  # tries for a nickname still held by the previous connection
+
+# Server lines by event kind, tried in order; "line" events carry the rest
+PATTERNS = [
+    ("ping", re.compile(r"PING (?P<text>.*)")),
+    (
+        "registered",
+        re.compile(r"Welcome (?P<nickname>.+)! You have been added to #general$"),
+    ),
+    ("nick", re.compile(r"You are now known as (?P<nickname>.+)$")),
+    ("joined", re.compile(r"You have joined (?P<channel>.+)$")),
+    ("left", re.compile(r"You have left (?P<channel>.+)$")),
+    (
+        "message",
+        re.compile(
+            r"\[(?P<time>[\d:]+)\] \[(?P<channel>[^\]]+)\] (?P<nickname>[^:]+): (?P<text>.*)"
+        ),
+    ),
+    (
+        "private",
+        re.compile(
+            r"\[(?P<time>[\d:]+)\] PRIVATE from (?P<nickname>.+?): (?P<text>.*)"
+        ),
+    ),
+    ("system", re.compile(r"SYSTEM: (?P<text>.*)")),
+    ("error", re.compile(r"ERROR: (?P<text>.*)")),
+]
+TAKEN = re.compile(r"Nickname (?P<nickname>.+) is already taken$")
+# Event kind of each STATE frame of the compact protocol, and what it names
+STATES = {
+    REGISTERED: ("registered", "nickname"),
+    RENAMED: ("nick", "nickname"),
+    JOINED: ("joined", "channel"),
+    LEFT: ("left", "channel"),
+}
+
+
+_clock = (None, "")
+
+
+def clock(when):
+    """Unix time as HH:MM:SS, formatted at most once per second"""
+    global _clock
+    second, formatted = _clock
+    if second != when:
+        formatted = time.strftime("%H:%M:%S", time.localtime(when))
+        _clock = (when, formatted)
+    return formatted
+
+
+class Event:
+    """One line from the server, classified"""
+
+    __slots__ = ("kind", "raw", "time", "channel", "nickname", "text")
+
+    def __init__(self, kind, line, time=None, channel=None, nickname=None, text=None):
+        self.kind = kind
+        self.raw = line  # None for compact messages until line is read
+        self.time = time
+        self.channel = channel
+        self.nickname = nickname
+        self.text = text
+
+    @property
+    def line(self):
+        if self.raw is None:
+            self.raw = f"[{self.time}] [{self.channel}] {self.nickname}: {self.text}"
+        return self.raw
+
+    def __repr__(self):
+        return f"Event({self.kind!r}, {self.line!r})"
+
+
+def parse_line(line):
+    for kind, pattern in PATTERNS:
+        match = pattern.match(line)
+        if match:
+            return Event(kind, line, **match.groupdict())
+    return Event("line", line)
 
 
 class IRCClient:
-    def __init__(self, host="127.0.0.1", port=9999):
+    """One connection to a PyIRC server, reconnected until close() is called
+
+    Callbacks are registered per event kind with ``on`` and called with the
+    client and the Event; coroutine callbacks run as tasks. Besides the
+    kinds in PATTERNS, the client emits "connected" and "disconnected",
+    and every server line but PINGs also fires "any". "nick_taken" names a
+    nickname given up after a reconnect, for the same one with a "_" added.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=9999,
+        nickname=None,
+        channels=(),
+        tls=None,
+        reconnect=True,
+        protocol=PROTOCOL_TEXT,
+        compress=False,
+    ):
         self.host = host
         self.port = port
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.nickname = None
-        self.current_channel = None
-        self.running = False
+        self.tls = tls  # SSLContext, or None for plaintext
+        self.protocol = protocol  # asked for on every connect
+        self.compress = compress  # only possible with the compact protocol
+        self.reconnect = reconnect
+        self.nickname = nickname  # registered again after every reconnect
+        self.channels = set(channels)  # joined, or to join once registered
+        self.registered = False
+        self.callbacks = {}  # {event kind: [callback]}
+        self.writer = None
+        self.ready = asyncio.Event()  # set while connected
+        self.closing = False
+        self.attempts = 0  # failed connects since the last success
+        self.sessions = 0  # connections made so far
+        self.nick_retries = 0  # of the nickname on this connection
 
-    def connect(self):
-        """Connect to the IRC server"""
-        try:
-            self.socket.connect((self.host, self.port))
-            self.running = True
-            return True
-        except Exception as e:
-            print(f"Connection error: {e}")
-            return False
+    def on(self, kind, callback):
+        """Call callback(client, event) for every event of kind"""
+        self.callbacks.setdefault(kind, []).append(callback)
+        return callback
 
-    def receive_messages(self):
-        """Thread function to receive and display messages from the server"""
-        while self.running:
-            try:
-                message = self.socket.recv(1024).decode("utf-8")
-                print(f'\nreceived message "{message}"')  # Debug
-                if not message:
-                    print("\nDisconnected from server")
-                    self.running = False
-                    break
+    def emit(self, event, kind=None):
+        for callback in self.callbacks.get(kind or event.kind, ()):
+            result = callback(self, event)
+            if inspect.isawaitable(result):
+                asyncio.ensure_future(result)
+
+    # Connection
 
-                # Clear the current line to display message cleanly
-                sys.stdout.write("\r" + " " * 80 + "\r")
-                print(message)
-
-                # Update current channel if we joined one
-                if "You have joined" in message:
-                    try:
-                        self.current_channel = message.split("You have joined ")[
-                            1
-                        ].strip()
-                    except:
-                        pass
-
-                # Update nickname if we set one
-                if message.startswith("You are now known as "):
-                    try:
-                        self.nickname = message.split("You are now known as ")[
-                            1
-                        ].strip()
-                    except:
-                        pass
-
-                # Extract nickname from welcome message
-                if message.startswith("Welcome ") and "!" in message:
-                    try:
-                        self.nickname = (
-                            message.split("Welcome ")[1].split("!")[0].strip()
-                        )
-                    except:
-                        pass
-
-                # Show prompt again
-                sys.stdout.write("> ")
-                sys.stdout.flush()
-
-            except Exception as e:
-                print(f"\nError receiving message: {e}")
-                self.running = False
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def run(self):
+        """Stay connected until close(), reconnecting with exponential backoff"""
+        while not self.closing:
+            try:
+                reader, self.writer = await asyncio.open_connection(
+                    self.host,
+                    self.port,
+                    ssl=self.tls,
+                    server_hostname=self.host if self.tls else None,
+                )
+            except OSError as e:
+                self.emit(Event("disconnected", "", text=str(e)))
+            else:
+                self.attempts = 0
+                await self.session(reader)
+            if self.closing or not self.reconnect:
                 break
+            delay = min(BACKOFF_MAX, BACKOFF_INITIAL * 2**self.attempts)
+            self.attempts += 1
+            # Jitter keeps many clients from reconnecting in lockstep
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
 
-    def send_command(self, command):
-        """Send a command to the server"""
+    async def session(self, reader):
+        self.registered = False
+        self.sessions += 1
+        self.nick_retries = 0
+        self.ready.set()
+        self.emit(Event("connected", ""))
+        if self.protocol != PROTOCOL_TEXT:
+            self.send(f"/protocol {self.protocol}")
+            if self.compress:
+                self.send(f"/compress {COMPRESSION_ZLIB}")
+        if self.nickname:
+            self.send(f"/nick {self.nickname}")
+        reason = "Connection closed by the server"
         try:
-            self.socket.send(command.encode("utf-8"))
-            print(f'sent command "{command}"')
-
-            # Update local state based on commands
-            if command.startswith("/nick "):
-                self.nickname = command.split(" ", 1)[1]
-            elif command.startswith("/join "):
-                self.current_channel = command.split(" ", 1)[1]
-            elif command.startswith("/leave ") or command.startswith("/part "):
-                channel = command.split(" ", 1)[1]
-                if channel == self.current_channel:
-                    self.current_channel = None
-
-        except Exception as e:
-            print(f"Error sending command: {e}")
-            self.running = False
-
-    def start(self):
-        """Start the IRC client"""
-        if not self.connect():
-            return
+            if self.protocol == PROTOCOL_COMPACT and await self.negotiate(reader):
+                await self.read_frames(reader)
+            else:
+                await self.read_lines(reader)
+        except OSError as e:
+            reason = str(e)
+        finally:
+            self.writer.close()
+            self.writer = None
+            self.ready.clear()
+            self.registered = False
+            self.emit(Event("disconnected", "", text=reason))
 
-        # Start a thread to receive messages
-        receive_thread = threading.Thread(target=self.receive_messages)
-        receive_thread.daemon = True
-        receive_thread.start()
+    async def negotiate(self, reader):
+        """Read lines one at a time until the server confirms the protocol
 
-        # Main input loop
-        try:
-            while self.running:
-                user_input = input("> ")
+        Returns False if the server closed the connection or does not know
+        the protocol, which leaves the connection speaking text.
+        """
+        confirmation = f"PROTOCOL {self.protocol}"
+        while True:
+            line = await reader.readline()
+            if not line:
+                return False
+            line = line.decode("utf-8", "replace").rstrip("\r\n")
+            if line == confirmation:
+                return True
+            self.handle_line(line)
+            if line.startswith(
+                ("ERROR: Unknown command /protocol", "ERROR: Unknown protocol")
+            ):
+                return False
 
-                if not user_input:
-                    continue
+    async def read_lines(self, reader):
+        framer = LineFramer()
+        while True:
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                return
+            for line in framer.feed(data):
+                self.handle_line(line)
 
-                if user_input.startswith("/"):
-                    if user_input.lower() == "/quit":
-                        self.send_command("/quit")
-                        self.running = False
-                        break
-                    else:
-                        self.send_command(user_input)
+    async def read_frames(self, reader):
+        decoder = FrameDecoder()
+        while True:
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                if decoder.buffer:
+                    raise OSError("Connection closed in the middle of a frame")
+                return
+            for kind, body in decoder.feed(data):
+                if kind == MESSAGE:
+                    when, channel, nickname, text = body
+                    event = Event("message", None, clock(when), channel, nickname, text)
+                    self.emit(event)
+                    self.emit(event, "any")
+                elif kind == STATE:
+                    change, name, text = decoder.state(body)
+                    if change in STATES:
+                        kind, field = STATES[change]
+                        self.handle_event(Event(kind, text, **{field: name}))
+                    else:  # from a newer server
+                        self.handle_line(text)
                 else:
-                    # If message doesn't start with /, it's a regular message
-                    self.send_command(user_input)
+                    for line in body.decode("utf-8", "replace").split("\n"):
+                        self.handle_line(line)
 
-        except KeyboardInterrupt:
-            print("\nDisconnecting...")
+    def handle_line(self, line):
+        self.handle_event(parse_line(line))
 
-        finally:
-            self.socket.close()
-            print("Disconnected from server")
-
-
-def display_help():
-    """Display help information"""
-    help_text = """
-    === PyIRC Client ===
-    
-    Connect to an IRC server and start chatting!
-    
-    Available commands:
-    /nick <nickname> - Set your nickname
-    /join <channel> - Join a channel
-    /leave <channel> - Leave a channel
-    /list - List available channels
-    /users <channel> - List users in a channel
-    /msg <nickname> <message> - Send a private message
-    /help - Show this help message
-    /quit - Disconnect from the server
-    
-    Admin commands:
-    /createchannel <channel> - Create a new channel (admin only)
-    
-    To send a message to your current channel, just type the message.
-    To send a message to a specific channel, use #channel message
+    def handle_event(self, event):
+        kind = event.kind
+        if kind == "ping":
+            self.send(f"/pong {event.text}")
+            self.emit(event)
+            return
+        if kind == "registered":
+            self.registered = True
+            self.nickname = event.nickname
+            self.channels.add("general")
+            # Rejoin everything we were in before a reconnect
+            for channel in sorted(self.channels - {"general"}):
+                self.send(f"/join {channel}")
+        elif kind == "nick":
+            self.nickname = event.nickname
+        elif kind == "joined":
+            self.channels.add(event.channel)
+        elif kind == "left":
+            self.channels.discard(event.channel)
+        elif kind == "error" and not self.registered and self.sessions > 1:
+            self.retry_nickname(event)
+        self.emit(event)
+        self.emit(event, "any")
+
+    def retry_nickname(self, event):
+        """Register after a reconnect although the nickname is taken
+
+        The server may not have noticed yet that the previous connection is
+        gone, so the nickname is tried again with backoff before a "_" is
+        added to it.
+        """
+        match = TAKEN.match(event.text)
+        if match is None or match["nickname"] != self.nickname:
+            return
+        if self.nick_retries < NICK_RETRIES:
+            delay = BACKOFF_INITIAL * 2**self.nick_retries
+            self.nick_retries += 1
+            asyncio.get_running_loop().call_later(
+                delay, self.resend_nickname, self.writer
+            )
+            return
+        self.emit(Event("nick_taken", event.line, nickname=self.nickname))
+        self.nick_retries = 0
+        self.nickname += "_"
+        self.send(f"/nick {self.nickname}")
+
+    def resend_nickname(self, writer):
+        if self.writer is writer and not self.registered:
+            self.send(f"/nick {self.nickname}")
+
+    def close(self):
+        """Disconnect and stop reconnecting"""
+        self.closing = True
+        if self.writer is not None:
+            self.writer.close()
+
+    # Commands
+
+    def send(self, line):
+        """Send one line, returns False when not connected"""
+        if not self.connected:
+            return False
+        self.writer.write(encode_line(line))
+        return True
+
+    def nick(self, nickname):
+        if not self.registered:
+            # Registered by session() on (re)connect if it is not yet
+            self.nickname = nickname
+        return self.send(f"/nick {nickname}")
+
+    def join(self, channel):
+        return self.send(f"/join {channel}")
+
+    def part(self, channel):
+        return self.send(f"/leave {channel}")
+
+    def say(self, channel, text):
+        return self.send(f"#{channel} {text}")
+
+    def msg(self, nickname, text):
+        return self.send(f"/msg {nickname} {text}")
+
+    def quit(self):
+        self.closing = True
+        return self.send("/quit")
+
+
+class TerminalClient:
+    """Interactive client: prints server lines, sends what the user types
+
+    Plain text goes to the channel joined last.
     """
-    print(help_text)
 
+    def __init__(self, client):
+        self.client = client
+        self.current_channel = None
+        client.on("any", self.show)
+        client.on("connected", self.connected)
+        client.on("disconnected", self.disconnected)
+        client.on("joined", self.joined)
+        client.on("left", self.left)
 
-if __name__ == "__main__":
-    os.system("cls" if os.name == "nt" else "clear")
+    def show(self, client, event):
+        # Clear the prompt, print the line, show the prompt again
+        sys.stdout.write(f"\r{event.line}\n> ")
+        sys.stdout.flush()
+
+    def connected(self, client, event):
+        self.show(
+            client, Event("connected", f"Connected to {client.host}:{client.port}")
+        )
+
+    def disconnected(self, client, event):
+        if not client.closing:
+            self.show(client, Event("disconnected", f"Disconnected: {event.text}"))
+
+    def joined(self, client, event):
+        self.current_channel = event.channel
+
+    def left(self, client, event):
+        if event.channel == self.current_channel:
+            self.current_channel = None
+
+    async def run(self):
+        lines = await stdin_lines()
+        connection = asyncio.ensure_future(self.client.run())
+        try:
+            while not connection.done():
+                line = await unless_done(lines.get(), connection)
+                if connection.done():
+                    break
+                if line is None or line.strip().lower() == "/quit":
+                    self.client.quit()
+                    break
+                if not line.strip():
+                    continue
+                if not line.startswith(("/", "#")) and self.current_channel:
+                    line = f"#{self.current_channel} {line}"
+                # Held until a reconnect, unless the client has stopped
+                while not self.client.send(line) and not connection.done():
+                    await unless_done(self.client.ready.wait(), connection)
+        finally:
+            # Give the server a moment to say goodbye
+            try:
+                await asyncio.wait_for(asyncio.shield(connection), QUIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.client.close()
+                await connection
+
+
+async def unless_done(awaitable, task):
+    """Result of awaitable, or None if task finishes first"""
+    waiter = asyncio.ensure_future(awaitable)
+    await asyncio.wait({waiter, task}, return_when=asyncio.FIRST_COMPLETED)
+    if not waiter.done():
+        waiter.cancel()
+        return None
+    return waiter.result()
+
+
+async def stdin_lines():
+    """Queue of the lines typed on stdin, None once it is closed"""
+    loop = asyncio.get_running_loop()
+    lines = asyncio.Queue()
+    if os.name != "nt":
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+        )
+
+        async def pump():
+            while True:
+                line = await reader.readline()
+                lines.put_nowait(line.decode("utf-8", "replace").rstrip("\r\n"))
+                if not line:
+                    lines.put_nowait(None)
+                    break
+
+        asyncio.ensure_future(pump())
+        return lines
+
+    def read_stdin():
+        # The Windows event loop cannot watch the console, so input() gets
+        # a thread of its own
+        while True:
+            try:
+                line = input()
+            except EOFError:
+                line = None
+            loop.call_soon_threadsafe(lines.put_nowait, line)
+            if line is None:
+                break
+
+    threading.Thread(target=read_stdin, daemon=True).start()
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PyIRC terminal client")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--nick", help="register this nickname on connect")
+    parser.add_argument("--tls", action="store_true", help="connect over TLS")
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="ask the server for the compact binary protocol",
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="ask the server to compress what it sends (implies --compact)",
+    )
+    parser.add_argument(
+        "--cafile", help="trust this certificate, e.g. the server's self-signed one"
+    )
+    options = parser.parse_args()
+
+    tls = client_context(options.cafile) if options.tls else None
+    client = IRCClient(
+        options.host,
+        options.port,
+        nickname=options.nick,
+        tls=tls,
+        protocol=(
+            PROTOCOL_COMPACT if options.compact or options.compress else PROTOCOL_TEXT
+        ),
+        compress=options.compress,
+    )
     print("=== PyIRC Client ===")
     print("Type /help for a list of commands")
+    try:
+        asyncio.run(TerminalClient(client).run())
+    except KeyboardInterrupt:
+        pass
+    print("Disconnected from server")
 
-    # Get server details
-    server = input("Server address (default: 127.0.0.1): ")
-    server = server if server else "127.0.0.1"
 
-    port = input("Port (default: 9999): ")
-    port = int(port) if port else 9999
-
-    # Create and start client
-    client = IRCClient(server, port)
-    client.start()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+"""Multi-process PyIRC server.
+
+The master process reserves the port and forks one worker per core. Each
+worker runs a ShardedIRCServer with its own listening socket bound with
+SO_REUSEPORT, so the kernel spreads new connections across workers (without
+SO_REUSEPORT the workers share the master's socket instead).
+
+A worker only holds sockets for its own clients, but keeps a replica of
+every nickname and channel membership in the cluster. Every state change,
+channel broadcast and private message for a remote nickname is published as
+one JSON line on the worker's end of a Unix socketpair. The master relays
+each line to every other worker, which applies it locally: a message sent to
+#general on one shard reaches the members of #general on every shard.
+"""
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import threading
+
+from framing import RECV_SIZE, LineFramer
+from server import IRCServer, run_server, terminate
+
+log = logging.getLogger("pyirc")
+
+BUS_BUFFER = 4 * 1024 * 1024  # socket buffer for each bus link
+BUS_MAX_LINE = 1024 * 1024  # longest event a worker will accept
+
+
+def encode_event(*event):
+    return (json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n").encode(
+        "utf-8"
+    )
+
+
+class ShardedIRCServer(IRCServer):
+    """IRCServer that mirrors its state changes to the other workers over a bus"""
+
+    def __init__(self, shard, bus, **kwargs):
+        super().__init__(**kwargs)
+        self.shard = shard
+        self.bus = bus
+        self.bus_lock = threading.Lock()
+        self.bus_framer = LineFramer(BUS_MAX_LINE)
+        self.remote_nicks = {}  # {nickname: shard} for clients of other workers
+        self.events = {
+            "register": self.apply_register,
+            "rename": self.apply_rename,
+            "join": self.apply_join,
+            "part": self.apply_part,
+            "create": self.apply_create,
+            "quit": self.apply_quit,
+            "deliver": self.apply_deliver,
+            "private": self.apply_private,
+            "shard_down": self.apply_shard_down,
+        }
+
+    def start(self):
+        threading.Thread(target=self.bus_loop, daemon=True).start()
+        super().start()
+
+    async def serve_async(self):
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.bus.fileno(), self.read_bus)
+        await super().serve_async()
+
+    # Local changes, published to the other workers
+
+    def request_restart(self, signum=None, frame=None):
+        # The new process could not take over this worker's end of the bus
+        log.warning("Hot restart is not supported by cluster workers")
+
+    def publish(self, *event):
+        data = encode_event(*event)
+        with self.bus_lock:
+            self.bus.sendall(data)
+
+    def register_client(self, client_socket, nickname):
+        if nickname in self.remote_nicks:
+            return False
+        if not super().register_client(client_socket, nickname):
+            return False
+        self.publish("register", self.shard, nickname)
+        return True
+
+    def rename_client(self, client_socket, old_nick, new_nick):
+        if new_nick in self.remote_nicks:
+            return False
+        if not super().rename_client(client_socket, old_nick, new_nick):
+            return False
+        self.publish("rename", old_nick, new_nick)
+        return True
+
+    def join_channel(self, nickname, channel):
+        if not super().join_channel(nickname, channel):
+            return False
+        self.publish("join", channel, nickname)
+        return True
+
+    def part_channel(self, nickname, channel):
+        if not super().part_channel(nickname, channel):
+            return False
+        self.publish("part", channel, nickname)
+        return True
+
+    def create_channel(self, channel, history_depth=None):
+        if not super().create_channel(channel, history_depth):
+            return False
+        self.publish("create", channel, history_depth)
+        return True
+
+    def remove_clients(self, client_sockets):
+        removed = super().remove_clients(client_sockets)
+        if removed:
+            self.publish("quit", *removed)
+        return removed
+
+    def broadcast_payload(
+        self, channel, payload, exclude_socket=None, record=False, fields=None
+    ):
+        super().broadcast_payload(channel, payload, exclude_socket, record, fields)
+        # Ids are interned per shard, so the fields travel and not the frame
+        self.publish("deliver", channel, payload.decode("utf-8"), record, fields)
+
+    def deliver_private(self, nickname, message):
+        if super().deliver_private(nickname, message):
+            return True
+        if nickname not in self.remote_nicks:
+            return False
+        self.publish("private", nickname, message)
+        return True
+
+    # Remote changes, applied without publishing them again
+
+    def bus_loop(self):
+        while True:
+            self.read_bus()
+
+    def read_bus(self):
+        data = self.bus.recv(RECV_SIZE)
+        if not data:
+            # Without the bus this shard would silently diverge from the rest
+            log.critical("Shard %s lost the master, exiting", self.shard)
+            os._exit(1)
+        for line in self.bus_framer.feed(data):
+            name, *args = json.loads(line)
+            self.events[name](*args)
+
+    def apply_register(self, shard, nickname):
+        with self.lock:
+            if nickname in self.nicknames:
+                # Both shards accepted the same nickname at the same time,
+                # our local client keeps it here
+                return
+            self.remote_nicks[nickname] = shard
+            # A session without a connection, broadcasts skip it
+            session = self.nicknames.add(nickname)
+            self.channels.join(session, "general")
+
+    def apply_rename(self, old_nick, new_nick):
+        with self.lock:
+            shard = self.remote_nicks.pop(old_nick, None)
+            if shard is None:
+                return
+            session = self.nicknames[old_nick]
+            if new_nick in self.nicknames:
+                # Taken here at the same time, as in apply_register
+                self.channels.part_all(session)
+                self.nicknames.remove(session)
+                self.nick_ids.release(old_nick)
+                return
+            self.remote_nicks[new_nick] = shard
+            self.channels.rename(session, new_nick)
+            self.nick_ids.release(old_nick)
+        self.announce_rename(session, old_nick)
+
+    def apply_join(self, channel, nickname):
+        if nickname in self.remote_nicks:
+            IRCServer.join_channel(self, nickname, channel)
+
+    def apply_part(self, channel, nickname):
+        if nickname in self.remote_nicks:
+            IRCServer.part_channel(self, nickname, channel)
+
+    def apply_create(self, channel, history_depth=None):
+        IRCServer.create_channel(self, channel, history_depth)
+
+    def apply_quit(self, *nicknames):
+        with self.lock:
+            for nickname in nicknames:
+                if self.remote_nicks.pop(nickname, None) is None:
+                    continue
+                session = self.nicknames[nickname]
+                self.channels.part_all(session)
+                self.nicknames.remove(session)
+                self.nick_ids.release(nickname)
+
+    def apply_deliver(self, channel, message, record=False, fields=None):
+        IRCServer.broadcast_payload(
+            self, channel, message.encode("utf-8"), record=record, fields=fields
+        )
+
+    def apply_private(self, nickname, message):
+        IRCServer.deliver_private(self, nickname, message)
+
+    def apply_shard_down(self, shard):
+        for nickname, owner in list(self.remote_nicks.items()):
+            if owner == shard:
+                self.apply_quit(nickname)
+
+
+class BusLink:
+    __slots__ = ("shard", "sock", "inbox", "outbox")
+
+    def __init__(self, shard, sock):
+        self.shard = shard
+        self.sock = sock
+        self.inbox = b""  # bytes after the last complete event
+        self.outbox = bytearray()  # relayed events the worker has not read yet
+
+
+class BusHub:
+    """Relays every event line from one worker to all the others
+
+    The hub never blocks: events a worker cannot take yet wait in its
+    outbox, so a busy worker cannot stall the bus for the rest.
+    """
+
+    def __init__(self, links):
+        self.selector = selectors.DefaultSelector()
+        self.links = {}
+        for shard, sock in links.items():
+            sock.setblocking(False)
+            link = BusLink(shard, sock)
+            self.links[shard] = link
+            self.selector.register(sock, selectors.EVENT_READ, link)
+
+    def run(self):
+        while self.links:
+            for key, events in self.selector.select():
+                link = key.data
+                if events & selectors.EVENT_READ:
+                    self.read(link)
+                if events & selectors.EVENT_WRITE and link.shard in self.links:
+                    self.write(link)
+
+    def read(self, link):
+        try:
+            data = link.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.drop(link)
+            return
+
+        data = link.inbox + data
+        end = data.rfind(b"\n") + 1
+        link.inbox = data[end:]
+        if end:
+            self.relay(link.shard, data[:end])
+
+    def relay(self, origin, data):
+        for link in list(self.links.values()):
+            if link.shard == origin:
+                continue
+            had_backlog = bool(link.outbox)
+            link.outbox += data
+            if not had_backlog:
+                self.write(link)
+
+    def write(self, link):
+        try:
+            sent = link.sock.send(link.outbox)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.drop(link)
+            return
+        del link.outbox[:sent]
+        events = selectors.EVENT_READ
+        if link.outbox:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(link.sock, events, link)
+
+    def drop(self, link):
+        log.warning("Shard %s went away", link.shard)
+        self.selector.unregister(link.sock)
+        link.sock.close()
+        del self.links[link.shard]
+        self.relay(link.shard, encode_event("shard_down", link.shard))
+
+
+def reserve_port(host, port, reuse_port):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Workers bind their own sockets to the same port; this one only
+        # reserves it (and resolves port 0) and never listens
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((host, port))
+    return listener
+
+
+def worker_socket(listener, reuse_port):
+    """The worker's own socket on the reserved port, or the shared one"""
+    if not reuse_port:
+        return listener
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind(listener.getsockname())
+    listener.close()
+    return server_socket
+
+
+def run_worker(shard, pairs, listeners, reuse_port, mode, server_options):
+    bus = pairs[shard][1]
+    for hub_end, worker_end in pairs:
+        hub_end.close()
+        if worker_end is not bus:
+            worker_end.close()
+
+    listener, tls_listener = listeners
+    server_socket = worker_socket(listener, reuse_port)
+    if tls_listener is not None:
+        server_options = dict(
+            server_options, tls_socket=worker_socket(tls_listener, reuse_port)
+        )
+
+    if server_options.get("metrics_port") is not None:
+        # Every worker keeps its own metrics, on consecutive ports
+        server_options = dict(
+            server_options, metrics_port=server_options["metrics_port"] + shard
+        )
+    if server_options.get("log_dir") is not None:
+        # and its own message log
+        server_options = dict(
+            server_options,
+            log_dir=os.path.join(server_options["log_dir"], f"shard-{shard}"),
+        )
+    if server_options.get("record_traffic") is not None:
+        # and its own trace; traffic.py merges them
+        root, extension = os.path.splitext(server_options["record_traffic"])
+        server_options = dict(
+            server_options, record_traffic=f"{root}-shard-{shard}{extension}"
+        )
+    server = ShardedIRCServer(shard, bus, server_socket=server_socket, **server_options)
+    log.info("Shard %s running in process %s", shard, os.getpid())
+    run_server(server, mode)
+
+
+def ignore_restart(signum, frame):
+    log.warning("Hot restart is not supported by the cluster, SIGTERM drains it")
+
+
+def run_cluster(host, port, workers, mode="async", **server_options):
+    """Serve host:port from several worker processes and relay between them"""
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    listener = reserve_port(host, port, reuse_port)
+    tls_listener = None
+    if server_options.get("tls_context") is not None:
+        tls_listener = reserve_port(host, server_options["tls_port"], reuse_port)
+
+    pairs = []
+    for _ in range(workers):
+        hub_end, worker_end = socket.socketpair()
+        for sock in (hub_end, worker_end):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, BUS_BUFFER)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BUS_BUFFER)
+        pairs.append((hub_end, worker_end))
+
+    context = multiprocessing.get_context("fork")
+    processes = []
+    for shard in range(workers):
+        process = context.Process(
+            target=run_worker,
+            args=(
+                shard,
+                pairs,
+                (listener, tls_listener),
+                reuse_port,
+                mode,
+                server_options,
+            ),
+            name=f"pyirc-shard-{shard}",
+        )
+        process.start()
+        processes.append(process)
+
+    for _, worker_end in pairs:
+        worker_end.close()
+    log.info(
+        "Cluster of %s workers on %s:%s (%s)",
+        workers,
+        host,
+        listener.getsockname()[1],
+        "SO_REUSEPORT" if reuse_port else "shared socket",
+    )
+
+    hub = BusHub({shard: hub_end for shard, (hub_end, _) in enumerate(pairs)})
+    # Stop the workers through the finally clause below on SIGTERM too
+    signal.signal(signal.SIGTERM, terminate)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, ignore_restart)
+
+        def profile_workers(signum, frame):
+            # Every worker writes a profile of its own
+            for process in processes:
+                os.kill(process.pid, signal.SIGUSR1)
+
+        signal.signal(signal.SIGUSR1, profile_workers)
+    try:
+        hub.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
@@ -0,0 +1,157 @@
+"""Command registry for the PyIRC server.
+
+Each slash command maps to a Command holding its handler, the rate limit
+class it is charged to, and the preconditions checked before the handler
+runs: whether the client must have a nickname, whether only the admin may
+use it, and how many arguments it takes, required and optional. The replies for a failed
+precondition are encoded once when the command is registered, and dispatch
+is a single dictionary lookup.
+
+Plugins add commands by registering them on the server's registry:
+
+    def register(commands):
+        @commands.command("/roll", arity=1, usage="/roll <sides> - Roll a die")
+        def roll(server, client_socket, nickname, sides):
+            server.reply(client_socket, str(random.randint(1, int(sides))))
+
+and are loaded with ``python server.py --plugin mymodule``.
+"""
+
+import importlib
+
+from framing import encode_line
+
+ADMIN_NICKNAME = "admin"
+
+NOT_REGISTERED = "ERROR: You must set a nickname first"
+NOT_ADMIN = "ERROR: Only admin can use {name}"
+
+
+class Command:
+    """One slash command, its preconditions and its pre-encoded error replies"""
+
+    __slots__ = (
+        "name",
+        "handler",
+        "registered",
+        "admin",
+        "arity",
+        "optional",
+        "rate_class",
+        "usage",
+        "not_registered",
+        "not_admin",
+        "missing",
+    )
+
+    def __init__(
+        self,
+        name,
+        handler,
+        registered=False,
+        admin=False,
+        arity=0,
+        optional=0,
+        rate_class="command",
+        usage="",
+        not_registered=NOT_REGISTERED,
+        not_admin=None,
+        missing=None,
+    ):
+        self.name = name
+        self.handler = handler
+        self.registered = registered  # the client must have a nickname
+        self.admin = admin  # only the admin may run it
+        # Required arguments, then optional ones the handler has defaults
+        # for; the last one takes the rest of the line
+        self.arity = arity
+        self.optional = optional
+        self.rate_class = rate_class  # token bucket charged, None for unlimited
+        self.usage = usage  # line in /help, empty to leave it out
+        self.not_registered = encode_line(not_registered)
+        self.not_admin = encode_line(not_admin or NOT_ADMIN.format(name=name))
+        if missing is None:
+            missing = f"ERROR: Usage: {usage.split(' - ', 1)[0] or name}"
+        self.missing = encode_line(missing)
+
+    def run(self, server, client_socket, nickname, args):
+        """Check the preconditions, then call the handler"""
+        if self.registered and not nickname:
+            server.send_payload(client_socket, self.not_registered)
+            return True
+        if self.admin and nickname != ADMIN_NICKNAME:
+            server.send_payload(client_socket, self.not_admin)
+            return True
+
+        arity = self.arity
+        accepted = arity + self.optional
+        if not accepted:
+            result = self.handler(server, client_socket, nickname)
+        elif not args:
+            if arity:
+                server.send_payload(client_socket, self.missing)
+                return True
+            result = self.handler(server, client_socket, nickname)
+        elif accepted == 1:
+            result = self.handler(server, client_socket, nickname, args)
+        else:
+            parts = args.split(" ", accepted - 1)
+            if len(parts) < arity:
+                server.send_payload(client_socket, self.missing)
+                return True
+            result = self.handler(server, client_socket, nickname, *parts)
+        return result is not False
+
+
+class CommandRegistry:
+    """Maps command verbs to Commands, in the order they were registered"""
+
+    def __init__(self):
+        self.commands = {}  # {"/verb": Command}, aliases included
+        self.help = {}  # {is admin: encoded /help reply}
+
+    def __contains__(self, name):
+        return name in self.commands
+
+    def get(self, verb):
+        return self.commands.get(verb)
+
+    def register(self, name, handler, aliases=(), **options):
+        command = Command(name, handler, **options)
+        for verb in (name, *aliases):
+            self.commands[verb] = command
+        self.help.clear()
+        return command
+
+    def command(self, name, **options):
+        """Decorator form of register"""
+
+        def decorate(handler):
+            self.register(name, handler, **options)
+            return handler
+
+        return decorate
+
+    def dispatch(self, server, client_socket, nickname, verb, args):
+        """Run one command line, return False to close the connection"""
+        command = self.commands.get(verb)
+        if command is None:
+            server.reply(client_socket, f"ERROR: Unknown command {verb}")
+            return True
+        return command.run(server, client_socket, nickname, args)
+
+    def help_reply(self, is_admin):
+        """The /help text, admin commands listed last"""
+        reply = self.help.get(is_admin)
+        if reply is None:
+            commands = list(dict.fromkeys(self.commands.values()))
+            lines = ["Available commands:"]
+            lines += [c.usage for c in commands if c.usage and not c.admin]
+            if is_admin:
+                lines += [c.usage for c in commands if c.usage and c.admin]
+            reply = self.help[is_admin] = encode_line("\n".join(lines))
+        return reply
+
+    def load_plugin(self, module_name):
+        """Import a module and let its register(commands) add commands"""
+        importlib.import_module(module_name).register(self)
@@ -0,0 +1,369 @@
+"""Compact binary wire format, negotiated per connection.
+
+The server speaks newline-terminated text lines by default (framing.py). A
+client that sends ``/protocol compact`` is answered with the text line
+``PROTOCOL compact``, and everything the server sends it after that line is
+framed:
+
+    type (1 byte) | body length (2 bytes, little endian) | body
+
+Channel messages, the bulk of any busy server's traffic, are MESSAGE frames:
+the Unix time, a channel id and a nickname id, 4 bytes each, followed by
+the UTF-8 text. Ids are interned by the server. Before the first frame that
+uses an id, the connection is sent a CHANNEL or NICK frame binding it to its
+name, so each name crosses the wire once per connection instead of once per
+message. The id of a nickname that has gone away may later be bound to
+another one; a client keeps the latest binding of each id. Everything else the server says travels as
+TEXT frames holding the usual text lines. What clients send stays text
+lines: commands are short and rare next to what a channel fans out.
+
+Replies that change the client's own state (registered, renamed, joined or
+left a channel) are STATE frames instead of TEXT frames: what changed, the
+nickname or channel it changed to, and the text line a person would read.
+A client keeps its state from these, without parsing the English.
+
+Like a text payload, a MESSAGE frame is built once per broadcast and the
+same bytes are queued for every compact recipient.
+
+A compact client may also send ``/compress zlib``. From then on, whenever
+the frames queued for it add up to the compression threshold by the time
+they are flushed, they go out as DEFLATE frames: raw deflate data from a
+compressor kept for the whole connection and primed with a dictionary of
+the server's stock phrases, so each batch is compressed against everything
+sent before it. Smaller flushes, such as a lone chat message, go out as
+they are and cost no compression CPU. A batch's compressed data may be
+split over several DEFLATE frames; what they inflate to is itself a stream
+of frames. A DEFLATE_RESET frame, sent when a hot restart hands the
+connection to a new process with a new compressor, tells the client to
+start a new inflater for the DEFLATE frames that follow.
+"""
+
+import collections
+import itertools
+import struct
+import threading
+import time
+import zlib
+
+PROTOCOL_TEXT = "text"
+PROTOCOL_COMPACT = "compact"
+PROTOCOLS = (PROTOCOL_TEXT, PROTOCOL_COMPACT)
+
+# Frame types
+TEXT = 0  # text lines, without the final newline
+MESSAGE = 1  # channel message: MESSAGE_HEADER, then the text
+CHANNEL = 2  # binds a channel id: ID, then the name
+NICK = 3  # binds a nickname id: ID, then the name
+DEFLATE = 4  # raw deflate data of further frames, continuing the previous ones
+DEFLATE_RESET = 5  # empty, the next DEFLATE frame starts a new stream
+STATE = 6  # a change to the client's state: STATE_HEADER, the name, the text
+
+# What a STATE frame reports, and the name it carries
+REGISTERED = 0  # the nickname registered
+RENAMED = 1  # the new nickname
+JOINED = 2  # the channel
+LEFT = 3  # the channel
+
+HEADER = struct.Struct("<BH")  # frame type, body length
+MESSAGE_HEADER = struct.Struct("<III")  # Unix time, channel id, nickname id
+ID = struct.Struct("<I")
+STATE_HEADER = struct.Struct("<BH")  # what changed, length of the name
+MAX_BODY = 0xFFFF
+REUSE_AFTER = 60.0  # seconds before a released id may name something else
+
+COMPRESSION_ZLIB = "zlib"
+COMPRESS_THRESHOLD = 512  # bytes in one flush before it is compressed
+COMPRESS_LEVEL = 6
+# A 4 KiB window keeps a compressor at about 32 KiB per connection
+WINDOW_BITS = 12
+MEM_LEVEL = 5
+# Stock phrases of the server, the most common last, where matches are
+# cheapest to encode
+DICTIONARY = (
+    b" - Set your nickname\n - Join a channel\n - Leave a channel\n"
+    b" - List available channels\n - List users in a channel\n"
+    b" - Send a private message\n - Find recent messages with all terms\n"
+    b" - Show this help message\n - Disconnect from the server\n"
+    b"Available commands:\n/nick <nickname>/join <channel>/leave <channel>"
+    b"/users <channel> [prefix] [after]/msg <nickname> <message>\n"
+    b"ERROR: Channel  does not exist\nERROR: User  not found\n"
+    b"SYSTEM:  has left  have left  has joined #general\n"
+    b"More: /users  * \nMore: /list * \nUsers in general: "
+    b"Available channels: #general ( users), #"
+    b"] PRIVATE from ] PRIVATE to ] [general] "
+)
+
+
+def frame(kind, body):
+    return HEADER.pack(kind, len(body)) + body
+
+
+def text_frames(payload):
+    """TEXT frames for an encoded text payload of one or more lines"""
+    body = payload[:-1] if payload.endswith(b"\n") else payload
+    if len(body) <= MAX_BODY:
+        return HEADER.pack(TEXT, len(body)) + body
+    # Split at line boundaries; a single line is far below MAX_BODY
+    frames = []
+    chunk = []
+    size = 0
+    for line in body.split(b"\n"):
+        if chunk and size + len(line) > MAX_BODY:
+            frames.append(frame(TEXT, b"\n".join(chunk)))
+            chunk = []
+            size = 0
+        chunk.append(line)
+        size += len(line) + 1
+    frames.append(frame(TEXT, b"\n".join(chunk)))
+    return b"".join(frames)
+
+
+def message_frame(when, channel_id, nick_id, text):
+    body = text.encode("utf-8")
+    return (
+        HEADER.pack(MESSAGE, MESSAGE_HEADER.size + len(body))
+        + MESSAGE_HEADER.pack(when, channel_id, nick_id)
+        + body
+    )
+
+
+def binding_frame(kind, name_id, name):
+    body = name.encode("utf-8")
+    return HEADER.pack(kind, ID.size + len(body)) + ID.pack(name_id) + body
+
+
+def state_frame(change, name, text):
+    name = name.encode("utf-8")
+    return frame(
+        STATE, STATE_HEADER.pack(change, len(name)) + name + text.encode("utf-8")
+    )
+
+
+class Interner:
+    """Small integer ids for names, assigned on first use
+
+    The id of a released name is given out again after REUSE_AFTER, long
+    after the last frame that used it for the old name has been queued.
+    """
+
+    __slots__ = ("ids", "counter", "released", "lock")
+
+    def __init__(self, ids=None):
+        self.ids = dict(ids or ())  # {name: id}
+        self.counter = itertools.count(max(self.ids.values(), default=0) + 1)
+        self.released = collections.deque()  # (monotonic time, id), oldest first
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __call__(self, name):
+        name_id = self.ids.get(name)
+        if name_id is None:
+            with self.lock:
+                name_id = self.ids.get(name)
+                if name_id is None:
+                    released = self.released
+                    if released and released[0][0] <= time.monotonic() - REUSE_AFTER:
+                        name_id = released.popleft()[1]
+                    else:
+                        name_id = next(self.counter)
+                    self.ids[name] = name_id
+        return name_id
+
+    def release(self, name):
+        """Forget a name that has gone away, so its id can be reused"""
+        with self.lock:
+            name_id = self.ids.pop(name, None)
+            if name_id is not None:
+                self.released.append((time.monotonic(), name_id))
+
+
+class CompactPayload:
+    """Frames encoded once for every compact recipient, and the ids they use
+
+    Id 0 is never assigned and every session knows it, so text frames need
+    no bindings.
+    """
+
+    __slots__ = ("frame", "channel", "channel_id", "nickname", "nick_id")
+
+    def __init__(self, frame, channel=None, channel_id=0, nickname=None, nick_id=0):
+        self.frame = frame
+        self.channel = channel
+        self.channel_id = channel_id
+        self.nickname = nickname
+        self.nick_id = nick_id
+
+
+class CompactSession:
+    """Per-connection state of the compact protocol: the ids it knows"""
+
+    __slots__ = ("channels", "nicks", "lock")
+
+    def __init__(self):
+        self.channels = {0}  # channel ids already bound on this connection
+        # Nickname ids are reused, so what each is bound to: {id: nickname}
+        self.nicks = {0: None}
+        self.lock = threading.Lock()  # held while binding ids
+
+    def send(self, connection, payload):
+        """Queue a CompactPayload, preceded by the bindings it needs"""
+        # Broadcasts test the bindings inline and only call this on a miss.
+        # An id is recorded once its binding is queued, so a frame sent
+        # because the id was there cannot overtake the binding, and the lock
+        # keeps two threads from both binding it.
+        with self.lock:
+            bind_channel = payload.channel_id not in self.channels
+            bind_nick = self.nicks.get(payload.nick_id) != payload.nickname
+            bindings = b""
+            if bind_channel:
+                bindings = binding_frame(CHANNEL, payload.channel_id, payload.channel)
+            if bind_nick:
+                bindings += binding_frame(NICK, payload.nick_id, payload.nickname)
+            sent = connection.send(bindings + payload.frame)
+            if bind_channel:
+                self.channels.add(payload.channel_id)
+            if bind_nick:
+                self.nicks[payload.nick_id] = payload.nickname
+            return sent
+
+
+class CompressionStats:
+    """Totals over every compressing connection, read as gauges"""
+
+    __slots__ = ("raw", "compressed", "passed", "seconds")
+
+    def __init__(self):
+        self.raw = 0  # bytes that went into a compressor
+        self.compressed = 0  # bytes that came out of it
+        self.passed = 0  # bytes sent as they were, being under the threshold
+        self.seconds = 0.0  # CPU time spent compressing
+
+    @property
+    def ratio(self):
+        return self.raw / self.compressed if self.compressed else 0.0
+
+
+class Deflater:
+    """Compresses one connection's flushes of frames into DEFLATE frames
+
+    Called with each payload the connection flushes. Bytes queued before
+    compression was turned on are passed through: the client may still be
+    reading them as text lines.
+    """
+
+    __slots__ = ("compressor", "threshold", "stats", "skip")
+
+    def __init__(self, stats, threshold=COMPRESS_THRESHOLD, level=COMPRESS_LEVEL):
+        self.compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL, zdict=DICTIONARY
+        )
+        self.threshold = threshold
+        self.stats = stats
+        self.skip = 0  # bytes at the start of the next flush to pass through
+
+    def __call__(self, payload):
+        if self.skip:
+            head = payload[: self.skip]
+            self.skip -= len(head)
+            return head + self(payload[len(head) :])
+        stats = self.stats
+        if len(payload) < self.threshold:
+            stats.passed += len(payload)
+            return payload
+        started = time.thread_time()
+        data = self.compressor.compress(payload)
+        data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        stats.seconds += time.thread_time() - started
+        stats.raw += len(payload)
+        stats.compressed += len(data)
+        if len(data) <= MAX_BODY:
+            return HEADER.pack(DEFLATE, len(data)) + data
+        return b"".join(
+            frame(DEFLATE, data[start : start + MAX_BODY])
+            for start in range(0, len(data), MAX_BODY)
+        )
+
+
+class FrameDecoder:
+    """Reassembles frames from a byte stream and resolves the ids they use"""
+
+    __slots__ = ("buffer", "channels", "nicks", "inflater", "inflated")
+
+    def __init__(self):
+        self.buffer = b""
+        self.channels = {}  # {id: name}
+        self.nicks = {}
+        self.inflater = None  # created by the first DEFLATE frame
+        self.inflated = b""  # inflated bytes short of a whole frame
+
+    def feed(self, data):
+        """Return the complete frames in data as (type, body) pairs
+
+        Binding frames are applied and DEFLATE frames inflated here, only
+        the frames they hold are returned. A MESSAGE frame comes back as its
+        (time, channel, nickname, text), resolved before a later binding in
+        the same data can change its ids.
+        """
+        frames = []
+        self.buffer = self.parse(self.buffer + data if self.buffer else data, frames)
+        return frames
+
+    def parse(self, buffer, frames):
+        """Append the complete frames in buffer to frames, return the rest"""
+        position = 0
+        end = len(buffer)
+        header_size = HEADER.size
+        unpack = HEADER.unpack_from
+        while end - position >= header_size:
+            kind, length = unpack(buffer, position)
+            start = position + header_size
+            if end - start < length:
+                break
+            body = buffer[start : start + length]
+            position = start + length
+            if kind == CHANNEL:
+                self.channels[ID.unpack_from(body)[0]] = body[ID.size :].decode(
+                    "utf-8", "replace"
+                )
+            elif kind == NICK:
+                self.nicks[ID.unpack_from(body)[0]] = body[ID.size :].decode(
+                    "utf-8", "replace"
+                )
+            elif kind == DEFLATE:
+                if self.inflater is None:
+                    # The largest window, whatever the server compresses with
+                    self.inflater = zlib.decompressobj(-15, zdict=DICTIONARY)
+                inflated = self.inflater.decompress(body)
+                if self.inflated:
+                    inflated = self.inflated + inflated
+                self.inflated = self.parse(inflated, frames)
+            elif kind == DEFLATE_RESET:
+                self.inflater = None
+                self.inflated = b""
+            elif kind == MESSAGE:
+                frames.append((kind, self.message(body)))
+            else:
+                frames.append((kind, body))
+        return buffer[position:]
+
+    def message(self, body):
+        """(time, channel, nickname, text) of a MESSAGE frame's body"""
+        when, channel_id, nick_id = MESSAGE_HEADER.unpack_from(body)
+        return (
+            when,
+            self.channels.get(channel_id, str(channel_id)),
+            self.nicks.get(nick_id, str(nick_id)),
+            body[MESSAGE_HEADER.size :].decode("utf-8", "replace"),
+        )
+
+    def state(self, body):
+        """(change, name, text) of a STATE frame's body"""
+        change, length = STATE_HEADER.unpack_from(body)
+        start = STATE_HEADER.size
+        return (
+            change,
+            body[start : start + length].decode("utf-8", "replace"),
+            body[start + length :].decode("utf-8", "replace"),
+        )
@@ -0,0 +1,467 @@
+"""Per-client connection objects with buffered, coalesced outbound queues.
+
+Handlers never write to a socket directly. ``send`` appends to the
+connection's outbound buffer and returns immediately; the buffer is flushed
+in as few writes as possible by the one writer thread all threaded
+connections share (threaded mode) or at the end of the current event loop
+iteration (asyncio mode). A connection that negotiated compression
+compresses each flush as a whole, off the handler's path in threaded mode.
+A client that stops reading is cut off once its buffer passes the
+high-water mark, so one slow reader can never stall a broadcast to the
+rest of the channel.
+"""
+
+import asyncio
+import select
+import selectors
+import socket
+import ssl
+import threading
+import time
+
+DEFAULT_HIGH_WATER = 256 * 1024  # bytes queued for one client before overflow
+COALESCE_LIMIT = 16 * 1024  # flush early once this much is queued in one go
+CLOSE_TIMEOUT = 5.0  # seconds a closing connection may spend flushing
+# Writes that fail rather than block on a blocking socket; without the flag
+# (Windows) a full socket stalls the writer until it takes more
+SEND_FLAGS = getattr(socket, "MSG_DONTWAIT", 0)
+
+OVERFLOW_DISCONNECT = "disconnect"
+OVERFLOW_DROP = "drop"
+OVERFLOW_POLICIES = (OVERFLOW_DISCONNECT, OVERFLOW_DROP)
+
+
+class SlowConsumerError(ConnectionError):
+    """Raised by send() when a client is disconnected for not reading its data"""
+
+
+class BufferedConnection:
+    """Common outbound buffer bookkeeping, subclasses decide how to flush"""
+
+    __slots__ = (
+        "high_water",
+        "overflow",
+        "chunks",
+        "pending",
+        "dropped",
+        "closed",
+        "last_seen",
+        "compact",
+        "deflate",
+    )
+
+    def __init__(self, high_water=DEFAULT_HIGH_WATER, overflow=OVERFLOW_DISCONNECT):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}")
+        self.high_water = high_water
+        self.overflow = overflow
+        self.chunks = []
+        self.pending = 0
+        self.dropped = 0
+        self.closed = False
+        self.last_seen = 0  # keepalive tick of the last data from the client
+        self.compact = None  # CompactSession once the client chose that protocol
+        self.deflate = None  # Deflater applied to every flush once compressing
+
+    def queued(self):
+        """Bytes accepted by send() that have not reached the kernel yet"""
+        return self.pending
+
+    def send(self, data):
+        """Queue data for the client, return the number of bytes accepted"""
+        if self.closed:
+            raise ConnectionError("Connection is closed")
+
+        queued = self.queued()
+        if queued and queued + len(data) > self.high_water:
+            if self.overflow == OVERFLOW_DROP:
+                self.dropped += 1
+                return 0
+            self.abort()
+            raise SlowConsumerError(
+                f"Outbound buffer exceeded {self.high_water} bytes, disconnecting"
+            )
+
+        self.chunks.append(data)
+        self.pending += len(data)
+        self.schedule_flush()
+        return len(data)
+
+    def flushed(self):
+        """True once everything accepted by send() has reached the kernel"""
+        return self.queued() == 0
+
+    def transferable(self):
+        """True if the socket can be handed to another process as it is"""
+        return False
+
+    def compress(self, deflater):
+        """Pass everything queued from now on through deflater when flushing"""
+        deflater.skip = self.pending
+        self.deflate = deflater
+
+    def take_chunks(self):
+        """Swap out everything queued so far as one coalesced payload"""
+        chunks = self.chunks
+        self.chunks = []
+        self.pending = 0
+        if len(chunks) == 1:
+            return chunks[0]
+        return b"".join(chunks)
+
+    def schedule_flush(self):
+        raise NotImplementedError
+
+    def abort(self):
+        raise NotImplementedError
+
+
+class Writer:
+    """The thread that flushes the queues of every ThreadedConnection
+
+    Sockets are written without blocking. A connection whose socket is full
+    waits in a selector until it takes more, so one slow client never holds
+    up the others, and a thousand clients cost one thread instead of a
+    thousand.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.wake, self.waker = socket.socketpair()
+        self.wake.setblocking(False)
+        self.selector.register(self.wake, selectors.EVENT_READ)
+        self.lock = threading.Lock()
+        self.ready = []  # connections with something new to write, or closing
+        self.sleeping = False  # in select(), woken by the next schedule()
+        self.blocked = set()  # connections waiting in the selector
+        self.deadlines = {}  # {blocked connection that is closing: deadline}
+        self.thread = threading.Thread(target=self.run, name="writer", daemon=True)
+        self.thread.start()
+
+    def schedule(self, connection):
+        """Have the writer flush connection soon"""
+        with self.lock:
+            self.ready.append(connection)
+            if self.sleeping:
+                self.sleeping = False
+                self.waker.send(b"\0")
+
+    def run(self):
+        selector = self.selector
+        blocked = self.blocked
+        deadlines = self.deadlines
+        while True:
+            with self.lock:
+                ready, self.ready = self.ready, []
+                self.sleeping = not ready
+            timeout = 0
+            if not ready:
+                timeout = None
+                if deadlines:
+                    timeout = max(0.0, min(deadlines.values()) - time.monotonic())
+            for key, _ in selector.select(timeout):
+                connection = key.data
+                if connection is None:
+                    try:
+                        while self.wake.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                selector.unregister(key.fileobj)
+                blocked.discard(connection)
+                deadlines.pop(connection, None)
+                ready.append(connection)
+            for connection in ready:
+                if connection in blocked:
+                    # Flushed once its socket takes more, or by the deadline
+                    if connection.closing and connection not in deadlines:
+                        deadlines[connection] = connection.deadline
+                    continue
+                try:
+                    events = connection.flush()
+                except Exception:
+                    # A bug, which must not stop the writes of everyone else
+                    connection.finish()
+                    continue
+                if events:
+                    selector.register(connection.socket, events, connection)
+                    blocked.add(connection)
+                    if connection.closing:
+                        deadlines[connection] = connection.deadline
+            if deadlines:
+                now = time.monotonic()
+                for connection, deadline in list(deadlines.items()):
+                    if deadline <= now:
+                        # Still not taking its last data, give up on it
+                        del deadlines[connection]
+                        blocked.discard(connection)
+                        selector.unregister(connection.socket)
+                        connection.finish()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def shared_writer():
+    """The process's Writer, started on first use"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = Writer()
+        return _writer
+
+
+class ThreadedConnection(BufferedConnection):
+    """Blocking socket whose writes are drained by the shared Writer thread"""
+
+    __slots__ = (
+        "socket",
+        "condition",
+        "writer",
+        "closing",
+        "scheduled",
+        "writing",
+        "outbox",
+        "deadline",
+        "done",
+    )
+
+    def __init__(self, client_socket, **kwargs):
+        super().__init__(**kwargs)
+        self.socket = client_socket
+        self.condition = threading.Condition(threading.Lock())
+        self.writer = shared_writer()
+        self.closing = False
+        self.scheduled = False  # with the writer, until it finds nothing to write
+        self.writing = False  # the writer holds data it has not written yet
+        self.outbox = b""  # what the writer holds, as a memoryview
+        self.deadline = None  # when a closing connection stops flushing
+        self.done = False  # the writer closed the socket
+
+    def send(self, data):
+        with self.condition:
+            return super().send(data)
+
+    def queued(self):
+        return self.pending + len(self.outbox)
+
+    def compress(self, deflater):
+        with self.condition:
+            super().compress(deflater)
+
+    def flushed(self):
+        with self.condition:
+            return not self.chunks and not self.writing
+
+    def transferable(self):
+        return True
+
+    def schedule_flush(self):
+        # Called with self.condition held
+        if not self.scheduled:
+            self.scheduled = True
+            self.writer.schedule(self)
+
+    def recv(self, bufsize):
+        return self.socket.recv(bufsize)
+
+    def getpeername(self):
+        return self.socket.getpeername()
+
+    def flush(self):
+        """Write what the socket takes without blocking, from the writer thread
+
+        Returns the selector events to wait for before trying again, or 0
+        once everything is written or the connection is done.
+        """
+        if self.done:
+            return 0
+        while True:
+            if not self.outbox:
+                with self.condition:
+                    if not self.chunks:
+                        self.writing = False
+                        if not self.closing:
+                            self.scheduled = False
+                            return 0
+                        break
+                    payload = self.take_chunks()
+                    # Read with the chunks, so it never covers bytes queued before it
+                    deflate = self.deflate
+                    self.writing = True
+                try:
+                    if deflate is not None:
+                        payload = deflate(payload)
+                except Exception:
+                    break
+                self.outbox = memoryview(payload)
+            try:
+                sent = self.write(self.outbox)
+            except (BlockingIOError, ssl.SSLWantWriteError):
+                return selectors.EVENT_WRITE
+            except ssl.SSLWantReadError:
+                return selectors.EVENT_READ
+            except OSError:
+                break
+            self.outbox = self.outbox[sent:]
+        self.finish()
+        return 0
+
+    def write(self, view):
+        """Write part of view without blocking, returns how much was written"""
+        return self.socket.send(view, SEND_FLAGS)
+
+    def finish(self):
+        """Close the socket, and drop whatever was not written"""
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        with self.condition:
+            self.closed = True
+            self.chunks = []
+            self.pending = 0
+            self.outbox = b""
+            self.writing = False
+            self.done = True
+            self.condition.notify_all()
+
+    def wait_closed(self, timeout=None):
+        """Wait until the writer has closed the socket, False if timeout passed"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.done, timeout)
+
+    def close(self):
+        """Flush whatever is queued, then close the socket"""
+        with self.condition:
+            if self.closing:
+                return
+            self.closing = True
+            self.closed = True
+            self.deadline = time.monotonic() + CLOSE_TIMEOUT
+            self.writer.schedule(self)
+
+    def abort(self):
+        """Discard queued data and tear the socket down immediately"""
+        # Called with self.condition held from send()
+        self.closed = True
+        self.closing = True
+        self.deadline = time.monotonic()
+        self.chunks = []
+        self.pending = 0
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.writer.schedule(self)
+
+
+def wait_for(sock, writable, timeout=None):
+    """Block until sock is readable or writable, False if timeout passed first"""
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT if writable else select.POLLIN)
+        return bool(poller.poll(None if timeout is None else timeout * 1000))
+    if writable:
+        return bool(select.select([], [sock], [], timeout)[1])
+    return bool(select.select([sock], [], [], timeout)[0])
+
+
+class TLSConnection(ThreadedConnection):
+    """ThreadedConnection over a TLS socket
+
+    An SSL connection must not be read and written from two threads at
+    once, so the socket is non-blocking and every TLS call is made under a
+    lock; the reading thread waits for the socket without holding it.
+    """
+
+    __slots__ = ("tls_lock",)
+
+    def __init__(self, tls_socket, **kwargs):
+        self.tls_lock = threading.Lock()
+        tls_socket.setblocking(False)
+        super().__init__(tls_socket, **kwargs)
+
+    def call(self, method, data, sending, timeout=None):
+        while True:
+            with self.tls_lock:
+                try:
+                    return method(data)
+                except ssl.SSLWantReadError:
+                    writable = False
+                except ssl.SSLWantWriteError:
+                    writable = True
+                except BlockingIOError:
+                    writable = sending
+            if not wait_for(self.socket, writable, timeout):
+                raise socket.timeout("TLS connection timed out")
+
+    def recv(self, bufsize):
+        return self.call(self.socket.recv, bufsize, False)
+
+    def transferable(self):
+        # The TLS session lives in this process
+        return False
+
+    def write(self, view):
+        with self.tls_lock:
+            return self.socket.send(view)
+
+
+class StreamConnection(BufferedConnection):
+    """Wraps an asyncio transport, coalescing all sends made in one loop iteration"""
+
+    __slots__ = ("transport", "loop", "flush_scheduled")
+
+    def __init__(self, transport, **kwargs):
+        super().__init__(**kwargs)
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self.flush_scheduled = False
+
+    def queued(self):
+        return self.pending + self.transport.get_write_buffer_size()
+
+    def schedule_flush(self):
+        if self.pending >= COALESCE_LIMIT:
+            # Hand big batches to the transport now so that only bytes the
+            # kernel refused count towards the high-water mark
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.scheduled_flush)
+
+    def scheduled_flush(self):
+        self.flush_scheduled = False
+        self.flush()
+
+    def flush(self):
+        if self.chunks and not self.transport.is_closing():
+            payload = self.take_chunks()
+            if self.deflate is not None:
+                payload = self.deflate(payload)
+            self.transport.write(payload)
+
+    def getpeername(self):
+        return self.transport.get_extra_info("peername")
+
+    def transferable(self):
+        return self.transport.get_extra_info("ssl_object") is None
+
+    def close(self):
+        """Flush whatever is queued, then close the transport"""
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        self.transport.close()
+
+    def abort(self):
+        """Discard queued data and drop the transport immediately"""
+        self.closed = True
+        self.chunks = []
+        self.pending = 0
+        self.transport.abort()
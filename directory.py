@@ -0,0 +1,254 @@
+"""Sessions, channels and who is in which, compact enough for millions.
+
+A registered nickname is a ``Session`` with a small integer id, reused
+once it ends, and every channel has an id of its own. Membership is kept
+twice, as arrays of 4-byte ids: ``Members`` holds the session ids of a
+channel's members, a session holds the ids of its channels. A membership
+then costs 8 bytes, where sets and lists of nicknames cost over 100, and
+the fixed cost of a channel or session is a few small objects.
+
+``Members`` keeps its ids sorted by nickname, using the nicknames by id as
+the sort key, so a join or part is one binary search and /users pages in
+nickname order. Broadcasts map the ids to connections in one C-level call.
+``ChannelDirectory`` is the dict of channels by name and keeps the channel
+names sorted the same way. A page of either listing is then a binary
+search for where it starts plus a slice, whatever the size of the server.
+
+Every change bumps a version counter, on the channel and on the directory.
+Formatted replies are cached together with the version they were built
+from, so repeating a query that nothing has changed since costs a
+dictionary lookup.
+"""
+
+import bisect
+import itertools
+from array import array
+
+PAGE_SIZE = 100  # channels or nicknames per /list or /users reply
+MAX_CACHED = 64  # cached replies kept per channel and for /list
+
+
+def page(names, prefix, after, limit, key=None):
+    """Up to limit names starting with prefix and sorting after after
+
+    names may also be ids sorted by key(id), the name of each.
+    Returns the names and whether there are more.
+    """
+    start = bisect.bisect_right(names, after, key=key) if after else 0
+    if prefix:
+        start = max(start, bisect.bisect_left(names, prefix, key=key))
+    if key is None:
+        found = names[start : start + limit + 1]
+    else:
+        # One C-level call, which other threads cannot interleave with
+        found = list(map(key, itertools.islice(names, start, start + limit + 1)))
+    if prefix:
+        found = [name for name in found if name.startswith(prefix)]
+    return found[:limit], len(found) > limit
+
+
+class Session:
+    """A registered nickname, its connection and the channels it is in"""
+
+    __slots__ = ("id", "nickname", "connection", "channels")
+
+    def __init__(self, session_id, nickname, connection):
+        self.id = session_id
+        self.nickname = nickname
+        self.connection = connection  # None for a client of another cluster worker
+        self.channels = array("I")  # ids of the channels joined, ascending
+
+    def is_in(self, channel_id):
+        """Whether the session is in the channel with this id"""
+        channels = self.channels
+        i = bisect.bisect_left(channels, channel_id)
+        try:
+            return channels[i] == channel_id
+        except IndexError:  # past the end, or parted by another thread meanwhile
+            return False
+
+
+class Sessions(dict):
+    """{nickname: Session}, with the ids of ended sessions reused"""
+
+    def __init__(self):
+        super().__init__()
+        self.names = []  # nickname of each session id, None while free
+        self.connections = []  # connection of each session id
+        self.free = []  # ids to reuse
+
+    def add(self, nickname, connection=None):
+        if self.free:
+            session_id = self.free.pop()
+            self.names[session_id] = nickname
+            self.connections[session_id] = connection
+        else:
+            session_id = len(self.names)
+            self.names.append(nickname)
+            self.connections.append(connection)
+        session = self[nickname] = Session(session_id, nickname, connection)
+        return session
+
+    def remove(self, session):
+        """End a session, which must have left its channels"""
+        del self[session.nickname]
+        self.names[session.id] = None
+        self.connections[session.id] = None
+        self.free.append(session.id)
+
+    def rename(self, session, nickname):
+        """Move a session to a new nickname, which must be out of its channels"""
+        del self[session.nickname]
+        session.nickname = self.names[session.id] = nickname
+        self[nickname] = session
+
+
+class Members:
+    """Session ids of the members of one channel, sorted by nickname"""
+
+    __slots__ = ("id", "name", "ids", "version", "directory", "cache")
+
+    def __init__(self, channel_id, name, directory):
+        self.id = channel_id
+        self.name = name
+        self.ids = array("I")
+        self.version = 0
+        self.directory = directory  # told about every change
+        self.cache = None  # {(prefix, after): (version, reply)}, made on first use
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, session_id):
+        return self.find(session_id) >= 0
+
+    def find(self, session_id):
+        """Where session_id is in ids, -1 if it is not"""
+        names = self.directory.sessions.names
+        name = names[session_id]
+        if name is None:  # ended, by another thread than the caller's
+            return -1
+        ids = self.ids
+        i = bisect.bisect_left(ids, name, key=names.__getitem__)
+        if i < len(ids) and ids[i] == session_id:
+            return i
+        return -1
+
+    def add(self, session_id):
+        """Add a member, returns False if it was one already"""
+        names = self.directory.sessions.names
+        ids = self.ids
+        i = bisect.bisect_left(ids, names[session_id], key=names.__getitem__)
+        if i < len(ids) and ids[i] == session_id:
+            return False
+        ids.insert(i, session_id)
+        self.changed()
+        return True
+
+    def discard(self, session_id):
+        """Remove a member, returns False if it was not one"""
+        i = self.find(session_id)
+        if i < 0:
+            return False
+        del self.ids[i]
+        self.changed()
+        return True
+
+    def nicknames(self):
+        """The members' nicknames, in sorted order"""
+        return list(map(self.directory.sessions.names.__getitem__, self.ids))
+
+    def changed(self):
+        self.version += 1
+        self.directory.version += 1
+
+    def page(self, prefix="", after="", limit=PAGE_SIZE):
+        names = self.directory.sessions.names
+        return page(self.ids, prefix, after, limit, names.__getitem__)
+
+
+class ChannelDirectory(dict):
+    """{channel name: Members}, with the names kept in sorted order"""
+
+    def __init__(self, sessions):
+        super().__init__()
+        self.sessions = sessions  # the Sessions whose ids are members
+        self.by_id = []  # Members of each channel id
+        self.names = []  # sorted channel names
+        self.version = 0  # bumped by new channels and by every membership change
+        self.cache = {}  # {(prefix, after): (version, reply)}
+
+    def create(self, channel):
+        """Add an empty channel, or return the existing one"""
+        members = self.get(channel)
+        if members is None:
+            members = self[channel] = Members(len(self.by_id), channel, self)
+            self.by_id.append(members)
+            bisect.insort(self.names, channel)
+            self.version += 1
+        return members
+
+    def page(self, prefix="", after="", limit=PAGE_SIZE):
+        return page(self.names, prefix, after, limit)
+
+    def joined(self, session):
+        """Names of the channels session is in, oldest channel first"""
+        return [self.by_id[channel_id].name for channel_id in session.channels]
+
+    def join(self, session, channel):
+        """Add session to a channel, returns False if there is no such channel"""
+        members = self.get(channel)
+        if members is None:
+            return False
+        if members.add(session.id):
+            bisect.insort(session.channels, members.id)
+        return True
+
+    def part(self, session, channel):
+        """Remove session from a channel, returns False if it was not a member"""
+        members = self.get(channel)
+        if members is None or not members.discard(session.id):
+            return False
+        joined = session.channels
+        del joined[bisect.bisect_left(joined, members.id)]
+        return True
+
+    def part_all(self, session):
+        """Remove session from all its channels, returns their names"""
+        left = self.joined(session)
+        for channel_id in session.channels:
+            self.by_id[channel_id].discard(session.id)
+        del session.channels[:]
+        return left
+
+    def rename(self, session, nickname):
+        """Give session a new nickname, returns the names of its channels
+
+        Its place in each channel's sorted ids moves with the nickname.
+        """
+        joined = [self.by_id[channel_id] for channel_id in session.channels]
+        for members in joined:
+            members.discard(session.id)
+        self.sessions.rename(session, nickname)
+        for members in joined:
+            members.add(session.id)
+        return [members.name for members in joined]
+
+
+def cached(owner, key, build):
+    """owner's cached reply for key, rebuilt if owner changed since"""
+    cache = owner.cache
+    if cache is None:
+        cache = owner.cache = {}
+    entry = cache.get(key)
+    if entry is not None and entry[0] == owner.version:
+        return entry[1]
+    version = owner.version
+    reply = build()
+    if len(cache) >= MAX_CACHED:
+        cache.clear()
+    cache[key] = (version, reply)
+    return reply
@@ -0,0 +1,72 @@
+"""Newline-delimited framing for the PyIRC wire protocol.
+
+Every command a client sends and every message the server sends is one UTF-8
+line terminated by ``\\n`` (a preceding ``\\r`` is ignored). TCP is a byte
+stream, so a single read may carry several lines, part of a line, or half of
+a multibyte character; LineFramer reassembles complete lines from whatever
+the socket hands us.
+"""
+
+import codecs
+
+MAX_LINE_LENGTH = 4096  # characters, longer lines are truncated
+RECV_SIZE = 16384  # bytes requested per read
+
+
+def encode_line(text):
+    """Frame and encode one outgoing message"""
+    return (text + "\n").encode("utf-8")
+
+
+class LineFramer:
+    """Incremental decoder that turns a stream of bytes into complete lines"""
+
+    __slots__ = ("max_line", "decoder", "partial", "discarding")
+
+    def __init__(self, max_line=MAX_LINE_LENGTH):
+        self.max_line = max_line
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.partial = ""  # start of a line whose newline has not arrived yet
+        self.discarding = False  # partial hit max_line, drop input until newline
+
+    def feed(self, data):
+        """Consume bytes from the socket, return the list of completed lines"""
+        text = self.decoder.decode(data)
+        if "\n" not in text:
+            self.keep(text)
+            return []
+
+        *complete, rest = text.split("\n")
+        lines = []
+        for part in complete:
+            if self.discarding:
+                line = self.partial
+                self.discarding = False
+            elif self.partial:
+                line = (self.partial + part)[: self.max_line]
+            else:
+                line = part[: self.max_line]
+            self.partial = ""
+            if line.endswith("\r"):
+                line = line[:-1]
+            lines.append(line)
+
+        self.keep(rest)
+        return lines
+
+    def getstate(self):
+        """(partial line, discarding, undecoded bytes), to carry on elsewhere"""
+        return self.partial, self.discarding, self.decoder.getstate()[0]
+
+    def setstate(self, state):
+        self.partial, self.discarding, pending = state
+        self.decoder.setstate((pending, 0))
+
+    def keep(self, text):
+        """Buffer the unterminated tail of the stream, bounded by max_line"""
+        if self.discarding or not text:
+            return
+        self.partial += text
+        if len(self.partial) > self.max_line:
+            self.partial = self.partial[: self.max_line]
+            self.discarding = True
@@ -0,0 +1,209 @@
+"""Hot restart: handing listening sockets and live clients to a new process.
+
+On SIGHUP the server stops accepting, stops reading from its clients and
+lets their outbound queues drain. It then starts a fresh copy of itself
+(same interpreter, same command line) and passes it, over a Unix socket,
+the listening sockets and every client connection as file descriptors
+(SCM_RIGHTS), followed by the server state as JSON: channels, history,
+memberships, and per client its nickname, unread partial line and protocol
+options. The new process adopts the sockets and tells the old one it is
+ready, and the old one exits without closing anything. Clients see no
+disconnect and nothing they sent is lost: what was not read yet is still in
+the kernel's buffers, now read by the new process.
+
+Connections that cannot be handed over, because TLS state lives inside the
+old process or because they did not drain in time, are told to reconnect
+and closed. If the new process fails to come up, the old one carries on.
+
+Wire format of a handoff: a header with the number of descriptors and the
+length of the state, the descriptors in batches with one byte each, then
+the state.
+"""
+
+import json
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+HANDOFF_ENV = "PYIRC_HANDOFF"  # descriptor of the handoff socket in the new process
+HANDOFF_TIMEOUT = 10.0  # seconds the new process has to take over
+FLUSH_TIMEOUT = 5.0  # seconds clients have to take their queued data first
+FLUSH_POLL = 0.01  # seconds between checks of the outbound queues
+FDS_PER_MESSAGE = 250  # the kernel accepts at most 253 per message
+HEADER = struct.Struct("<IQ")  # descriptors, bytes of state
+READY = b"R"
+
+
+def can_hand_over():
+    """True if this platform can pass sockets to another process"""
+    return hasattr(socket, "send_fds") and hasattr(socket, "AF_UNIX")
+
+
+def spawn_successor():
+    """Start a new server process with the same command line
+
+    Returns the process and our end of its handoff socket.
+    """
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    env = dict(os.environ, **{HANDOFF_ENV: str(theirs.fileno())})
+    process = subprocess.Popen(
+        [sys.executable, *sys.argv], pass_fds=(theirs.fileno(),), env=env
+    )
+    theirs.close()
+    ours.settimeout(HANDOFF_TIMEOUT)
+    return process, ours
+
+
+def send_state(sock, state, sockets):
+    """Send sockets and the JSON-serialisable state to the new process"""
+    fds = [s.fileno() for s in sockets]
+    data = json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    sock.sendall(HEADER.pack(len(fds), len(data)))
+    for start in range(0, len(fds), FDS_PER_MESSAGE):
+        socket.send_fds(sock, [b"F"], fds[start : start + FDS_PER_MESSAGE])
+    sock.sendall(data)
+
+
+def wait_ready(sock):
+    """True once the new process reported it took over"""
+    try:
+        return sock.recv(1) == READY
+    except OSError:
+        return False
+
+
+def receive_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Handoff socket closed early")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def receive_state():
+    """(handoff socket, state, sockets) from the old process, or None
+
+    Returns None unless this process was started by a hot restart.
+    """
+    fd = os.environ.pop(HANDOFF_ENV, None)
+    if fd is None:
+        return None
+    sock = socket.socket(fileno=int(fd))
+    sock.settimeout(HANDOFF_TIMEOUT)
+    count, size = HEADER.unpack(receive_exactly(sock, HEADER.size))
+    fds = []
+    while len(fds) < count:
+        # One byte at a time, so a read never runs into the next batch
+        _, received, _, _ = socket.recv_fds(sock, 1, FDS_PER_MESSAGE)
+        if not received:
+            raise ConnectionError("Handoff socket closed early")
+        fds.extend(received)
+    state = json.loads(receive_exactly(sock, size))
+    sockets = []
+    for fd in fds:
+        received = socket.socket(fileno=fd)
+        # The async server left them non-blocking, and that flag is shared
+        received.setblocking(True)
+        sockets.append(received)
+    return sock, state, sockets
+
+
+def encode_bytes(data):
+    """bytes as a JSON string"""
+    return data.decode("latin-1")
+
+
+def decode_bytes(text):
+    return text.encode("latin-1")
+
+
+class Gate:
+    """Stops the threads of the threaded server between two reads
+
+    Threads wait for their socket with a function from watch() rather than
+    blocking in recv() or accept(), so close() can stop every one of them
+    at a point where nothing was read that is not accounted for. A stopped
+    thread parks, with whatever it holds, until the gate opens again or the
+    process is handed over.
+    """
+
+    def __init__(self):
+        self.wake, self.waker = socket.socketpair()
+        self.closed = threading.Event()
+        self.condition = threading.Condition()
+        self.watchers = 0  # threads that will park when the gate closes
+        self.parked = {}  # {key: what the parked thread held}
+        self.finished = False
+
+    def enter(self):
+        """Count one more thread that watches the gate"""
+        with self.condition:
+            self.watchers += 1
+
+    def leave(self):
+        with self.condition:
+            self.watchers -= 1
+            self.condition.notify_all()
+
+    def watch(self, sock):
+        """A function that waits until sock is readable, False once the gate closes"""
+        wake = self.wake.fileno()
+        if not hasattr(select, "poll"):
+            return lambda: self.wake not in select.select([sock, self.wake], [], [])[0]
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        poller.register(wake, select.POLLIN)
+
+        def wait():
+            for fd, _ in poller.poll():
+                if fd == wake:
+                    return False
+            return True
+
+        return wait
+
+    def park(self, key, held=None):
+        """Wait while the gate is closed; True if the process was handed over"""
+        with self.condition:
+            self.parked[key] = held
+            if len(self.parked) >= self.watchers:
+                self.condition.notify_all()
+            while self.closed.is_set() and not self.finished:
+                self.condition.wait()
+            if not self.finished:
+                del self.parked[key]
+            return self.finished
+
+    def close(self, timeout):
+        """Stop every watching thread, False if some did not stop in time"""
+        self.closed.set()
+        self.waker.send(b"x")
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while len(self.parked) < self.watchers:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def open(self):
+        """Let the parked threads carry on"""
+        with self.condition:
+            self.wake.recv(64)
+            self.closed.clear()
+            self.condition.notify_all()
+
+    def finish(self):
+        """Release the parked threads for good, their park() returns True"""
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
@@ -0,0 +1,90 @@
+"""Recent channel messages, replayed to clients when they join.
+
+Each channel keeps its last few messages as the framed, encoded bytes that
+were broadcast, in a ring buffer of configurable depth. All buffers together
+are bounded by a global byte budget; when it is exceeded the buffers of the
+channels that went longest without a message are dropped first.
+"""
+
+import sys
+import threading
+from collections import OrderedDict, deque
+
+DEFAULT_DEPTH = 50  # messages kept per channel
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024  # budget for all channels together
+ENTRY_OVERHEAD = sys.getsizeof(b"") + 8  # bytes object header plus deque slot
+BUFFER_OVERHEAD = sys.getsizeof(deque()) + 200  # empty deque plus dict entries
+
+
+class HistoryStore:
+    """Bounded ring buffers of recent messages, one per channel"""
+
+    def __init__(self, depth=DEFAULT_DEPTH, max_bytes=DEFAULT_MAX_BYTES):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.depths = {}  # {channel: depth} overrides of the default depth
+        self.buffers = OrderedDict()  # {channel: deque}, least active first
+        self.sizes = {}  # {channel: accounted bytes in its buffer}
+        self.total = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def set_depth(self, channel, depth):
+        """Keep depth messages for channel instead of the default"""
+        with self.lock:
+            self.depths[channel] = depth
+            buffer = self.buffers.get(channel)
+            if buffer is None:
+                return
+            kept = deque(buffer, maxlen=depth) if depth else deque()
+            self.buffers[channel] = kept
+            size = BUFFER_OVERHEAD + sum(
+                len(payload) + ENTRY_OVERHEAD for payload in kept
+            )
+            self.total += size - self.sizes[channel]
+            self.sizes[channel] = size
+
+    def append(self, channel, payload):
+        """Remember one framed message sent to channel"""
+        depth = self.depths.get(channel, self.depth)
+        if not depth:
+            return
+        cost = len(payload) + ENTRY_OVERHEAD
+        with self.lock:
+            buffer = self.buffers.get(channel)
+            if buffer is None:
+                buffer = self.buffers[channel] = deque(maxlen=depth)
+                self.sizes[channel] = 0
+                cost += BUFFER_OVERHEAD
+            else:
+                self.buffers.move_to_end(channel)
+            if len(buffer) == depth:
+                cost -= len(buffer[0]) + ENTRY_OVERHEAD
+            buffer.append(payload)
+            self.sizes[channel] += cost
+            self.total += cost
+            if self.total > self.max_bytes:
+                self.evict(channel)
+
+    def evict(self, active):
+        """Drop the least active buffers until the budget is met again"""
+        # Called with self.lock held
+        buffers = self.buffers
+        while self.total > self.max_bytes and len(buffers) > 1:
+            channel, _ = buffers.popitem(last=False)
+            self.total -= self.sizes.pop(channel)
+            self.evictions += 1
+        # A single channel over the whole budget loses its oldest messages
+        buffer = buffers[active]
+        while self.total > self.max_bytes and buffer:
+            cost = len(buffer.popleft()) + ENTRY_OVERHEAD
+            self.sizes[active] -= cost
+            self.total -= cost
+
+    def replay(self, channel):
+        """Everything remembered for channel as one payload, oldest first"""
+        buffer = self.buffers.get(channel)
+        if not buffer:
+            return b""
+        # join() copies the deque in one step, so appends cannot interleave
+        return b"".join(buffer)
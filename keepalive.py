@@ -0,0 +1,154 @@
+"""Keepalives and idle timeouts for client connections.
+
+A peer that vanished without closing its TCP connection is otherwise only
+noticed when a write to it fails, which may never happen for a quiet
+client. Every connection therefore has one timer. When it fires and the
+client has been silent for the ping interval, the server sends it a
+``PING <token>`` line; a client that still has not sent anything (usually
+``/pong <token>``) by the ping timeout is reaped.
+
+Timers live in a hierarchical timing wheel, so scheduling and cancelling
+one is a few dictionary and set operations whatever the number of timers,
+and a tick only touches the timers that are due. Traffic from a client
+does not touch its timer at all: it only stamps the connection with the
+current tick, and a timer that fires early is simply moved to the new
+deadline.
+"""
+
+import threading
+
+DEFAULT_INTERVAL = 60  # seconds of silence before a client is pinged
+DEFAULT_TIMEOUT = 30  # seconds a pinged client has to answer
+RESOLUTION = 1.0  # seconds per tick
+
+
+class TimerWheel:
+    """Hierarchical timing wheel keyed by arbitrary hashable objects
+
+    Level 0 has one slot per tick, and each higher level has slots that
+    each span a full turn of the level below. A timer is filed at the
+    lowest level that covers its deadline and moved down a level each time
+    its slot comes up, so it is touched at most once per level.
+    """
+
+    __slots__ = ("slots", "levels", "spans", "wheels", "deadlines", "now")
+
+    def __init__(self, slots=64, levels=4, now=0):
+        self.slots = slots
+        self.levels = levels
+        self.spans = [slots**level for level in range(levels)]  # ticks per slot
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.deadlines = {}  # {key: (deadline tick, level, slot)}
+        self.now = now  # last tick processed
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def schedule(self, key, deadline):
+        """Fire key at the deadline tick (the next tick at the earliest)"""
+        self.cancel(key)
+        self.insert(key, max(deadline, self.now + 1))
+
+    def cancel(self, key):
+        entry = self.deadlines.pop(key, None)
+        if entry is not None:
+            self.wheels[entry[1]][entry[2]].discard(key)
+
+    def insert(self, key, deadline):
+        # Past the top level, park the timer in its furthest slot; it is
+        # filed again when that slot comes up
+        delta = min(deadline - self.now, self.spans[-1] * self.slots - 1)
+        level = 0
+        while level + 1 < self.levels and delta >= self.spans[level + 1]:
+            level += 1
+        slot = (self.now + delta) // self.spans[level] % self.slots
+        self.wheels[level][slot].add(key)
+        self.deadlines[key] = (deadline, level, slot)
+
+    def advance(self, now):
+        """Move the wheel to tick now, return the keys that came due in order"""
+        expired = []
+        deadlines = self.deadlines
+        while self.now < now:
+            self.now += 1
+            tick = self.now
+            # Cascade from the top so timers can fall through several levels
+            for level in range(self.levels - 1, 0, -1):
+                span = self.spans[level]
+                if tick % span:
+                    continue
+                bucket = self.wheels[level][tick // span % self.slots]
+                if bucket:
+                    keys = list(bucket)
+                    bucket.clear()
+                    for key in keys:
+                        self.insert(key, deadlines.pop(key)[0])
+            bucket = self.wheels[0][tick % self.slots]
+            if bucket:
+                keys = list(bucket)
+                bucket.clear()
+                for key in keys:
+                    deadline = deadlines.pop(key)[0]
+                    if deadline <= tick:
+                        expired.append(key)
+                    else:
+                        self.insert(key, deadline)
+        return expired
+
+
+class KeepAlive:
+    """Decides which connections to ping and which to reap, tick by tick
+
+    Connections need a writable ``last_seen`` attribute, which the server
+    sets to ``now`` whenever the client sends something.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, timeout=DEFAULT_TIMEOUT):
+        self.interval = max(1, round(interval / RESOLUTION))  # in ticks
+        self.timeout = max(1, round(timeout / RESOLUTION))
+        self.wheel = TimerWheel()
+        self.pinged = {}  # {connection: tick of the unanswered PING}
+        self.lock = threading.Lock()  # handler threads add and discard
+        self.pings = 0
+        self.reaped = 0
+
+    @property
+    def now(self):
+        return self.wheel.now
+
+    def add(self, connection):
+        with self.lock:
+            connection.last_seen = self.wheel.now
+            self.wheel.schedule(connection, self.wheel.now + self.interval + 1)
+
+    def discard(self, connection):
+        with self.lock:
+            self.wheel.cancel(connection)
+            self.pinged.pop(connection, None)
+
+    def tick(self, now):
+        """Advance to tick now, return (connections to ping, connections to reap)"""
+        ping = []
+        reap = []
+        with self.lock:
+            wheel = self.wheel
+            pinged = self.pinged
+            for connection in wheel.advance(now):
+                last_seen = connection.last_seen
+                sent = pinged.pop(connection, None)
+                if sent is not None and last_seen < sent:
+                    reap.append(connection)
+                elif last_seen + self.interval + 1 > now:
+                    # Stamps are taken partway through a tick, the extra one
+                    # keeps a client from being pinged early
+                    wheel.schedule(connection, last_seen + self.interval + 1)
+                else:
+                    pinged[connection] = now
+                    wheel.schedule(connection, now + self.timeout)
+                    ping.append(connection)
+        self.pings += len(ping)
+        self.reaped += len(reap)
+        return ping, reap
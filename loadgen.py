@@ -0,0 +1,309 @@
+"""Headless load generator for the PyIRC server.
+
+Opens many client connections from one asyncio event loop, registers a
+nickname on each, joins channels and then sends channel messages and private
+messages at a fixed rate. Every message carries the time it was sent, so the
+generator measures delivery latency end to end, and reports throughput,
+latency percentiles and the server's memory use:
+
+    python loadgen.py --spawn --mode async --clients 2000 --rate 0.5 --duration 30
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from framing import encode_line
+from server import raise_fd_limit
+
+# Prefix of the "lg:<sender index>:<send time>" token in every generated message
+MARKER = "lg:"
+
+
+def process_rss(pid):
+    """Resident memory of pid and all its descendants in bytes, 0 if unknown"""
+    total = 0
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1]) * 1024
+                    break
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            for child in children.read().split():
+                total += process_rss(int(child))
+    except (OSError, ValueError):
+        pass
+    return total
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    index = min(len(values) - 1, int(len(values) * fraction))
+    return values[index]
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.sent = 0
+        self.delivered = 0
+        self.bytes_in = 0
+        self.latencies = []  # seconds
+        self.peak_rss = 0
+
+
+class LoadClient:
+    """One simulated user: a reader task plus a paced writer loop"""
+
+    def __init__(self, index, options, channels, stats):
+        self.index = index
+        self.options = options
+        self.nickname = f"{options.prefix}{index}"
+        self.channels = channels
+        self.stats = stats
+        self.rng = random.Random(index)
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.options.host, self.options.port
+        )
+        self.writer.write(encode_line(f"/nick {self.nickname}"))
+        for channel in self.channels:
+            self.writer.write(encode_line(f"/join {channel}"))
+        await self.writer.drain()
+
+    async def read_loop(self):
+        stats = self.stats
+        clock = time.perf_counter
+        own = str(self.index).encode()
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            stats.bytes_in += len(line)
+            if line.startswith(b"PING "):
+                self.writer.write(b"/pong " + line[5:])
+                continue
+            position = line.rfind(b" " + MARKER.encode())
+            if position >= 0:
+                sender, _, sent_at = line[position + len(MARKER) + 1 :].partition(b":")
+                if sender == own:
+                    # The server's echo of our own message or PM, not a delivery
+                    continue
+                stats.latencies.append(clock() - float(sent_at))
+                stats.delivered += 1
+
+    async def write_loop(self, deadline, total_clients):
+        options = self.options
+        interval = 1.0 / options.rate
+        # Spread the first sends so clients do not fire in lockstep
+        await asyncio.sleep(self.rng.random() * interval)
+        while time.perf_counter() < deadline:
+            if self.rng.random() < options.pm_ratio:
+                target = f"{options.prefix}{self.rng.randrange(total_clients)}"
+                command = f"/msg {target} {options.payload} {MARKER}"
+            else:
+                channel = self.rng.choice(self.channels)
+                command = f"#{channel} {options.payload} {MARKER}"
+            sent_at = time.perf_counter()
+            self.writer.write(encode_line(f"{command}{self.index}:{sent_at:.6f}"))
+            self.stats.sent += 1
+            await asyncio.sleep(interval)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def create_channels(options):
+    """Create the load channels as the admin user, returns their names"""
+    if options.channels == 0:
+        return ["general"]
+    names = [f"{options.prefix}room{i}" for i in range(options.channels)]
+    reader, writer = await asyncio.open_connection(options.host, options.port)
+    writer.write(encode_line(f"/nick {options.admin}"))
+    for name in names:
+        writer.write(encode_line(f"/createchannel {name}"))
+    writer.write(encode_line("/quit"))
+    await writer.drain()
+    while await reader.readline():
+        pass
+    writer.close()
+    return names
+
+
+async def sample_rss(options, stats):
+    while True:
+        stats.peak_rss = max(stats.peak_rss, process_rss(options.server_pid))
+        await asyncio.sleep(0.5)
+
+
+async def run(options):
+    stats = Stats()
+    channels = await create_channels(options)
+
+    clients = []
+    for index in range(options.clients):
+        joined = random.Random(index).sample(
+            channels, min(options.joins, len(channels))
+        )
+        clients.append(LoadClient(index, options, joined, stats))
+
+    # Connect in batches so the listen backlog is not overrun
+    started = time.perf_counter()
+    for start in range(0, len(clients), options.batch):
+        batch = clients[start : start + options.batch]
+        results = await asyncio.gather(
+            *(client.connect() for client in batch), return_exceptions=True
+        )
+        for client, result in zip(batch, results):
+            if isinstance(result, Exception):
+                stats.failed += 1
+                client.writer = None
+            else:
+                stats.connected += 1
+    connect_time = time.perf_counter() - started
+    live = [client for client in clients if client.writer is not None]
+
+    readers = [asyncio.ensure_future(client.read_loop()) for client in live]
+    sampler = None
+    if options.server_pid:
+        sampler = asyncio.ensure_future(sample_rss(options, stats))
+    await asyncio.sleep(options.warmup)
+    stats.latencies.clear()
+    stats.delivered = 0
+
+    deadline = time.perf_counter() + options.duration
+    await asyncio.gather(
+        *(client.write_loop(deadline, options.clients) for client in live)
+    )
+    # Let in-flight messages arrive before closing
+    await asyncio.sleep(options.drain)
+
+    for client in live:
+        client.close()
+    for task in readers:
+        task.cancel()
+    if sampler is not None:
+        sampler.cancel()
+        stats.peak_rss = max(stats.peak_rss, process_rss(options.server_pid))
+
+    latencies = sorted(stats.latencies)
+    report = {
+        "clients": options.clients,
+        "connected": stats.connected,
+        "failed": stats.failed,
+        "connect_seconds": round(connect_time, 3),
+        "sent": stats.sent,
+        "delivered": stats.delivered,
+        "send_rate": round(stats.sent / options.duration, 1),
+        "delivery_rate": round(stats.delivered / options.duration, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1e3, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1e3, 3),
+        "max_ms": round(latencies[-1] * 1e3, 3) if latencies else None,
+        "server_rss_mb": round(stats.peak_rss / 2**20, 1) if stats.peak_rss else None,
+    }
+    return report
+
+
+def spawn_server(options):
+    """Start server.py on a free port and point the load at it"""
+    if not options.port:
+        probe = socket.socket()
+        probe.bind((options.host, 0))
+        options.port = probe.getsockname()[1]
+        probe.close()
+    command = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+        "--host",
+        options.host,
+        "--port",
+        str(options.port),
+        "--mode",
+        options.mode,
+        "--workers",
+        str(options.workers),
+    ]
+    process = subprocess.Popen(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((options.host, options.port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    options.server_pid = process.pid
+    return process
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PyIRC load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--port", type=int, help="default 9999, or a free port with --spawn"
+    )
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument(
+        "--channels", type=int, default=10, help="0 to use only #general"
+    )
+    parser.add_argument("--joins", type=int, default=2, help="channels per client")
+    parser.add_argument(
+        "--rate", type=float, default=1.0, help="messages per second per client"
+    )
+    parser.add_argument(
+        "--pm-ratio", type=float, default=0.1, help="fraction of private messages"
+    )
+    parser.add_argument("--payload", default="hello from the load generator")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--drain", type=float, default=1.0)
+    parser.add_argument("--batch", type=int, default=200, help="connects at once")
+    parser.add_argument("--prefix", default="lg", help="nickname prefix")
+    parser.add_argument(
+        "--admin", default="admin", help="nickname that creates channels"
+    )
+    parser.add_argument("--server-pid", type=int, help="sample this process's RSS")
+    parser.add_argument(
+        "--spawn", action="store_true", help="start a local server.py to test"
+    )
+    parser.add_argument("--mode", choices=("thread", "async"), default="async")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    options = parser.parse_args()
+
+    raise_fd_limit()
+    server = None
+    if options.spawn:
+        server = spawn_server(options)
+    elif options.port is None:
+        options.port = 9999
+    try:
+        report = asyncio.run(run(options))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if options.json:
+        print(json.dumps(report))
+    else:
+        for key, value in report.items():
+            print(f"{key:>16}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Runtime metrics for the PyIRC server.
+
+Counters are plain integer attributes bumped inline on the hot path; a
+ticker turns them into per-second rates once a second. Everything is
+rendered in the Prometheus text format, either over HTTP (--metrics-port)
+or to an admin with /stats. Counter updates from handler threads are not
+locked, so under heavy thread contention an increment can occasionally be
+lost; that is an accepted trade-off for keeping them free.
+"""
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets, the last bucket is +Inf
+LATENCY_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+)
+FANOUT_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+RATE_COUNTERS = ("messages_in", "messages_out", "bytes_in", "bytes_out")
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "total", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the given quantile"""
+        if not self.count:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self, name, labels=""):
+        lines = []
+        cumulative = 0
+        separator = "," if labels else ""
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(
+                f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}'
+            )
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.total}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+
+class Metrics:
+    """Counters, histograms and per-second rates for one server process"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.connections_opened = 0
+        self.connections_closed = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.commands = {}  # {command: count}
+        self.command_latency = {}  # {command: Histogram of seconds}
+        self.fanout = Histogram(FANOUT_BUCKETS)
+        self.rates = dict.fromkeys(RATE_COUNTERS, 0.0)
+        self.previous = None  # (monotonic time, counter values) at the last tick
+
+    def observe_command(self, command, elapsed):
+        histogram = self.command_latency.get(command)
+        if histogram is None:
+            histogram = self.command_latency[command] = Histogram(LATENCY_BUCKETS)
+            self.commands[command] = 0
+        self.commands[command] += 1
+        histogram.observe(elapsed)
+
+    def observe_fanout(self, recipients, payload_size):
+        self.fanout.observe(recipients)
+        self.messages_out += recipients
+        self.bytes_out += recipients * payload_size
+
+    def tick(self):
+        """Refresh the per-second rates, called about once a second"""
+        now = time.monotonic()
+        values = [getattr(self, name) for name in RATE_COUNTERS]
+        if self.previous is not None:
+            then, before = self.previous
+            elapsed = now - then
+            if elapsed > 0:
+                for name, value, old in zip(RATE_COUNTERS, values, before):
+                    self.rates[name] = (value - old) / elapsed
+        self.previous = (now, values)
+
+    def start_ticker(self, interval=1.0):
+        def run():
+            while True:
+                self.tick()
+                time.sleep(interval)
+
+        threading.Thread(target=run, name="metrics-ticker", daemon=True).start()
+
+    def render(self, gauges):
+        """All metrics in the Prometheus text exposition format"""
+        lines = [
+            f"pyirc_uptime_seconds {time.time() - self.started:.0f}",
+            f"pyirc_connections_opened_total {self.connections_opened}",
+            f"pyirc_connections_closed_total {self.connections_closed}",
+            f"pyirc_messages_in_total {self.messages_in}",
+            f"pyirc_messages_out_total {self.messages_out}",
+            f"pyirc_bytes_in_total {self.bytes_in}",
+            f"pyirc_bytes_out_total {self.bytes_out}",
+        ]
+        for name, rate in self.rates.items():
+            lines.append(f"pyirc_{name}_per_second {rate:.1f}")
+        for name, value in gauges.items():
+            lines.append(f"pyirc_{name} {value}")
+        for command, count in sorted(self.commands.items()):
+            lines.append(f'pyirc_commands_total{{command="{command}"}} {count}')
+        for command, histogram in sorted(self.command_latency.items()):
+            lines.extend(
+                histogram.render("pyirc_command_seconds", f'command="{command}"')
+            )
+        lines.extend(self.fanout.render("pyirc_fanout_recipients"))
+        return "\n".join(lines) + "\n"
+
+    def summary(self, gauges):
+        """Short human readable digest for the /stats command"""
+        rates = self.rates
+        lines = [
+            f"connections: {self.connections_opened - self.connections_closed}"
+            f" open, {self.connections_opened} since start",
+            f"messages/s: {rates['messages_in']:.0f} in, {rates['messages_out']:.0f} out",
+            f"bytes/s: {rates['bytes_in']:.0f} in, {rates['bytes_out']:.0f} out",
+            f"fanout: {self.fanout.count} broadcasts,"
+            f" p50 <= {self.fanout.quantile(0.5)}, p99 <= {self.fanout.quantile(0.99)}",
+        ]
+        lines.append(", ".join(f"{name}: {value}" for name, value in gauges.items()))
+        for command, histogram in sorted(self.command_latency.items()):
+            lines.append(
+                f"{command}: {self.commands[command]} calls,"
+                f" p50 <= {histogram.quantile(0.5) * 1e3:g} ms,"
+                f" p99 <= {histogram.quantile(0.99) * 1e3:g} ms"
+            )
+        return "\n".join(lines)
+
+
+def serve_metrics(render, host, port):
+    """Serve render() as text on http://host:port/metrics from a daemon thread"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(
+        target=httpd.serve_forever, name="metrics-http", daemon=True
+    ).start()
+    return httpd
@@ -0,0 +1,317 @@
+"""Sampling CPU profiler for the running server, with collapsed-stack output.
+
+In async mode, a profiling timer (ITIMER_PROF) raises SIGPROF each time
+the process has used another interval of CPU time. The handler runs in the
+main thread, between two bytecodes, and records where it was interrupted:
+the event loop, and where it spends its time. It also looks at the other
+threads. Each thread whose CPU clock moved since it was last charged is
+charged that CPU time, at the Python stack it is at now.
+
+In thread mode the main thread sits in the accept loop, and only runs a
+signal handler once a client connects. There a sampler thread wakes every
+SAMPLER_INTERVAL of wall time and charges the threads the same way. It
+needs the GIL to look, so the other threads are stopped where they last
+released it, often in a send(), and their stacks lean towards I/O.
+
+A thread blocked in recv(), poll() or a condition wait uses no CPU, so it
+drops out of the profile. This matters in thread mode, where thousands of
+client threads are idle. Blocked threads are recognised by their stack
+(IDLE), and their CPU clocks are only read every IDLE_SAMPLES samples, so
+a sample reads a handful of clocks. What a blocked thread used since, on
+its way into or out of the wait, is charged at the wait: a profile heavy
+in Condition.wait points at threads contending for locks. Where per-thread
+CPU clocks are missing, every busy-looking thread is charged the interval
+instead.
+
+Profiles are written as collapsed stacks, one line per distinct stack. The
+frames run from the thread's entry point to the running function, which
+also has its line number. The count at the end of the line is the
+microseconds spent there:
+
+    Thread.run (threading.py);...;IRCServer.on_join (server.py:1380) 1520
+
+flamegraph.pl, speedscope and inferno read this format. ``python
+profiler.py top`` and ``python profiler.py diff`` summarise and compare
+profiles without them.
+"""
+
+import argparse
+import os
+import signal
+import sys
+import threading
+import time
+
+PROFILE_INTERVAL = 0.001  # seconds of CPU time between two samples
+# Seconds of wall time between two samples taken by a sampler thread, which
+# walks every thread's stack, however many of them are idle
+SAMPLER_INTERVAL = 0.005
+IDLE_SAMPLES = 10  # read the CPU clocks of blocked threads every this many samples
+
+# Innermost Python functions of a thread that waits for something:
+# (file name, function name)
+IDLE = {
+    ("selectors.py", "select"),  # the event loop, the writer, the metrics server
+    ("threading.py", "wait"),  # Condition and Event waits
+    ("threading.py", "__enter__"),  # a Condition's lock, held by another thread
+    ("handoff.py", "wait"),  # readers and accept loops, see Gate.watch()
+    ("socket.py", "accept"),
+}
+
+
+def thread_clock(ident):
+    """Id of the CPU clock of a thread, None where there is none"""
+    try:
+        return time.pthread_getcpuclockid(ident)
+    except (AttributeError, OSError):
+        return None
+
+
+def label(code):
+    """'Class.method (file.py)' for a code object"""
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)})"
+
+
+class Profiler:
+    """Samples the stacks of every thread in the process while running"""
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.installed = False
+        self.sampler = None  # the sampler thread, while it runs
+        self.stopping = threading.Event()  # tells the sampler thread to stop
+        self.stacks = {}  # {collapsed stack: microseconds}
+        self.samples = 0
+        self.started = None  # time.monotonic() of start(), None when stopped
+        self.labels = {}  # {code object: (label, whether it waits)}
+        # {thread ident: (CPU clock id, its time when last charged)}
+        self.clocks = {}
+        self.sampling = False  # in sample(), which another SIGPROF may interrupt
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.started is not None
+
+    def install(self):
+        """Handle SIGPROF, from the main thread; False where there is no timer"""
+        if not hasattr(signal, "setitimer"):
+            return False
+        signal.signal(signal.SIGPROF, self.sample)
+        self.installed = True
+        return True
+
+    def start(self, threaded=False):
+        """Start sampling, False if running already or not installed
+
+        With threaded, samples are taken by a sampler thread instead of on
+        SIGPROF, for processes whose main thread is mostly blocked.
+        """
+        with self.lock:
+            if self.running or not (self.installed or threaded):
+                return False
+            self.stacks = {}
+            self.samples = 0
+            self.clocks = {}
+            if thread_clock(threading.get_ident()) is not None:
+                for ident in sys._current_frames():
+                    clock = thread_clock(ident)
+                    try:
+                        self.clocks[ident] = (clock, time.clock_gettime(clock))
+                    except (OSError, TypeError):  # the thread is gone
+                        pass
+            self.started = time.monotonic()
+            if threaded:
+                self.stopping.clear()
+                self.sampler = threading.Thread(
+                    target=self.sample_loop, name="profiler", daemon=True
+                )
+                self.sampler.start()
+            else:
+                signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+            return True
+
+    def stop(self):
+        """Stop sampling, returns {collapsed stack: microseconds} or None"""
+        with self.lock:
+            if not self.running:
+                return None
+            if self.sampler is None:
+                signal.setitimer(signal.ITIMER_PROF, 0)
+            else:
+                self.stopping.set()
+                self.sampler.join()
+                self.sampler = None
+            self.started = None
+            stacks, self.stacks = self.stacks, {}
+            return stacks
+
+    def sample_loop(self):
+        while not self.stopping.wait(max(self.interval, SAMPLER_INTERVAL)):
+            self.sample(None, None)
+
+    def sample(self, signum, frame):
+        """SIGPROF handler: charge every busy thread at its current stack
+
+        The sampler thread calls it with no frame.
+        """
+        if self.started is None or self.sampling:
+            return
+        self.sampling = True
+        self.samples += 1
+        labels = self.labels
+        clocks = self.clocks
+        stacks = self.stacks
+        if frame is None:
+            weight = int(max(self.interval, SAMPLER_INTERVAL) * 1e6)
+        else:
+            weight = int(self.interval * 1e6)
+        frames = sys._current_frames()
+        main = threading.get_ident()
+        if frame is None:
+            # The sampler thread, which is not charged
+            del frames[main]
+        else:
+            # The main thread is running this handler, it was interrupted at frame
+            frames[main] = frame
+        for ident, frame in frames.items():
+            if frame is None:
+                continue
+            code = frame.f_code
+            known = labels.get(code)
+            if known is None:
+                idle = (os.path.basename(code.co_filename), code.co_name) in IDLE
+                known = labels[code] = (label(code), idle)
+            leaf, idle = known
+            if idle and (not clocks or self.samples % IDLE_SAMPLES):
+                continue
+            if clocks:
+                clock, before = clocks.get(ident, (None, 0.0))
+                if clock is None:
+                    # Started after the profile, all its CPU time counts
+                    clock = thread_clock(ident)
+                    if clock is None:  # gone already
+                        continue
+                try:
+                    cpu = time.clock_gettime(clock)
+                except OSError:  # gone, the ident may come back for a new thread
+                    clocks.pop(ident, None)
+                    continue
+                weight = int((cpu - before) * 1e6)
+                if weight <= 0:
+                    continue
+                clocks[ident] = (clock, cpu)
+            names = [f"{leaf[:-1]}:{frame.f_lineno})"]
+            frame = frame.f_back
+            while frame is not None:
+                code = frame.f_code
+                known = labels.get(code)
+                if known is None:
+                    known = labels[code] = (label(code), False)
+                names.append(known[0])
+                frame = frame.f_back
+            stack = ";".join(reversed(names))
+            stacks[stack] = stacks.get(stack, 0) + weight
+        if len(clocks) > len(frames):
+            for ident in clocks.keys() - frames.keys():
+                del clocks[ident]
+        if main in clocks:
+            # This handler's own time is not charged to the main thread
+            clock = clocks[main][0]
+            clocks[main] = (clock, time.clock_gettime(clock))
+        self.sampling = False
+
+
+def write_collapsed(stacks, path):
+    """Write {collapsed stack: count} to path, heaviest stacks first"""
+    with open(path, "w", encoding="utf-8") as output:
+        for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+            output.write(f"{stack} {count}\n")
+
+
+def read_collapsed(path):
+    """{collapsed stack: count} from a file of collapsed stacks"""
+    stacks = {}
+    with open(path, encoding="utf-8") as lines:
+        for line in lines:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if stack:
+                stacks[stack] = stacks.get(stack, 0) + int(count)
+    return stacks
+
+
+def function(frame):
+    """A frame label without its line number"""
+    name, _, location = frame.rpartition(" (")
+    return f"{name} ({location.split(':')[0].rstrip(')')})"
+
+
+def functions(stacks):
+    """{function: (self count, total count)} over collapsed stacks"""
+    totals = {}
+    for stack, count in stacks.items():
+        frames = [function(frame) for frame in stack.split(";")]
+        for name in set(frames):
+            own, total = totals.get(name, (0, 0))
+            totals[name] = (own, total + count)
+        own, total = totals[frames[-1]]
+        totals[frames[-1]] = (own + count, total)
+    return totals
+
+
+def top(stacks, limit=20):
+    """Lines describing the functions with the most self time"""
+    everything = sum(stacks.values()) or 1
+    rows = sorted(functions(stacks).items(), key=lambda item: -item[1][0])
+    lines = [f"{'self %':>7} {'total %':>8}  function"]
+    for name, (own, total) in rows[:limit]:
+        lines.append(f"{own / everything:7.1%} {total / everything:8.1%}  {name}")
+    return lines
+
+
+def diff(old, new, limit=20):
+    """Lines describing the functions whose share of self time changed most"""
+    old_total = sum(old.values()) or 1
+    new_total = sum(new.values()) or 1
+    before = functions(old)
+    after = functions(new)
+    changes = []
+    for name in before.keys() | after.keys():
+        old_share = before.get(name, (0, 0))[0] / old_total
+        new_share = after.get(name, (0, 0))[0] / new_total
+        changes.append((new_share - old_share, old_share, new_share, name))
+    changes.sort(key=lambda change: -abs(change[0]))
+    lines = [
+        f"total {old_total / 1e6:.3f}s -> {new_total / 1e6:.3f}s"
+        f" ({new_total / old_total - 1:+.1%})",
+        f"{'old %':>7} {'new %':>7} {'change':>7}  function",
+    ]
+    for change, old_share, new_share, name in changes[:limit]:
+        if change:
+            lines.append(f"{old_share:7.1%} {new_share:7.1%} {change:+7.1%}  {name}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise collapsed-stack profiles")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary = subparsers.add_parser("top", help="functions with the most self time")
+    summary.add_argument("profile")
+    summary.add_argument("--limit", type=int, default=20)
+    compare = subparsers.add_parser("diff", help="compare two profiles")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--limit", type=int, default=20)
+    options = parser.parse_args()
+
+    if options.command == "top":
+        lines = top(read_collapsed(options.profile), options.limit)
+    else:
+        old = read_collapsed(options.old)
+        lines = diff(old, read_collapsed(options.new), options.limit)
+    print("\n".join(lines))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Token-bucket flood control.
+
+Every connection gets a bucket per command class (channel messages, queries
+like /list, membership changes, ...). A limit on the ``channel`` class, off
+by default, also gives every channel a bucket shared by all its senders. A
+bucket holds up to ``burst`` tokens and refills at
+``rate`` tokens per second; each line costs one token. Buckets are refilled
+lazily when they are used, so the accounting is a few float operations per
+line and idle clients cost nothing.
+
+Updates from concurrent handler threads are not locked, so a channel bucket
+can occasionally miscount a token under contention; the limits are meant to
+stop floods, not to be exact.
+"""
+
+import argparse
+
+CHANNEL = "channel"  # limits key of the per-channel bucket
+SWEEP_INTERVAL = 60.0  # seconds between sweeps of the channel buckets
+
+# {class: (tokens per second, burst)}
+DEFAULT_LIMITS = {
+    "message": (10.0, 20),  # channel and private messages from one client
+    "membership": (5.0, 10),  # /nick, /join, /leave, /createchannel
+    "query": (2.0, 5),  # /list, /users, /search, /help, /stats
+    "command": (5.0, 10),  # anything else, e.g. plugin commands
+    # CHANNEL, messages to one channel from all its members, is not limited
+    # unless asked for, e.g. (100.0, 200)
+}
+
+POLICY_DELAY = "delay"
+POLICY_DROP = "drop"
+POLICIES = (POLICY_DELAY, POLICY_DROP)
+
+
+def parse_limit(text):
+    """argparse type for CLASS=RATE[:BURST], a rate of 0 lifts the limit"""
+    try:
+        name, _, spec = text.partition("=")
+        rate, _, burst = spec.partition(":")
+        rate = float(rate)
+        burst = int(burst) if burst else max(1, int(rate))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected CLASS=RATE[:BURST], got {text!r}")
+    if not name:
+        raise argparse.ArgumentTypeError(f"expected CLASS=RATE[:BURST], got {text!r}")
+    return name, rate, burst
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """Spend one token, return 0 or the seconds until one is available"""
+        tokens = self.tokens + (now - self.updated) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.updated = now
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return 0
+        self.tokens = tokens
+        return (1 - tokens) / self.rate
+
+
+class RateLimiter:
+    """Token buckets per connection and command class, and per channel"""
+
+    def __init__(self, limits=None, policy=POLICY_DELAY):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown rate limit policy {policy!r}")
+        # Classes with a rate of 0 or no entry are not limited
+        self.limits = {
+            name: limit
+            for name, limit in (DEFAULT_LIMITS if limits is None else limits).items()
+            if limit[0] > 0
+        }
+        self.policy = policy
+        self.connections = {}  # {connection: {class: TokenBucket}}
+        self.channels = {}  # {channel: TokenBucket}, of recently busy channels
+        self.swept = None  # when the channel buckets were last swept
+        self.delayed = 0
+        self.dropped = 0
+
+    def check(self, connection, rate_class, now):
+        """Charge one line of rate_class, return the seconds to hold it back"""
+        limit = self.limits.get(rate_class)
+        if limit is None:
+            return 0
+        buckets = self.connections.get(connection)
+        if buckets is None:
+            buckets = self.connections[connection] = {}
+        bucket = buckets.get(rate_class)
+        if bucket is None:
+            bucket = buckets[rate_class] = TokenBucket(*limit, now)
+        return bucket.take(now)
+
+    def check_channel(self, channel, now):
+        """Charge one message to channel, return True if it may be sent"""
+        limit = self.limits.get(CHANNEL)
+        if limit is None:
+            return True
+        if self.swept is None:
+            self.swept = now
+        elif now - self.swept > SWEEP_INTERVAL:
+            self.sweep(now)
+        bucket = self.channels.get(channel)
+        if bucket is None:
+            bucket = self.channels[channel] = TokenBucket(*limit, now)
+        if bucket.take(now):
+            self.dropped += 1
+            return False
+        return True
+
+    def sweep(self, now):
+        """Drop the channel buckets that have filled up again
+
+        A full bucket is what a new one would be, so channels only have one
+        while they are busy.
+        """
+        self.swept = now
+        for channel, bucket in list(self.channels.items()):
+            if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.burst:
+                self.channels.pop(channel, None)
+
+    def forget(self, connection):
+        self.connections.pop(connection, None)
@@ -0,0 +1,317 @@
+"""Full-text search over channel messages.
+
+An inverted index maps each word of a channel to the sorted keys of the
+messages that contain it, in compact arrays of machine integers. A key is
+the message's position in the durable message log when there is one, so
+the text itself stays on disk; without a log the index packs the encoded
+messages into one buffer in memory and the key is their number.
+
+Messages are indexed as they are broadcast. A query intersects the posting
+lists of its words newest first and stops after a fixed number of hits, so
+it costs a few binary searches per hit however long the channel's history
+is; words that are common but rarely appear together give up after a
+bounded number of candidates.
+
+Memory is bounded by a byte budget. Messages go to a live generation, and
+once it holds half the budget it becomes the previous generation and the
+ones before it are dropped, so the index covers the most recent messages
+that fit. With a log, a query that finds too few matches there goes on
+through the channel's older messages in the log, a bounded number of them.
+
+When the server starts on an existing log, a background thread indexes the
+old messages while new ones keep arriving. It follows the channels' back
+pointers from their last messages and stops once the budget is full, so it
+costs the same however long the log has grown.
+"""
+
+import bisect
+import heapq
+import re
+import string
+import sys
+import threading
+import time
+from array import array
+
+from storage import RECORD_MESSAGE
+
+SEARCH_LIMIT = 20  # most recent matches returned by one query
+MAX_TERMS = 8  # words per query
+MAX_SCAN = 20000  # candidates one query may check, bounds its worst case
+SEARCH_MAX_BYTES = 16 * 1024 * 1024  # budget of the index
+LOG_SCAN = 2000  # older logged messages one query may read past the index
+WORD = re.compile(r"\w+")
+# Bytes that are not part of an ASCII word, turned into spaces
+SEPARATORS = bytes(
+    byte if chr(byte) in string.ascii_letters + string.digits + "_" else 32
+    for byte in range(256)
+)
+KEY_COST = 8  # a key in a posting list and the message's offset, roughly
+TERM_OVERHEAD = sys.getsizeof(array("I")) + sys.getsizeof("word") + 100
+
+
+def message_terms(payload):
+    """Words of a framed channel message, skipping its timestamp and channel"""
+    # "[12:00:00] [channel] nick: text", index from the nick onwards
+    if payload.startswith(b"["):
+        payload = payload.split(b"] ", 2)[-1]
+    if payload.isascii():
+        # Same words as the pattern finds, a few times faster
+        return set(payload.lower().translate(SEPARATORS).split())
+    text = payload.decode("utf-8", "replace").lower()
+    return {word.encode() for word in WORD.findall(text)}
+
+
+def query_terms(query):
+    """Distinct words of a query, as message_terms() finds them"""
+    words = dict.fromkeys(WORD.findall(query.lower()))
+    return [word.encode() for word in words][:MAX_TERMS]
+
+
+class InvertedIndex:
+    """Posting lists of one contiguous range of message keys"""
+
+    __slots__ = ("typecode", "channels", "firsts", "documents", "size")
+
+    def __init__(self, typecode):
+        self.typecode = typecode
+        self.channels = {}  # {channel: {term: array of ascending keys}}
+        self.firsts = {}  # {channel: key of its first message here}
+        self.documents = 0
+        self.size = 0  # accounted bytes
+
+    def add(self, channel, terms, key):
+        """Index one message"""
+        postings = self.channels.get(channel)
+        if postings is None:
+            postings = self.channels[channel] = {}
+            self.firsts[channel] = key
+        created = 0
+        for term in terms:
+            keys = postings.get(term)
+            if keys is None:
+                keys = postings[term] = array(self.typecode)
+                created += 1
+            keys.append(key)
+        self.documents += 1
+        self.size += KEY_COST * len(terms) + TERM_OVERHEAD * created
+
+    def search(self, channel, terms, limit, skip=None):
+        """Up to limit keys of messages holding every term, newest first"""
+        postings = self.channels.get(channel)
+        if postings is None:
+            return []
+        lists = []
+        for term in terms:
+            keys = postings.get(term)
+            if not keys:
+                return []
+            lists.append(keys)
+        lists.sort(key=len)
+        rarest, others = lists[0], lists[1:]
+        found = []
+        for index in range(len(rarest) - 1, max(len(rarest) - MAX_SCAN, 0) - 1, -1):
+            key = rarest[index]
+            if skip is not None and skip(key):
+                continue
+            for keys in others:
+                position = bisect.bisect_left(keys, key)
+                if position == len(keys) or keys[position] != key:
+                    break
+            else:
+                found.append(key)
+                if len(found) == limit:
+                    break
+        return found
+
+
+class Generation(InvertedIndex):
+    """Messages kept in memory, back to back, and their index"""
+
+    __slots__ = ("texts", "offsets")
+
+    def __init__(self):
+        super().__init__("I")
+        self.texts = bytearray()
+        self.offsets = array("Q")  # where each message starts in texts, by key
+
+    def store(self, channel, terms, payload):
+        key = len(self.offsets)
+        self.offsets.append(len(self.texts))
+        self.texts += payload
+        self.add(channel, terms, key)
+        self.size += len(payload) + KEY_COST
+
+    def fetch(self, key):
+        start = self.offsets[key]
+        if key + 1 < len(self.offsets):
+            return bytes(self.texts[start : self.offsets[key + 1]])
+        return bytes(self.texts[start:])
+
+
+class SearchIndex:
+    """Indexes channel messages as they are sent and answers /search
+
+    max_bytes bounds the index, 0 turns it off.
+    """
+
+    def __init__(self, message_log=None, max_bytes=SEARCH_MAX_BYTES):
+        self.message_log = message_log
+        self.max_bytes = max_bytes
+        self.generations = [self.generation()]  # newest first, live at 0
+        self.rotations = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @property
+    def documents(self):
+        return sum(generation.documents for generation in self.generations)
+
+    @property
+    def size(self):
+        """Accounted bytes of the index"""
+        return sum(generation.size for generation in self.generations)
+
+    def generation(self):
+        if self.message_log is None:
+            return Generation()
+        return InvertedIndex("Q")
+
+    def trim(self, generations):
+        """generations without the oldest ones that leave no room for live
+
+        Live gets half the budget and the newest generation before it is
+        always kept.
+        """
+        kept = generations[:2]
+        room = self.max_bytes - self.max_bytes // 2
+        room -= sum(generation.size for generation in kept[1:])
+        for generation in generations[2:]:
+            room -= generation.size
+            if room < 0:
+                break
+            kept.append(generation)
+        return kept
+
+    def add(self, channel, payload, position=None):
+        """Index one framed message, position is its place in the message log"""
+        if not self.enabled:
+            return
+        terms = message_terms(payload)
+        with self.lock:
+            live = self.generations[0]
+            if self.message_log is None:
+                live.store(channel, terms, payload)
+            else:
+                live.add(channel, terms, position)
+            if live.size > self.max_bytes // 2:
+                # A new list, so a query holding the old one is unaffected
+                self.generations = self.trim([self.generation()] + self.generations)
+                self.rotations += 1
+
+    def start_backfill(self):
+        """Index the messages already in the message log from a background thread"""
+        if not self.enabled or self.message_log is None or not self.message_log.end:
+            return
+        # The last message of every channel, taken before any new one is logged
+        lasts = [
+            (1 - last, channel)
+            for channel, (_, last) in self.message_log.channels.items()
+            if last
+        ]
+        threading.Thread(
+            target=self.run_backfill,
+            args=(lasts,),
+            name="search-backfill",
+            daemon=True,
+        ).start()
+
+    def run_backfill(self, lasts):
+        """Index the newest logged messages that fit in the budget
+
+        lasts holds (-position, channel) of every channel's last message.
+        Their back pointers are followed newest first across channels, so
+        only the messages kept are read however long the log has grown.
+        """
+        heapq.heapify(lasts)
+        room = self.max_bytes - self.max_bytes // 2
+        index = InvertedIndex("Q")
+        while lasts and index.size <= room:
+            position, channel = lasts[0]
+            _, body, previous = self.message_log.read(-position)
+            index.add(channel, message_terms(body), -position)
+            if previous:
+                heapq.heapreplace(lasts, (1 - previous, channel))
+            else:
+                heapq.heappop(lasts)
+            if not index.documents % 1000:
+                # Give the threads serving clients a turn
+                time.sleep(0)
+        # Keys were added newest first
+        for channel, postings in index.channels.items():
+            for keys in postings.values():
+                keys.reverse()
+            if postings:
+                index.firsts[channel] = min(keys[0] for keys in postings.values())
+        with self.lock:
+            # Dropped again if live has filled up meanwhile
+            self.generations = self.trim(self.generations + [index])
+
+    def search(self, channel, query, limit=SEARCH_LIMIT):
+        """Matching messages as framed payloads, oldest first"""
+        terms = query_terms(query)
+        if not terms:
+            return []
+        skip = None
+        if self.message_log is not None:
+            committed = self.message_log.committed
+
+            def skip(key):
+                # Still waiting for the log writer, cannot be read back yet
+                return key >= committed
+
+        with self.lock:
+            # A generation dropped meanwhile can still be read
+            generations = self.generations
+        found = []
+        oldest = None  # key of the channel's oldest indexed message
+        for generation in generations:
+            if len(found) == limit:
+                break
+            for key in generation.search(channel, terms, limit - len(found), skip):
+                if self.message_log is not None:
+                    found.append(self.message_log.read(key)[1])
+                else:
+                    found.append(generation.fetch(key))
+            oldest = generation.firsts.get(channel, oldest)
+        if len(found) < limit and self.message_log is not None:
+            found += self.scan_log(channel, set(terms), oldest, limit - len(found))
+        found.reverse()
+        return found
+
+    def scan_log(self, channel, terms, oldest, limit):
+        """Matches among the channel's logged messages older than the index"""
+        message_log = self.message_log
+        if oldest is None:
+            # None of the channel's messages are indexed, start at its last
+            entry = message_log.channels.get(channel)
+            position = entry[1] if entry is not None else 0
+        else:
+            position = message_log.read(oldest)[2]
+        committed = message_log.committed
+        found = []
+        for _ in range(LOG_SCAN):
+            if not position or position - 1 >= committed:
+                break
+            record = message_log.read(position - 1)
+            if record is None:
+                break
+            _, body, position = record
+            if terms <= message_terms(body):
+                found.append(body)
+                if len(found) == limit:
+                    break
+        return found
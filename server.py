@@ -1,403 +1,1925 @@
+import argparse
+import asyncio
+import logging
+import os
+import signal
 import socket
 import threading
 import time
-from datetime import datetime
-import traceback
+
+from commands import ADMIN_NICKNAME, CommandRegistry
+from compact import (
+    COMPRESS_THRESHOLD,
+    COMPRESSION_ZLIB,
+    PROTOCOL_COMPACT,
+    PROTOCOLS,
+    CompactPayload,
+    CompactSession,
+    DEFLATE_RESET,
+    JOINED,
+    LEFT,
+    REGISTERED,
+    RENAMED,
+    CompressionStats,
+    Deflater,
+    Interner,
+    frame,
+    message_frame,
+    state_frame,
+    text_frames,
+)
+from ratelimit import DEFAULT_LIMITS, POLICIES, POLICY_DELAY, RateLimiter, parse_limit
+from connection import (
+    CLOSE_TIMEOUT,
+    DEFAULT_HIGH_WATER,
+    OVERFLOW_DISCONNECT,
+    OVERFLOW_POLICIES,
+    StreamConnection,
+    ThreadedConnection,
+    TLSConnection,
+)
+from framing import RECV_SIZE, LineFramer, encode_line
+from handoff import (
+    FLUSH_POLL,
+    FLUSH_TIMEOUT,
+    HANDOFF_TIMEOUT,
+    READY,
+    Gate,
+    can_hand_over,
+    decode_bytes,
+    encode_bytes,
+    receive_state,
+    send_state,
+    spawn_successor,
+    wait_ready,
+)
+from directory import ChannelDirectory, Sessions, cached
+from history import DEFAULT_DEPTH, DEFAULT_MAX_BYTES, HistoryStore
+from keepalive import DEFAULT_INTERVAL, DEFAULT_TIMEOUT, RESOLUTION, KeepAlive
+from metrics import Metrics, serve_metrics
+from profiler import PROFILE_INTERVAL, Profiler, write_collapsed
+from search import SEARCH_MAX_BYTES, SearchIndex
+from storage import MessageLog
+from tls import HANDSHAKE_TIMEOUT, server_context
+from traffic import TrafficRecorder
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+log = logging.getLogger("pyirc")
+
+WELCOME_MESSAGE = (
+    "Welcome to PyIRC Server! Please set your nickname with /nick <nickname>"
+)
+
+# Constant replies, encoded once
+NICKNAME_FIRST = encode_line(
+    "ERROR: You must set a nickname first with /nick <nickname>"
+)
+NO_CHANNELS = encode_line("ERROR: You haven't joined any channels")
+GOODBYE = encode_line("Goodbye!")
+RATE_LIMITED = encode_line("ERROR: Rate limit exceeded, slow down")
+SHUTTING_DOWN = encode_line("SYSTEM: Server shutting down, please reconnect")
+RESTARTING = encode_line("SYSTEM: Server restarting, please reconnect")
+
+PART_NAMES_PER_LINE = 50  # nicknames in one combined departure notice
+DRAIN_SECONDS = 5.0  # disconnecting every client on SIGTERM is spread over this
+DRAIN_INTERVAL = 0.1  # seconds between two batches of a drain, at least
+
+commands = CommandRegistry()
+
+
+class IRCProtocol(asyncio.Protocol):
+    """Event loop counterpart of IRCServer.handle_client, one per connection"""
+
+    __slots__ = ("server", "connection", "framer", "held", "adopted")
+
+    def __init__(self, server, adopted=None):
+        self.server = server
+        self.connection = None
+        self.framer = LineFramer()
+        self.held = None  # lines held back by a rate limit, reading paused meanwhile
+        self.adopted = adopted  # what the previous process knew of the client
+
+    def connection_made(self, transport):
+        server = self.server
+        server.metrics.connections_opened += 1
+        set_nodelay(transport.get_extra_info("socket"))
+        self.connection = StreamConnection(
+            transport,
+            high_water=server.high_water,
+            overflow=server.overflow,
+        )
+        server.connections[self.connection] = self
+        if server.keepalive is not None:
+            server.keepalive.add(self.connection)
+        tls_object = transport.get_extra_info("ssl_object")
+        if tls_object is not None:
+            server.count_handshake(tls_object)
+        if self.adopted is not None:
+            self.framer, self.held = server.restore_client(
+                self.connection, self.adopted
+            )
+            self.adopted = None
+            # Read once every adopted client is registered, see serve_async()
+            transport.pause_reading()
+        elif server.restarting:
+            # A handshake that finished after the handoff started
+            server.send_payload(self.connection, RESTARTING)
+            self.connection.close()
+        else:
+            if server.recorder is not None:
+                server.recorder.opened(self.connection)
+            server.reply(self.connection, WELCOME_MESSAGE)
+
+    def data_received(self, data):
+        server = self.server
+        server.metrics.bytes_in += len(data)
+        self.connection.last_seen = server.keepalive_now()
+        if server.recorder is not None:
+            server.recorder.received(self.connection, data)
+        self.run(self.framer.feed(data))
+
+    def run(self, lines):
+        connection = self.connection
+        try:
+            position, delay = self.server.handle_lines(connection, lines)
+        except Exception:
+            log.exception(
+                "Error handling client %s", self.server.clients.get(connection)
+            )
+            connection.close()
+            return
+        if position < 0:
+            connection.close()
+        elif delay:
+            # Stop reading until the bucket refills, the client's further
+            # lines wait in the kernel buffers meanwhile
+            if self.held is None:
+                connection.transport.pause_reading()
+            self.held = lines[position:]
+            connection.loop.call_later(delay, self.resume)
+        elif self.held is not None:
+            self.held = None
+            connection.transport.resume_reading()
+
+    def resume(self):
+        # A hot restart leaves held lines alone, for the next process
+        if self.held and not self.connection.closed and not self.server.restarting:
+            self.run(self.held)
+
+    def connection_lost(self, exc):
+        server = self.server
+        server.metrics.connections_closed += 1
+        server.connections.pop(self.connection, None)
+        if server.recorder is not None:
+            server.recorder.closed(self.connection)
+        server.remove_client(self.connection)
+
+
+_clock = (None, "")  # (second, formatted) of the last timestamp() call
+
+
+def timestamp():
+    """Current local time as HH:MM:SS, formatted at most once per second"""
+    global _clock
+    now = int(time.time())
+    second, formatted = _clock
+    if second != now:
+        formatted = time.strftime("%H:%M:%S", time.localtime(now))
+        _clock = (now, formatted)
+    return formatted
+
+
+def raise_fd_limit():
+    """Raise the soft open-files limit to the hard limit so we can hold many sockets"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def set_nodelay(client_socket):
+    """Disable Nagle's algorithm, connections coalesce their writes already
+
+    asyncio only does this for sockets created with IPPROTO_TCP explicitly.
+    Without it, a TLS session ticket followed by the welcome line waits for
+    the client's delayed ACK.
+    """
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def bind_listener(host, port):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    return listener
+
+
+def terminate(signum, frame):
+    raise SystemExit(0)
+
+
+def run_server(server, mode):
+    """Serve until interrupted or terminated, then close the server cleanly
+
+    SIGTERM drains the server first and a second one exits at once. SIGHUP
+    hands the server over to a new process (see handoff.py). SIGUSR1 starts
+    and stops the profiler.
+    """
+    signal.signal(signal.SIGTERM, server.request_drain)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, server.request_restart)
+        signal.signal(signal.SIGUSR1, server.request_profile)
+    server.profiler.install()
+    try:
+        if mode == "async":
+            server.start_async()
+        else:
+            server.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
 
 
 class IRCServer:
-    def __init__(self, host="127.0.0.1", port=9999):
+    # Slash commands, shared by every server in the process; plugins add theirs here
+    commands = commands
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=9999,
+        high_water=DEFAULT_HIGH_WATER,
+        overflow=OVERFLOW_DISCONNECT,
+        server_socket=None,
+        metrics_port=None,
+        history_depth=DEFAULT_DEPTH,
+        history_bytes=DEFAULT_MAX_BYTES,
+        log_dir=None,
+        search_bytes=SEARCH_MAX_BYTES,
+        rate_limits=None,
+        rate_limit_policy=POLICY_DELAY,
+        ping_interval=DEFAULT_INTERVAL,
+        ping_timeout=DEFAULT_TIMEOUT,
+        tls_context=None,
+        tls_port=None,
+        tls_socket=None,
+        compress_threshold=COMPRESS_THRESHOLD,
+        drain_seconds=DRAIN_SECONDS,
+        profile_dir=".",
+        profile_interval=PROFILE_INTERVAL,
+        record_traffic=None,
+    ):
         self.host = host
         self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((self.host, self.port))
+        self.high_water = high_water  # max bytes queued per client
+        self.overflow = overflow  # what to do with a client past high_water
+        if server_socket is None:
+            server_socket = bind_listener(self.host, self.port)
+        else:
+            # Already bound, e.g. inherited from a parent process
+            self.host, self.port = server_socket.getsockname()[:2]
+        self.server_socket = server_socket
+        # Second listener for TLS clients, when the server has a certificate
+        self.tls_context = tls_context
+        if tls_context is not None and tls_socket is None:
+            tls_socket = bind_listener(self.host, tls_port)
+        self.tls_socket = tls_socket
+        self.tls_handshakes = 0
+        self.tls_resumed = 0
+        # {connection: its IRCProtocol in async mode, None in thread mode},
+        # registered or not
+        self.connections = {}
         self.clients = {}  # {client_socket: nickname}
-        self.channels = {"general": set()}  # {channel_name: set of nicknames}
-        self.client_channels = {}  # {nickname: set of channels}
+        # {nickname: Session}, with the session's connection and channel ids
+        self.nicknames = Sessions()
+        # {channel_name: Members, the session ids of its members}
+        self.channels = ChannelDirectory(self.nicknames)
+        self.channels.create("general")
+        # Ids of channel names and nicknames in the compact protocol
+        self.channel_ids = Interner()
+        self.nick_ids = Interner()
+        # Smallest flush compressed for clients that asked, None refuses them
+        self.compress_threshold = compress_threshold
+        self.compression = CompressionStats()
+        # Held by every change to clients, nicknames and channels, never while
+        # sending. Readers (broadcasts, /list, /users) do not take it; they
+        # iterate over a snapshot copied in one C-level call, which other
+        # threads cannot interleave with.
         self.lock = threading.Lock()
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port  # serve /metrics over HTTP if set
+        self.history = HistoryStore(history_depth, history_bytes)
+        # None applies the default limits, {} disables rate limiting
+        self.limiter = RateLimiter(rate_limits, rate_limit_policy)
+        # Pings quiet clients and reaps dead ones, None when ping_interval is 0
+        self.keepalive = None
+        if ping_interval:
+            self.keepalive = KeepAlive(ping_interval, ping_timeout)
+        self.message_log = None  # durable MessageLog when log_dir is set
+        if log_dir is not None:
+            self.message_log = MessageLog(log_dir)
+            for channel, (depth, _) in self.message_log.open().items():
+                self.channels.create(channel)
+                if depth is not None:
+                    self.history.set_depth(channel, depth)
+        self.search_index = SearchIndex(self.message_log, search_bytes)
+        self.search_index.start_backfill()
+        # Graceful shutdown and hot restart
+        self.drain_seconds = drain_seconds
+        self.draining = False
+        self.restarting = False
+        self.accept_gate = Gate()  # stops the accept threads of thread mode
+        self.read_gate = Gate()  # and the client threads
+        self.adopted = []  # [(client state, socket)] handed over by a hot restart
+        self.predecessor = None  # handoff socket of the process being replaced
+        self.loop = None  # the event loop in async mode
+        self.servers = []  # its listening asyncio servers
+        self.stopped = None  # future that ends serve_async()
+        self.task = None  # the drain or restart running on the loop
+        self.metrics_server = None
+        # Profiles on demand, written to profile_dir
+        self.profiler = Profiler(profile_interval)
+        self.profile_dir = profile_dir
+        # Appends what clients send to a trace file, for replaying it later
+        self.recorder = None
+        if record_traffic is not None:
+            self.recorder = TrafficRecorder(record_traffic)
+
+    def start_metrics(self):
+        self.metrics.start_ticker()
+        self.open_metrics()
+
+    def open_metrics(self):
+        if self.metrics_port is not None:
+            self.metrics_server = serve_metrics(
+                self.metrics_text, self.host, self.metrics_port
+            )
+            log.info("Metrics on http://%s:%s/metrics", self.host, self.metrics_port)
+
+    def gauges(self):
+        """Point-in-time values computed when metrics are read"""
+        connections = list(self.clients)
+        queued = [connection.queued() for connection in connections]
+        return {
+            "connections_open": self.metrics.connections_opened
+            - self.metrics.connections_closed,
+            "clients_registered": len(connections),
+            "channels": len(self.channels),
+            "channel_memberships": sum(
+                len(members) for members in list(self.channels.values())
+            ),
+            "outbound_queued_bytes": sum(queued),
+            "outbound_queued_bytes_max": max(queued, default=0),
+            "outbound_dropped_messages": sum(
+                getattr(connection, "dropped", 0) for connection in connections
+            ),
+            "history_bytes": self.history.total,
+            "history_evicted_channels": self.history.evictions,
+            "search_documents": self.search_index.documents,
+            "search_bytes": self.search_index.size,
+            "rate_limited_delays": self.limiter.delayed,
+            "rate_limited_drops": self.limiter.dropped,
+            "keepalive_timers": len(self.keepalive.wheel) if self.keepalive else 0,
+            "keepalive_pings": self.keepalive.pings if self.keepalive else 0,
+            "keepalive_reaped": self.keepalive.reaped if self.keepalive else 0,
+            "tls_handshakes": self.tls_handshakes,
+            "tls_resumed_sessions": self.tls_resumed,
+            "compact_connections": sum(
+                getattr(connection, "compact", None) is not None
+                for connection in connections
+            ),
+            "compressed_connections": sum(
+                getattr(connection, "deflate", None) is not None
+                for connection in connections
+            ),
+            "compression_bytes_in": self.compression.raw,
+            "compression_bytes_out": self.compression.compressed,
+            "compression_ratio": round(self.compression.ratio, 2),
+            "compression_skipped_bytes": self.compression.passed,
+            "compression_cpu_seconds": round(self.compression.seconds, 6),
+        }
+
+    def metrics_text(self):
+        return self.metrics.render(self.gauges())
+
+    def keepalive_now(self):
+        """Current keepalive tick, stamped on connections as they send data"""
+        return 0 if self.keepalive is None else self.keepalive.wheel.now
+
+    def check_keepalive(self):
+        """Ping the clients that went quiet and reap those that never answered"""
+        if self.restarting:
+            return
+        keepalive = self.keepalive
+        ping, reap = keepalive.tick(keepalive.now + 1)
+        if ping:
+            payload = encode_line(f"PING {keepalive.now}")
+            for connection in ping:
+                try:
+                    self.send_payload(connection, payload)
+                except OSError:
+                    reap.append(connection)
+        if reap:
+            log.info("Reaping %d connections that stopped answering", len(reap))
+            self.remove_clients(reap)
+
+    def start_keepalive(self):
+        if self.keepalive is None:
+            return
+
+        def run():
+            while True:
+                time.sleep(RESOLUTION)
+                try:
+                    self.check_keepalive()
+                except Exception:
+                    log.exception("Keepalive check failed")
+
+        threading.Thread(target=run, name="keepalive", daemon=True).start()
 
     def start(self):
-        self.server_socket.listen(5)
-        print(f"[*] Server started on {self.host}:{self.port}")
+        self.server_socket.listen(socket.SOMAXCONN)
+        self.start_metrics()
+        self.start_keepalive()
+        log.info("Server started on %s:%s", self.host, self.port)
+        if self.tls_socket is not None:
+            self.tls_socket.listen(socket.SOMAXCONN)
+            threading.Thread(
+                target=self.accept_loop,
+                args=(self.tls_socket, True),
+                name="tls-accept",
+                daemon=True,
+            ).start()
+            log.info("TLS on %s:%s", self.host, self.tls_socket.getsockname()[1])
+        self.take_over()
+        # Register every adopted client before any of them is read from
+        readers = []
+        for client, client_socket in self.adopted:
+            self.metrics.connections_opened += 1
+            connection = self.open_connection(ThreadedConnection, client_socket)
+            readers.append((connection, *self.restore_client(connection, client)))
+        self.adopted = []
+        for reader in readers:
+            threading.Thread(
+                target=self.handle_client, args=reader, daemon=True
+            ).start()
+        self.accept_loop(self.server_socket)
 
+    def accept_loop(self, listener, tls=False):
+        """Accept clients on listener and start a thread for each
+
+        Returns once a drain or a hot restart is done with the process.
+        """
+        gate = self.accept_gate
+        gate.enter()
+        wait = gate.watch(listener)
         while True:
-            client_socket, address = self.server_socket.accept()
-            print(f"[+] New connection from {address}")
-            client_handler = threading.Thread(
-                target=self.handle_client, args=(client_socket,)
-            )
+            if not wait():
+                if gate.park(listener):
+                    return
+                continue
+            client_socket, address = listener.accept()
+            log.info("New connection from %s%s", address, " (TLS)" if tls else "")
+            self.metrics.connections_opened += 1
+            set_nodelay(client_socket)
+            if tls:
+                # The client's own thread runs the handshake, so a slow one
+                # never holds up accepting the next client
+                target, client = self.handle_tls_client, client_socket
+            else:
+                target = self.handle_client
+                client = self.open_connection(ThreadedConnection, client_socket)
+            client_handler = threading.Thread(target=target, args=(client,))
             client_handler.daemon = True
             client_handler.start()
 
-    ## DEBUG : this not working
+    def open_connection(self, kind, client_socket):
+        connection = kind(
+            client_socket, high_water=self.high_water, overflow=self.overflow
+        )
+        self.connections[connection] = None
+        if connection.transferable():
+            self.read_gate.enter()
+        if self.keepalive is not None:
+            self.keepalive.add(connection)
+        return connection
+
+    def handle_tls_client(self, client_socket):
+        """Complete the TLS handshake, then serve the client like any other"""
+        client_socket.settimeout(HANDSHAKE_TIMEOUT)
+        try:
+            tls_socket = self.tls_context.wrap_socket(client_socket, server_side=True)
+        except OSError as e:
+            log.info("TLS handshake failed: %s", e)
+            self.metrics.connections_closed += 1
+            client_socket.close()
+            return
+        self.count_handshake(tls_socket)
+        connection = self.open_connection(TLSConnection, tls_socket)
+        if self.restarting:
+            # Finished its handshake after the handoff started
+            self.send_payload(connection, RESTARTING)
+            self.metrics.connections_closed += 1
+            self.connections.pop(connection, None)
+            connection.close()
+            return
+        self.handle_client(connection)
+
+    def count_handshake(self, tls_object):
+        self.tls_handshakes += 1
+        if tls_object.session_reused:
+            self.tls_resumed += 1
+
+    def start_async(self):
+        """Serve every client from a single asyncio event loop instead of threads"""
+        raise_fd_limit()
+        asyncio.run(self.serve_async())
+
+    async def serve_async(self):
+        loop = self.loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        self.start_metrics()
+        if self.keepalive is not None:
+            # Ticks on the loop, sends to StreamConnections are not thread-safe
+            def tick():
+                loop.call_later(RESOLUTION, tick)
+                self.check_keepalive()
+
+            loop.call_later(RESOLUTION, tick)
+        log.info("Server started on %s:%s (asyncio)", self.host, self.port)
+
+        await self.listen_async()
+        if self.tls_socket is not None:
+            log.info("TLS on %s:%s", self.host, self.tls_socket.getsockname()[1])
+        self.take_over()
+        protocols = []
+        for client, client_socket in self.adopted:
+            _, protocol = await loop.connect_accepted_socket(
+                lambda client=client: IRCProtocol(self, client), client_socket
+            )
+            protocols.append(protocol)
+        self.adopted = []
+        for protocol in protocols:
+            protocol.run(protocol.held)
+        try:
+            await self.stopped
+        finally:
+            for server in self.servers:
+                server.close()
+
+    async def listen_async(self):
+        """Serve the listening sockets from the event loop"""
+        loop = self.loop
+        self.server_socket.listen(socket.SOMAXCONN)
+        self.server_socket.setblocking(False)
+        self.servers = [
+            await loop.create_server(lambda: IRCProtocol(self), sock=self.server_socket)
+        ]
+        if self.tls_socket is not None:
+            # The event loop drives handshakes like any other I/O
+            self.tls_socket.listen(socket.SOMAXCONN)
+            self.tls_socket.setblocking(False)
+            self.servers.append(
+                await loop.create_server(
+                    lambda: IRCProtocol(self),
+                    sock=self.tls_socket,
+                    ssl=self.tls_context,
+                    ssl_handshake_timeout=HANDSHAKE_TIMEOUT,
+                )
+            )
+
     def broadcast_to_channel(self, channel, message, exclude_socket=None):
         """Send message to all clients in a channel except the excluded socket"""
 
-        print(f"[DEBUG] Broadcasting to channel: {channel}, Message: {message}")
+        log.debug("Broadcasting to channel: %s, Message: %s", channel, message)
         if channel not in self.channels:
-            print(f"[DEBUG] Channel {channel} not found.")
+            log.debug("Channel %s not found.", channel)
             return
 
-        print(f"[DEBUG] Broadcasting to channel: {channel}, Message: {message}")
-        for nick in self.channels[channel]:
-            print(f"[DEBUG] Trying to send to {nick}")
-            client_socket = None
-            for sock, nickname in self.clients.items():
-                if nickname == nick:
-                    client_socket = sock
+        self.broadcast_payload(channel, encode_line(message), exclude_socket)
 
-                    break
-            if client_socket and (
-                exclude_socket is None or client_socket != exclude_socket
-            ):
+    def broadcast_payload(
+        self, channel, payload, exclude_socket=None, record=False, fields=None
+    ):
+        """Fan an already framed and encoded message out to a channel
+
+        Every recipient's queue shares the same bytes object, so the message
+        is encoded once no matter how large the channel is. With record, the
+        message is also kept in the channel history replayed on /join.
+        fields are the (Unix time, nickname, text) of a channel message,
+        sent to compact clients as a MESSAGE frame rather than as text.
+        """
+        if record:
+            self.history.append(channel, payload)
+            position = None
+            if self.message_log is not None:
+                position = self.message_log.append_message(channel, payload)
+            self.search_index.add(channel, payload, position)
+        members = self.channels.get(channel)
+        if not members:
+            return
+
+        failed = []
+        sent = 0
+        compact = None  # what compact clients get instead, encoded on first use
+        # Iterate over a snapshot, other handlers may join or leave meanwhile
+        connections = list(map(self.nicknames.connections.__getitem__, members.ids))
+        for client_socket in connections:
+            if client_socket is not None and client_socket is not exclude_socket:
                 try:
-                    client_socket.send(message.encode("utf-8"))
-                    print(f"[DEBUG] Sent message to {nick}")
+                    session = client_socket.compact
+                    if session is None:
+                        client_socket.send(payload)
+                    else:
+                        if compact is None:
+                            compact = self.compact_payload(channel, payload, fields)
+                            compact_frame = compact.frame
+                            channel_id = compact.channel_id
+                            nick_id = compact.nick_id
+                            nickname = compact.nickname
+                        # Ids are only recorded once their bindings are
+                        # queued, see CompactSession.send
+                        if (
+                            channel_id in session.channels
+                            and session.nicks.get(nick_id) == nickname
+                        ):
+                            client_socket.send(compact_frame)
+                        else:
+                            session.send(client_socket, compact)
+                    sent += 1
                 except Exception as e:
-                    print(f"[ERROR] Failed to send message to {nick}: {e}")
-                    self.remove_client(client_socket)
+                    log.warning(
+                        "Failed to send message to %s: %s",
+                        self.clients.get(client_socket),
+                        e,
+                    )
+                    failed.append(client_socket)
+        self.metrics.observe_fanout(sent, len(payload))
+
+        # Removing announces the departure to other channels, so do it after
+        # we are done iterating over this one
+        if failed:
+            self.remove_clients(failed)
+
+    def compact_payload(self, channel, payload, fields=None):
+        """The compact protocol's version of a broadcast payload"""
+        if fields is None:
+            return CompactPayload(text_frames(payload))
+        when, nickname, text = fields
+        channel_id = self.channel_ids(channel)
+        nick_id = self.nick_ids(nickname)
+        return CompactPayload(
+            message_frame(when, channel_id, nick_id, text),
+            channel,
+            channel_id,
+            nickname,
+            nick_id,
+        )
+
+    def reply(self, client_socket, message):
+        """Send one framed message to a single client"""
+        self.send_payload(client_socket, encode_line(message))
+
+    def confirm(self, client_socket, change, name, message):
+        """Reply with a change to the client's own state
+
+        Compact clients get it as a STATE frame, which also names what changed.
+        """
+        if client_socket.compact is None:
+            return self.reply(client_socket, message)
+        payload = state_frame(change, name, message)
+        client_socket.send(payload)
+        metrics = self.metrics
+        metrics.messages_out += 1
+        metrics.bytes_out += len(payload)
+
+    def send_payload(self, client_socket, payload):
+        """Send an already framed and encoded message to a single client"""
+        if client_socket.compact is not None:
+            payload = text_frames(payload)
+        client_socket.send(payload)
+        metrics = self.metrics
+        metrics.messages_out += 1
+        metrics.bytes_out += len(payload)
+
+    def deliver_private(self, nickname, message):
+        """Send message to the client holding nickname, returns False if there is none"""
+        session = self.nicknames.get(nickname)
+        if session is None or session.connection is None:
+            return False
+        self.reply(session.connection, message)
+        return True
 
     def remove_client(self, client_socket):
         """Remove a client from all structures when they disconnect"""
-        if client_socket in self.clients:
-            nickname = self.clients[client_socket]
-
-            # Remove from channels
-            if nickname in self.client_channels:
-                for channel in list(self.client_channels[nickname]):
-                    if channel in self.channels:
-                        self.channels[channel].discard(nickname)
-                        # Notify others that user has left
-                        self.broadcast_to_channel(
-                            channel,
-                            f"SYSTEM: {nickname} has left {channel}",
-                            client_socket,
-                        )
-
-            # Clean up data structures
-            if nickname in self.client_channels:
-                del self.client_channels[nickname]
-            del self.clients[client_socket]
+        return self.remove_clients((client_socket,))
+
+    def remove_clients(self, client_sockets):
+        """Remove several clients at once and close their connections
 
+        The departures are announced with one broadcast per channel, however
+        many of its members left. Returns the nicknames that were removed.
+        """
+        departed = {}  # {channel: [nicknames]}
+        removed = []
+        with self.lock:
+            for client_socket in client_sockets:
+                nickname = self.clients.pop(client_socket, None)
+                if nickname is None:
+                    continue
+                session = self.nicknames.get(nickname)
+                if session is None or session.connection is not client_socket:
+                    continue
+                removed.append(nickname)
+                # Remove from channels
+                for channel in self.channels.part_all(session):
+                    departed.setdefault(channel, []).append(nickname)
+                self.nicknames.remove(session)
+                self.nick_ids.release(nickname)
+        for client_socket in client_sockets:
+            self.limiter.forget(client_socket)
+            if self.keepalive is not None:
+                self.keepalive.discard(client_socket)
+
+        # Notify others that the users have left
+        for channel, nicknames in departed.items():
+            if channel not in self.channels:
+                continue
+            lines = []
+            for start in range(0, len(nicknames), PART_NAMES_PER_LINE):
+                names = nicknames[start : start + PART_NAMES_PER_LINE]
+                if len(names) == 1:
+                    lines.append(f"SYSTEM: {names[0]} has left {channel}")
+                else:
+                    lines.append(f"SYSTEM: {', '.join(names)} have left {channel}")
+            self.broadcast_payload(channel, encode_line("\n".join(lines)))
+
+        for client_socket in client_sockets:
             try:
                 client_socket.close()
             except:
                 pass
+        return removed
+
+    def register_client(self, client_socket, nickname):
+        """Claim nickname for a new client and add it to #general
+
+        Returns False if another client already holds the nickname.
+        """
+        with self.lock:
+            if nickname in self.nicknames:
+                return False
+            self.clients[client_socket] = nickname
+            session = self.nicknames.add(nickname, client_socket)
+            self.channels.join(session, "general")
+        return True
+
+    def rename_client(self, client_socket, old_nick, new_nick):
+        """Move a registered client to a new nickname, keeping its channels
+
+        Returns False if another client already holds the new nickname.
+        """
+        with self.lock:
+            if new_nick in self.nicknames or client_socket not in self.clients:
+                return False
+            self.clients[client_socket] = new_nick
+            session = self.nicknames[old_nick]
+            self.channels.rename(session, new_nick)
+            self.nick_ids.release(old_nick)
+
+        self.confirm(
+            client_socket, RENAMED, new_nick, f"You are now known as {new_nick}"
+        )
+        self.announce_rename(session, old_nick)
+        return True
+
+    def announce_rename(self, session, old_nick):
+        """Tell everyone sharing a channel with session about its new nickname
+
+        Each of them is told once, however many channels they share.
+        """
+        by_id = self.channels.by_id
+        ids = set()
+        for channel_id in session.channels:
+            ids.update(by_id[channel_id].ids)
+        ids.discard(session.id)
+        if not ids:
+            return
+        payload = encode_line(f"SYSTEM: {old_nick} is now known as {session.nickname}")
+        failed = []
+        for client_socket in map(self.nicknames.connections.__getitem__, ids):
+            if client_socket is None:  # gone meanwhile, or on another worker
+                continue
+            try:
+                self.send_payload(client_socket, payload)
+            except Exception as e:
+                log.warning(
+                    "Failed to send message to %s: %s",
+                    self.clients.get(client_socket),
+                    e,
+                )
+                failed.append(client_socket)
+        if failed:
+            self.remove_clients(failed)
+
+    def join_channel(self, nickname, channel):
+        """Add nickname to an existing channel, returns False if there is no such channel"""
+        with self.lock:
+            session = self.nicknames.get(nickname)
+            return session is not None and self.channels.join(session, channel)
+
+    def part_channel(self, nickname, channel):
+        """Remove nickname from a channel, returns False if it was not a member"""
+        with self.lock:
+            session = self.nicknames.get(nickname)
+            return session is not None and self.channels.part(session, channel)
+
+    def create_channel(self, channel, history_depth=None):
+        """Create an empty channel, returns False if it already exists"""
+        with self.lock:
+            if channel in self.channels:
+                return False
+            self.channels.create(channel)
+        if history_depth is not None:
+            self.history.set_depth(channel, history_depth)
+        if self.message_log is not None:
+            self.message_log.append_create(channel, history_depth)
+        return True
+
+    def backlog(self, channel):
+        """Recent messages of channel as one payload, from memory or the log"""
+        payload = self.history.replay(channel)
+        if not payload and self.message_log is not None:
+            # Evicted from memory or not seen since a restart
+            depth = self.history.depths.get(channel, self.history.depth)
+            payload = b"".join(self.message_log.recent(channel, depth))
+        return payload
+
+    def close(self):
+        """Commit and snapshot the message log before exiting
+
+        A profile still running is written out, and the traffic recorded.
+        """
+        if self.message_log is not None:
+            self.message_log.close()
+        self.stop_profile()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    # Graceful drain and hot restart
+
+    def request_drain(self, signum=None, frame=None):
+        """SIGTERM: drain in the background, or exit at once if already stopping"""
+        if self.draining or self.restarting:
+            raise SystemExit(0)
+        self.draining = True
+        self.in_background("drain", self.drain, self.drain_async)
+
+    def request_restart(self, signum=None, frame=None):
+        """SIGHUP: hand the server over to a new process in the background"""
+        if self.draining or self.restarting:
+            return
+        if not can_hand_over():
+            log.warning("Hot restart needs Unix sockets with SCM_RIGHTS")
+            return
+        self.restarting = True
+        self.in_background("restart", self.restart, self.restart_async)
+
+    def in_background(self, name, function, coroutine):
+        """Run function on a thread, or coroutine on the event loop in async mode"""
+        if self.loop is None:
+            threading.Thread(target=function, name=name, daemon=True).start()
+            return
+        loop = self.loop
+
+        def start():
+            # The loop only keeps weak references to its tasks
+            self.task = loop.create_task(coroutine())
+
+        loop.call_soon_threadsafe(start)
+
+    def drain(self):
+        """Stop accepting clients, then disconnect them all over drain_seconds"""
+        self.accept_gate.close(HANDOFF_TIMEOUT)
+        # Refuse new connections, so clients go elsewhere instead of waiting
+        self.server_socket.close()
+        if self.tls_socket is not None:
+            self.tls_socket.close()
+        connections = list(self.connections)
+        for pause, batch in self.drain_batches(connections):
+            time.sleep(pause)
+            self.disconnect(batch, SHUTTING_DOWN)
+        deadline = time.monotonic() + CLOSE_TIMEOUT
+        for connection in connections:
+            connection.wait_closed(max(0.0, deadline - time.monotonic()))
+        # The accept loops return, and with them start()
+        self.accept_gate.finish()
+
+    async def drain_async(self):
+        """drain() for the event loop"""
+        for server in self.servers:
+            server.close()
+        connections = list(self.connections)
+        for pause, batch in self.drain_batches(connections):
+            await asyncio.sleep(pause)
+            self.disconnect(batch, SHUTTING_DOWN)
+        deadline = self.loop.time() + CLOSE_TIMEOUT
+        while connections and self.loop.time() < deadline:
+            await asyncio.sleep(FLUSH_POLL)
+            connections = [c for c in connections if c in self.connections]
+        self.stopped.set_result(None)
+
+    def drain_batches(self, connections):
+        """(pause, batch) steps that disconnect everyone over drain_seconds
+
+        Spreading the disconnects out spreads the reconnects out too, so
+        the servers that take the clients over are not hit all at once.
+        """
+        log.info(
+            "Draining %d connections over %ss", len(connections), self.drain_seconds
+        )
+        count = max(1, min(len(connections), int(self.drain_seconds / DRAIN_INTERVAL)))
+        size = max(1, -(-len(connections) // count))
+        batches = [
+            connections[start : start + size]
+            for start in range(0, len(connections), size)
+        ]
+        pause = self.drain_seconds / max(1, len(batches))
+        return [(pause if index else 0, batch) for index, batch in enumerate(batches)]
+
+    def disconnect(self, connections, notice):
+        """Tell connections why they are being closed, then close them"""
+        for connection in connections:
+            try:
+                self.send_payload(connection, notice)
+            except OSError:
+                pass
+        self.remove_clients(connections)
+
+    def restart(self):
+        """Hand the listeners and every client over to a new process"""
+        started = time.perf_counter()
+        self.accept_gate.close(HANDOFF_TIMEOUT)
+        if self.read_gate.close(HANDOFF_TIMEOUT):
+            parked = self.read_gate.parked
+            # Only TLS clients are still being served, until told to reconnect
+            self.disconnect(
+                [c for c in list(self.connections) if c not in parked], RESTARTING
+            )
+            connections = list(parked)
+            while True:
+                stuck = self.wait_flushed(connections)
+                if not stuck:
+                    break
+                # Announcing their departure queues more for the others
+                self.remove_clients(stuck)
+                connections = [c for c in connections if not c.closed]
+            sockets = [connection.socket for connection in connections]
+            if self.hand_over(connections, sockets, parked.get, started):
+                os._exit(0)
+        else:
+            log.warning("Hot restart abandoned, client threads did not stop")
+        self.restarting = False
+        self.read_gate.open()
+        self.accept_gate.open()
+
+    async def restart_async(self):
+        """restart() for the event loop"""
+        started = time.perf_counter()
+        # Closing an asyncio server closes its socket, keep copies to pass on
+        self.server_socket = self.server_socket.dup()
+        if self.tls_socket is not None:
+            self.tls_socket = self.tls_socket.dup()
+        for server in self.servers:
+            server.close()
+        protocols = self.connections
+        connections = []
+        others = []
+        for connection in list(protocols):
+            if connection.transferable():
+                connection.transport.pause_reading()
+                connections.append(connection)
+            else:
+                others.append(connection)
+        self.disconnect(others, RESTARTING)
+        while True:
+            stuck = await self.wait_flushed_async(connections)
+            if not stuck:
+                break
+            self.remove_clients(stuck)
+            connections = [c for c in connections if not c.closed]
+
+        def reader(connection):
+            protocol = protocols[connection]
+            return protocol.framer, protocol.held or []
+
+        sockets = [c.transport.get_extra_info("socket") for c in connections]
+        if await self.loop.run_in_executor(
+            None, self.hand_over, connections, sockets, reader, started
+        ):
+            os._exit(0)
+        await self.listen_async()
+        self.restarting = False
+        for connection in connections:
+            protocol = protocols.get(connection)
+            if protocol is None or connection.closed:
+                continue
+            if protocol.held is None:
+                connection.transport.resume_reading()
+            else:
+                protocol.resume()
+
+    def wait_flushed(self, connections):
+        """The connections still holding queued data after FLUSH_TIMEOUT"""
+        deadline = time.monotonic() + FLUSH_TIMEOUT
+        while True:
+            pending = [c for c in connections if not c.flushed()]
+            if not pending or time.monotonic() > deadline:
+                return pending
+            time.sleep(FLUSH_POLL)
+
+    async def wait_flushed_async(self, connections):
+        deadline = time.monotonic() + FLUSH_TIMEOUT
+        while True:
+            pending = [c for c in connections if not c.flushed()]
+            if not pending or time.monotonic() > deadline:
+                return pending
+            await asyncio.sleep(FLUSH_POLL)
+
+    def hand_over(self, connections, sockets, reader, started):
+        """Pass the listeners and connections to a new process
 
-    def handle_client(self, client_socket):
-        """Handle client connection, registration and commands"""
-        # Initial registration
-        client_socket.send(
-            "Welcome to PyIRC Server! Please set your nickname with /nick <nickname>".encode(
-                "utf-8"
+        reader(connection) is the (LineFramer, unhandled lines) of its
+        client. Returns True once the new process has taken over, or False
+        with this server able to carry on.
+        """
+        listeners = [self.server_socket]
+        if self.tls_socket is not None:
+            listeners.append(self.tls_socket)
+        state = self.handoff_state(connections, reader, len(listeners))
+        # The new process opens these itself
+        if self.message_log is not None:
+            self.message_log.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.stop_profile()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+        process = None
+        ready = False
+        try:
+            process, handoff_socket = spawn_successor()
+            with handoff_socket:
+                send_state(handoff_socket, state, listeners + sockets)
+                ready = wait_ready(handoff_socket)
+        except OSError as e:
+            log.error("Hot restart failed: %s", e)
+        if ready:
+            log.info(
+                "Handed %d clients over to process %s in %.0f ms",
+                len(connections),
+                process.pid,
+                (time.perf_counter() - started) * 1000,
             )
+            return True
+        if process is not None:
+            log.error("Hot restart failed, process %s did not take over", process.pid)
+            process.kill()
+            process.wait()
+        if self.message_log is not None:
+            self.message_log.open()
+        if self.recorder is not None:
+            self.recorder.open()
+        self.open_metrics()
+        return False
+
+    def handoff_state(self, connections, reader, listeners):
+        """What a new process needs to carry on with connections, as JSON"""
+        clients = []
+        with self.lock:
+            for connection in connections:
+                framer, lines = reader(connection)
+                partial, discarding, pending = framer.getstate()
+                nickname = self.clients.get(connection)
+                joined = []
+                if nickname is not None:
+                    joined = self.channels.joined(self.nicknames[nickname])
+                session = connection.compact
+                clients.append(
+                    {
+                        "nickname": nickname,
+                        "channels": joined,
+                        "framer": [partial, discarding, encode_bytes(pending)],
+                        "lines": list(lines),
+                        "compact": (
+                            None
+                            if session is None
+                            else [list(session.channels), list(session.nicks.items())]
+                        ),
+                        "deflate": connection.deflate is not None,
+                    }
+                )
+            channels = list(self.channels)
+        return {
+            "listeners": listeners,
+            "channels": channels,
+            "depths": self.history.depths,
+            "history": {
+                channel: [encode_bytes(payload) for payload in buffer]
+                for channel, buffer in self.history.buffers.items()
+            },
+            "channel_ids": self.channel_ids.ids,
+            "nick_ids": self.nick_ids.ids,
+            "clients": clients,
+        }
+
+    def adopt(self, state, sockets, predecessor):
+        """Take over the channels and clients handed over by a hot restart
+
+        The clients are served once the server starts.
+        """
+        for channel in state["channels"]:
+            if channel not in self.channels:
+                self.channels.create(channel)
+        for channel, depth in state["depths"].items():
+            self.history.set_depth(channel, depth)
+        for channel, payloads in state["history"].items():
+            for payload in payloads:
+                payload = decode_bytes(payload)
+                self.history.append(channel, payload)
+                if self.message_log is None:
+                    # With a log, the backfill indexes it all
+                    self.search_index.add(channel, payload)
+        self.channel_ids = Interner(state["channel_ids"])
+        self.nick_ids = Interner(state["nick_ids"])
+        self.adopted = list(zip(state["clients"], sockets))
+        self.predecessor = predecessor
+
+    def take_over(self):
+        """Let the process being replaced exit, once this one is listening"""
+        if self.predecessor is not None:
+            self.predecessor.sendall(READY)
+            self.predecessor.close()
+            self.predecessor = None
+            log.info("Took over %d clients from a hot restart", len(self.adopted))
+
+    def restore_client(self, connection, client):
+        """Register an adopted connection as the previous process had it
+
+        Returns its LineFramer and the lines it had not handled yet.
+        """
+        nickname = client["nickname"]
+        if nickname is not None:
+            with self.lock:
+                self.clients[connection] = nickname
+                session = self.nicknames.add(nickname, connection)
+                for channel in client["channels"]:
+                    self.channels.join(session, channel)
+        if client["compact"]:
+            channel_ids, nick_ids = client["compact"]
+            connection.compact = CompactSession()
+            connection.compact.channels.update(channel_ids)
+            # A process from before nickname ids were reused sent bare ids,
+            # which are then bound again as they come up
+            connection.compact.nicks.update(
+                entry for entry in nick_ids if isinstance(entry, list)
+            )
+        if client["deflate"]:
+            # This process compresses with a new stream
+            connection.send(frame(DEFLATE_RESET, b""))
+            if self.compress_threshold is not None:
+                connection.compress(Deflater(self.compression, self.compress_threshold))
+        partial, discarding, pending = client["framer"]
+        framer = LineFramer()
+        framer.setstate((partial, discarding, decode_bytes(pending)))
+        return framer, client["lines"]
+
+    # Profiling
+
+    def request_profile(self, signum=None, frame=None):
+        """SIGUSR1: start the profiler, or stop it and write the profile"""
+        # Off the signal handler, which may have interrupted the profiler
+        threading.Thread(target=self.toggle_profile, name="profile").start()
+
+    def toggle_profile(self):
+        if self.stop_profile() is None:
+            self.start_profile()
+
+    def start_profile(self):
+        """Start the profiler, False if it is running already"""
+        # In thread mode the main thread is blocked accepting clients, and
+        # would rarely get to run a SIGPROF handler
+        if not self.profiler.start(threaded=self.loop is None):
+            return False
+        log.info("Profiling started")
+        return True
+
+    def stop_profile(self):
+        """Stop the profiler and write its profile, returns its path or None"""
+        started = self.profiler.started
+        stacks = self.profiler.stop()
+        if stacks is None:
+            return None
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = time.strftime("profile-%Y%m%d-%H%M%S") + f"-{os.getpid()}.txt"
+        path = os.path.join(self.profile_dir, name)
+        write_collapsed(stacks, path)
+        log.info(
+            "Profile of %.1fs (%d samples) written to %s",
+            time.monotonic() - started,
+            self.profiler.samples,
+            path,
         )
+        return path
+
+    def handle_client(self, client_socket, framer=None, lines=()):
+        """Handle client connection, registration and commands
 
-        nickname = None
+        A connection adopted in a hot restart comes with the framer and the
+        unhandled lines the previous process left off with.
+        """
+        recorder = self.recorder
+        if framer is None:
+            # Initial registration
+            if recorder is not None:
+                recorder.opened(client_socket)
+            self.reply(client_socket, WELCOME_MESSAGE)
+            framer = LineFramer()
+        gate = self.read_gate
+        wait = None  # TLS connections are never handed over, nor stopped
+        if client_socket.transferable():
+            wait = gate.watch(client_socket.socket)
 
+        position = 0
         while True:
             try:
-                message = client_socket.recv(1024).decode("utf-8").strip()
-                print(
-                    f'Received message "{message}" from {client_socket.getpeername()}'
-                )  # DEBUG
+                if position == len(lines):
+                    if wait is not None and not wait():
+                        # Stopped between two reads for a hot restart
+                        if gate.park(client_socket, (framer, [])):
+                            return
+                        continue
+                    data = client_socket.recv(RECV_SIZE)
+                    if not data:
+                        break
 
-                if not message:
+                    self.metrics.bytes_in += len(data)
+                    client_socket.last_seen = self.keepalive_now()
+                    if recorder is not None:
+                        recorder.received(client_socket, data)
+                    lines = framer.feed(data)
+                    position = 0
+                position, delay = self.handle_lines(client_socket, lines, position)
+                if position < 0:
                     break
+                if delay:
+                    # Held back by a rate limit; not reading meanwhile pushes
+                    # back on the client through TCP
+                    if wait is None:
+                        time.sleep(delay)
+                    elif gate.closed.wait(delay) and gate.park(
+                        client_socket, (framer, lines[position:])
+                    ):
+                        return
 
-                # Handle commands
-                if message.startswith("/"):
-                    parts = message.split(" ", 1)
-                    command = parts[0].lower()
-                    args = parts[1] if len(parts) > 1 else ""
-
-                    if command == "/nick":
-                        if not args:
-                            client_socket.send(
-                                "ERROR: Nickname cannot be empty".encode("utf-8")
-                            )
-                            continue
-
-                        # Check if nickname is already taken
-                        nickname = args
-                        self.clients[client_socket] = nickname
-                        self.client_channels[nickname] = set()
-
-                        client_socket.send(
-                            f"Welcome {nickname}! You have been added to #general".encode(
-                                "utf-8"
-                            )
-                        )
-
-                        # Add to general channel by default
-                        self.channels["general"].add(nickname)
-                        self.client_channels[nickname].add("general")
-                        print(f'User "{nickname}" has joined the server')
-
-                        print(self.channels["general"])
-                        print(self.client_channels[nickname])
-
-                        self.broadcast_to_channel(
-                            "general",
-                            f"SYSTEM: {nickname} has joined #general",
-                            client_socket,
-                        )
-
-                    elif command == "/join":
-                        if not nickname:
-                            client_socket.send(
-                                "ERROR: You must set a nickname first with /nick <nickname>".encode(
-                                    "utf-8"
-                                )
-                            )
-                            continue
-
-                        if not args:
-                            client_socket.send(
-                                "ERROR: Please specify a channel to join".encode(
-                                    "utf-8"
-                                )
-                            )
-                            continue
-
-                        # Check if channel exists
-                        if args not in self.channels:
-                            client_socket.send(
-                                f"ERROR: Channel {args} does not exist. Only the admin can create new channels.".encode(
-                                    "utf-8"
-                                )
-                            )
-                            continue
-
-                        # Join the channel
-                        self.channels[args].add(nickname)
-                        self.client_channels[nickname].add(args)
-
-                        client_socket.send(f"You have joined {args}".encode("utf-8"))
-                        self.broadcast_to_channel(
-                            args,
-                            f"SYSTEM: {nickname} has joined {args}",
-                            client_socket,
-                        )
-
-                    elif command == "/leave" or command == "/part":
-                        if not nickname:
-                            client_socket.send(
-                                "ERROR: You must set a nickname first".encode("utf-8")
-                            )
-                            continue
-
-                        if not args:
-                            client_socket.send(
-                                "ERROR: Please specify a channel to leave".encode(
-                                    "utf-8"
-                                )
-                            )
-                            continue
-
-                        if args in self.channels and nickname in self.channels[args]:
-                            self.channels[args].remove(nickname)
-                            self.client_channels[nickname].remove(args)
-
-                            client_socket.send(f"You have left {args}".encode("utf-8"))
-                            self.broadcast_to_channel(
-                                args, f"SYSTEM: {nickname} has left {args}"
-                            )
-                        else:
-                            client_socket.send(
-                                f"ERROR: You are not in channel {args}".encode("utf-8")
-                            )
-
-                    elif command == "/list":
-                        channel_list = ", ".join(
-                            [
-                                f"#{channel} ({len(members)} users)"
-                                for channel, members in self.channels.items()
-                            ]
-                        )
-                        client_socket.send(
-                            f"Available channels: {channel_list}".encode("utf-8")
-                        )
-
-                    elif command == "/users":
-                        if not args:
-                            client_socket.send(
-                                "ERROR: Please specify a channel".encode("utf-8")
-                            )
-                            continue
-
-                        if args in self.channels:
-                            users = ", ".join(sorted(self.channels[args]))
-                            client_socket.send(
-                                f"Users in {args}: {users}".encode("utf-8")
-                            )
-                        else:
-                            client_socket.send(
-                                f"ERROR: Channel {args} does not exist".encode("utf-8")
-                            )
-
-                    elif command == "/createchannel":
-                        if not nickname:
-                            client_socket.send(
-                                "ERROR: You must set a nickname first".encode("utf-8")
-                            )
-                            continue
-
-                        if nickname != "admin":
-                            client_socket.send(
-                                "ERROR: Only admin can create channels".encode("utf-8")
-                            )
-                            continue
-
-                        if not args:
-                            client_socket.send(
-                                "ERROR: Please specify a channel name to create".encode(
-                                    "utf-8"
-                                )
-                            )
-                            continue
-
-                        if args in self.channels:
-                            client_socket.send(
-                                f"ERROR: Channel {args} already exists".encode("utf-8")
-                            )
-                        else:
-                            self.channels[args] = set()
-                            client_socket.send(
-                                f"Channel {args} created. Use /join {args} to join it.".encode(
-                                    "utf-8"
-                                )
-                            )
-
-                    elif command == "/msg":
-                        if not nickname:
-                            client_socket.send(
-                                "ERROR: You must set a nickname first".encode("utf-8")
-                            )
-                            continue
-
-                        parts = args.split(" ", 1)
-                        if len(parts) < 2:
-                            client_socket.send(
-                                "ERROR: Usage: /msg <nickname> <message>".encode(
-                                    "utf-8"
-                                )
-                            )
-                            continue
-
-                        target_nick, pm_message = parts
-
-                        target_socket = None
-                        for sock, nick in self.clients.items():
-                            if nick == target_nick:
-                                target_socket = sock
-                                break
-
-                        if target_socket:
-                            timestamp = datetime.now().strftime("%H:%M:%S")
-                            target_socket.send(
-                                f"[{timestamp}] PRIVATE from {nickname}: {pm_message}".encode(
-                                    "utf-8"
-                                )
-                            )
-                            client_socket.send(
-                                f"[{timestamp}] PRIVATE to {target_nick}: {pm_message}".encode(
-                                    "utf-8"
-                                )
-                            )
-                        else:
-                            client_socket.send(
-                                f"ERROR: User {target_nick} not found".encode("utf-8")
-                            )
-
-                    elif command == "/help":
-                        help_text = (
-                            "Available commands:\n"
-                            "/nick <nickname> - Set your nickname\n"
-                            "/join <channel> - Join a channel\n"
-                            "/leave <channel> - Leave a channel\n"
-                            "/list - List available channels\n"
-                            "/users <channel> - List users in a channel\n"
-                            "/msg <nickname> <message> - Send a private message\n"
-                            "/help - Show this help message\n"
-                            "/quit - Disconnect from the server\n"
-                        )
-                        if nickname == "admin":
-                            help_text += "/createchannel <channel> - Create a new channel (admin only)\n"
-
-                        client_socket.send(help_text.encode("utf-8"))
-
-                    elif command == "/quit":
-                        client_socket.send("Goodbye!".encode("utf-8"))
-                        break
+            except OSError as e:
+                # Connection reset, closed by another thread, or a slow consumer
+                if not client_socket.closed:
+                    log.info(
+                        "Connection to %s lost: %s", self.clients.get(client_socket), e
+                    )
+                break
+            except Exception:
+                log.exception(
+                    "Error handling client %s", self.clients.get(client_socket)
+                )
+                break
 
-                    else:
-                        client_socket.send(
-                            f"ERROR: Unknown command {command}".encode("utf-8")
-                        )
+        if wait is not None:
+            gate.leave()
+        self.metrics.connections_closed += 1
+        self.connections.pop(client_socket, None)
+        if recorder is not None:
+            recorder.closed(client_socket)
+        self.remove_client(client_socket)
+
+    def handle_lines(self, client_socket, lines, start=0):
+        """Dispatch lines[start:] in order, subject to the rate limits
 
-                # Regular message - send to current channel
+        Returns (position, delay). position is -1 when the connection should
+        be closed and len(lines) once every line was handled. Otherwise the
+        line at position was held back by a rate limit: call again with it
+        after delay seconds.
+        """
+        metrics = self.metrics
+        limiter = self.limiter
+        debug = log.isEnabledFor(logging.DEBUG)
+        clock = time.perf_counter
+        for position in range(start, len(lines)):
+            message = lines[position].strip()
+            if debug:
+                log.debug(
+                    'Received message "%s" from %s',
+                    message,
+                    client_socket.getpeername(),
+                )
+            if not message:
+                continue
+
+            if message[0] == "/":
+                verb, _, args = message.partition(" ")
+                verb = verb.lower()
+                command = self.commands.get(verb)
+                if command is None:
+                    label, rate_class = "unknown", "command"
                 else:
-                    if not nickname:
-                        client_socket.send(
-                            "ERROR: You must set a nickname first with /nick <nickname>".encode(
-                                "utf-8"
-                            )
-                        )
-                        continue
+                    label, rate_class = verb, command.rate_class
+            else:
+                label, rate_class = "channel_message", "message"
 
-                    # Find the active channel
-                    target_channel = None
+            started = clock()
+            if rate_class is not None:
+                delay = limiter.check(client_socket, rate_class, time.monotonic())
+                if delay:
+                    if limiter.policy == POLICY_DELAY:
+                        limiter.delayed += 1
+                        return position, delay
+                    limiter.dropped += 1
+                    self.send_payload(client_socket, RATE_LIMITED)
+                    continue
 
-                    # Parse channel from message if format is "#channel message"
-                    if message.startswith("#") and " " in message:
-                        parts = message.split(" ", 1)
-                        channel_name = parts[0][1:]  # Remove the # character
-                        msg_content = parts[1]
+            metrics.messages_in += 1
+            nickname = self.clients.get(client_socket)
+            if label == "channel_message":
+                keep_open = self.handle_channel_message(
+                    client_socket, nickname, message
+                )
+            elif command is None:
+                keep_open = self.commands.dispatch(
+                    self, client_socket, nickname, verb, args
+                )
+            else:
+                keep_open = command.run(self, client_socket, nickname, args)
+            metrics.observe_command(label, clock() - started)
+            if not keep_open:
+                return -1, 0
+        return len(lines), 0
 
-                        if (
-                            channel_name in self.channels
-                            and nickname in self.channels[channel_name]
-                        ):
-                            target_channel = channel_name
-                            message = msg_content
-
-                    # If no explicit channel, find a joined channel
-                    if not target_channel:
-                        joined_channels = self.client_channels.get(nickname, set())
-                        if joined_channels:
-                            target_channel = next(iter(joined_channels))
-                        else:
-                            client_socket.send(
-                                "ERROR: You haven't joined any channels".encode("utf-8")
-                            )
-                            continue
-
-                    timestamp = datetime.now().strftime("%H:%M:%S")
-                    formatted_message = (
-                        f"[{timestamp}] [{target_channel}] {nickname}: {message}"
-                    )
+    def handle_channel_message(self, client_socket, nickname, message):
+        """Send a regular message to the channel it names or the first joined one"""
+        if not nickname:
+            self.send_payload(client_socket, NICKNAME_FIRST)
+            return True
 
-                    # Send to client's own socket to confirm message
-                    client_socket.send(formatted_message.encode("utf-8"))
+        session = self.nicknames.get(nickname)
+        if session is None or session.connection is not client_socket:
+            # Removed by another thread meanwhile, the connection is closing
+            return True
 
-                    # Broadcast to channel
-                    self.broadcast_to_channel(
-                        target_channel, formatted_message, client_socket
-                    )
+        # Find the active channel
+        target_channel = None
 
-            except Exception as e:
-                print(f"Error handling client {nickname}: {e}")
-                traceback.print_exc()  # Add traceback to see full error details
-                break
+        # Parse channel from message if format is "#channel message"
+        if message.startswith("#") and " " in message:
+            parts = message.split(" ", 1)
+            channel_name = parts[0][1:]  # Remove the # character
+            msg_content = parts[1]
 
-        self.remove_client(client_socket)
+            members = self.channels.get(channel_name)
+            if members is not None and session.is_in(members.id):
+                target_channel = channel_name
+                message = msg_content
+
+        # If no explicit channel, find a joined channel
+        if not target_channel:
+            first = session.channels[:1]  # a copy, the session may part meanwhile
+            if first:
+                target_channel = self.channels.by_id[first[0]].name
+            else:
+                self.send_payload(client_socket, NO_CHANNELS)
+                return True
+
+        if not self.limiter.check_channel(target_channel, time.monotonic()):
+            self.reply(
+                client_socket,
+                f"ERROR: Channel {target_channel} is busy, message dropped",
+            )
+            return True
+
+        formatted_message = f"[{timestamp()}] [{target_channel}] {nickname}: {message}"
+        payload = encode_line(formatted_message)
+        fields = (int(time.time()), nickname, message)
+
+        # Send to client's own socket to confirm message
+        session = client_socket.compact
+        if session is None:
+            self.send_payload(client_socket, payload)
+        else:
+            compact = self.compact_payload(target_channel, payload, fields)
+            self.metrics.messages_out += 1
+            self.metrics.bytes_out += session.send(client_socket, compact)
+
+        # Broadcast to channel
+        self.broadcast_payload(
+            target_channel, payload, client_socket, record=True, fields=fields
+        )
+        return True
+
+    # Commands, checked against their declared preconditions by the registry
+
+    @commands.command(
+        "/nick",
+        rate_class="membership",
+        arity=1,
+        usage="/nick <nickname> - Set your nickname",
+        missing="ERROR: Nickname cannot be empty",
+    )
+    def on_nick(self, client_socket, nickname, new_nick):
+        if new_nick == nickname:
+            return
+
+        # Check if nickname is already taken
+        if nickname:
+            registered = self.rename_client(client_socket, nickname, new_nick)
+        else:
+            registered = self.register_client(client_socket, new_nick)
+        if not registered:
+            self.reply(client_socket, f"ERROR: Nickname {new_nick} is already taken")
+            return
+        if nickname:
+            return
+
+        self.confirm(
+            client_socket,
+            REGISTERED,
+            new_nick,
+            f"Welcome {new_nick}! You have been added to #general",
+        )
+        log.info('User "%s" has joined the server', new_nick)
+        self.broadcast_to_channel(
+            "general", f"SYSTEM: {new_nick} has joined #general", client_socket
+        )
+
+    @commands.command(
+        "/join",
+        rate_class="membership",
+        registered=True,
+        arity=1,
+        usage="/join <channel> - Join a channel",
+        not_registered="ERROR: You must set a nickname first with /nick <nickname>",
+        missing="ERROR: Please specify a channel to join",
+    )
+    def on_join(self, client_socket, nickname, channel):
+        # Join the channel if it exists
+        if not self.join_channel(nickname, channel):
+            self.reply(
+                client_socket,
+                f"ERROR: Channel {channel} does not exist. Only the admin can create new channels.",
+            )
+            return
+
+        self.confirm(client_socket, JOINED, channel, f"You have joined {channel}")
+        backlog = self.backlog(channel)
+        if backlog:
+            self.send_payload(client_socket, backlog)
+        self.broadcast_to_channel(
+            channel, f"SYSTEM: {nickname} has joined {channel}", client_socket
+        )
+
+    @commands.command(
+        "/leave",
+        rate_class="membership",
+        aliases=("/part",),
+        registered=True,
+        arity=1,
+        usage="/leave <channel> - Leave a channel",
+        missing="ERROR: Please specify a channel to leave",
+    )
+    def on_leave(self, client_socket, nickname, channel):
+        if self.part_channel(nickname, channel):
+            self.confirm(client_socket, LEFT, channel, f"You have left {channel}")
+            self.broadcast_to_channel(channel, f"SYSTEM: {nickname} has left {channel}")
+        else:
+            self.reply(client_socket, f"ERROR: You are not in channel {channel}")
+
+    @commands.command(
+        "/list",
+        rate_class="query",
+        optional=2,
+        usage="/list [prefix] [after] - List available channels",
+    )
+    def on_list(self, client_socket, nickname, prefix="*", after=""):
+        # Replies are cached until a channel is created or its members change
+        prefix = "" if prefix == "*" else prefix
+        channels = self.channels
+
+        def build():
+            names, more = channels.page(prefix, after)
+            listing = ", ".join(
+                [f"#{name} ({len(channels[name])} users)" for name in names]
+            )
+            reply = f"Available channels: {listing}"
+            if more:
+                reply += f"\nMore: /list {prefix or '*'} {names[-1]}"
+            return encode_line(reply)
+
+        self.send_payload(client_socket, cached(channels, (prefix, after), build))
+
+    @commands.command(
+        "/users",
+        rate_class="query",
+        arity=1,
+        optional=2,
+        usage="/users <channel> [prefix] [after] - List users in a channel",
+        missing="ERROR: Please specify a channel",
+    )
+    def on_users(self, client_socket, nickname, channel, prefix="*", after=""):
+        members = self.channels.get(channel)
+        if members is None:
+            self.reply(client_socket, f"ERROR: Channel {channel} does not exist")
+            return
+        prefix = "" if prefix == "*" else prefix
+
+        def build():
+            names, more = members.page(prefix, after)
+            reply = f"Users in {channel}: {', '.join(names)}"
+            if more:
+                reply += f"\nMore: /users {channel} {prefix or '*'} {names[-1]}"
+            return encode_line(reply)
+
+        self.send_payload(client_socket, cached(members, (prefix, after), build))
+
+    @commands.command(
+        "/msg",
+        rate_class="message",
+        registered=True,
+        arity=2,
+        usage="/msg <nickname> <message> - Send a private message",
+    )
+    def on_msg(self, client_socket, nickname, target_nick, pm_message):
+        now = timestamp()
+        if self.deliver_private(
+            target_nick, f"[{now}] PRIVATE from {nickname}: {pm_message}"
+        ):
+            self.reply(client_socket, f"[{now}] PRIVATE to {target_nick}: {pm_message}")
+        else:
+            self.reply(client_socket, f"ERROR: User {target_nick} not found")
+
+    @commands.command(
+        "/search",
+        rate_class="query",
+        registered=True,
+        arity=2,
+        usage="/search <channel> <terms> - Find recent messages with all terms",
+    )
+    def on_search(self, client_socket, nickname, channel, terms):
+        if not self.search_index.enabled:
+            self.reply(client_socket, "ERROR: Search is disabled on this server")
+            return
+        if channel not in self.channels:
+            self.reply(client_socket, f"ERROR: Channel {channel} does not exist")
+            return
+
+        found = self.search_index.search(channel, terms)
+        if not found:
+            self.reply(client_socket, f"No messages in {channel} match {terms}")
+            return
+        # Header and matches go out in a single write
+        self.send_payload(
+            client_socket,
+            encode_line(f"Search results in {channel} for {terms}:") + b"".join(found),
+        )
+
+    @commands.command(
+        "/help", rate_class="query", usage="/help - Show this help message"
+    )
+    def on_help(self, client_socket, nickname):
+        self.send_payload(
+            client_socket, self.commands.help_reply(nickname == ADMIN_NICKNAME)
+        )
+
+    @commands.command(
+        "/quit", rate_class=None, usage="/quit - Disconnect from the server"
+    )
+    def on_quit(self, client_socket, nickname):
+        self.send_payload(client_socket, GOODBYE)
+        return False
+
+    @commands.command(
+        "/protocol",
+        arity=1,
+        usage="/protocol <text|compact> - Choose how the server frames what it"
+        " sends you",
+    )
+    def on_protocol(self, client_socket, nickname, protocol):
+        protocol = protocol.strip().lower()
+        if protocol not in PROTOCOLS:
+            self.reply(client_socket, f"ERROR: Unknown protocol {protocol}")
+            return
+        if client_socket.compact is not None:
+            # Clients switch their reader once, at connect time
+            self.reply(client_socket, "ERROR: The protocol is already chosen")
+            return
+        # The confirmation is the last line sent as text
+        self.reply(client_socket, f"PROTOCOL {protocol}")
+        if protocol == PROTOCOL_COMPACT:
+            client_socket.compact = CompactSession()
+
+    @commands.command(
+        "/compress",
+        arity=1,
+        usage="/compress zlib - Compress large replies and busy traffic"
+        " (compact protocol only)",
+    )
+    def on_compress(self, client_socket, nickname, algorithm):
+        algorithm = algorithm.strip().lower()
+        if algorithm != COMPRESSION_ZLIB:
+            self.reply(client_socket, f"ERROR: Unknown compression {algorithm}")
+        elif self.compress_threshold is None:
+            self.reply(client_socket, "ERROR: Compression is disabled on this server")
+        elif client_socket.compact is None:
+            # Only frames can tell compressed data from plain
+            self.reply(client_socket, "ERROR: Compression needs /protocol compact")
+        elif client_socket.deflate is None:
+            self.reply(client_socket, f"COMPRESS {algorithm}")
+            client_socket.compress(Deflater(self.compression, self.compress_threshold))
+
+    @commands.command("/pong", rate_class=None)
+    def on_pong(self, client_socket, nickname):
+        # Answer to a keepalive PING; receiving it already counted as activity
+        pass
+
+    @commands.command(
+        "/createchannel",
+        rate_class="membership",
+        registered=True,
+        admin=True,
+        arity=1,
+        usage="/createchannel <channel> [depth=<n>] - Create a new channel,"
+        " optionally keeping the last <n> messages (admin only)",
+        not_admin="ERROR: Only admin can create channels",
+        missing="ERROR: Please specify a channel name to create",
+    )
+    def on_createchannel(self, client_socket, nickname, args):
+        # An optional trailing depth=<n> sets the history depth; a bare
+        # number is part of the name
+        channel, history_depth = args, None
+        name, _, option = args.rpartition(" ")
+        if name and option.startswith("depth="):
+            depth = option[len("depth=") :]
+            if not depth.isdigit():
+                self.reply(client_socket, "ERROR: depth must be a number of messages")
+                return
+            channel, history_depth = name, int(depth)
+
+        if not self.create_channel(channel, history_depth):
+            self.reply(client_socket, f"ERROR: Channel {channel} already exists")
+        else:
+            self.reply(
+                client_socket,
+                f"Channel {channel} created. Use /join {channel} to join it.",
+            )
+
+    @commands.command(
+        "/stats",
+        rate_class="query",
+        admin=True,
+        usage="/stats - Show server metrics (admin only)",
+        not_admin="ERROR: Only admin can view stats",
+    )
+    def on_stats(self, client_socket, nickname):
+        self.reply(client_socket, self.metrics.summary(self.gauges()))
+
+    @commands.command(
+        "/profile",
+        rate_class="query",
+        admin=True,
+        optional=1,
+        usage="/profile [start|stop] - Profile the server, stop writes the"
+        " profile as collapsed stacks (admin only)",
+        not_admin="ERROR: Only admin can profile the server",
+    )
+    def on_profile(self, client_socket, nickname, action=""):
+        action = action.lower()
+        if action not in ("", "start", "stop"):
+            self.reply(client_socket, "ERROR: Usage: /profile [start|stop]")
+        elif not self.profiler.installed:
+            self.reply(client_socket, "ERROR: Profiling is not available")
+        elif action == "start" or (not action and not self.profiler.running):
+            if self.start_profile():
+                self.reply(client_socket, "Profiling, /profile stop writes the profile")
+            else:
+                self.reply(client_socket, "ERROR: Already profiling")
+        else:
+            path = self.stop_profile()
+            if path is None:
+                self.reply(client_socket, "ERROR: Not profiling")
+            else:
+                self.reply(client_socket, f"Profile written to {path}")
 
 
 if __name__ == "__main__":
-    server = IRCServer()
-    print(
+    parser = argparse.ArgumentParser(description="PyIRC server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument(
+        "--mode",
+        choices=("thread", "async"),
+        default="thread",
+        help="thread-per-connection or a single asyncio event loop",
+    )
+    parser.add_argument(
+        "--high-water",
+        type=int,
+        default=DEFAULT_HIGH_WATER,
+        help="bytes queued for one client before it counts as a slow consumer",
+    )
+    parser.add_argument(
+        "--overflow",
+        choices=OVERFLOW_POLICIES,
+        default=OVERFLOW_DISCONNECT,
+        help="disconnect slow consumers, or drop messages they cannot keep up with",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="worker processes; more than one runs a sharded cluster (POSIX only)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve Prometheus metrics over HTTP on this port (one per worker)",
+    )
+    parser.add_argument(
+        "--history",
+        type=int,
+        default=DEFAULT_DEPTH,
+        help="messages per channel replayed on /join, 0 to disable",
+    )
+    parser.add_argument(
+        "--history-bytes",
+        type=int,
+        default=DEFAULT_MAX_BYTES,
+        help="memory budget for the history of all channels together",
+    )
+    parser.add_argument(
+        "--log-dir",
+        help="persist channels and messages in this directory (one per worker)",
+    )
+    parser.add_argument(
+        "--search-bytes",
+        type=int,
+        default=SEARCH_MAX_BYTES,
+        help="memory budget of the /search index, 0 to disable /search",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=parse_limit,
+        action="append",
+        default=[],
+        metavar="CLASS=RATE[:BURST]",
+        help="override a rate limit: message, membership, query, command or"
+        " channel; a rate of 0 removes it",
+    )
+    parser.add_argument(
+        "--rate-limit-policy",
+        choices=POLICIES,
+        default=POLICY_DELAY,
+        help="delay a client's lines over its limit, or drop them with an error",
+    )
+    parser.add_argument(
+        "--ping-interval",
+        type=float,
+        default=DEFAULT_INTERVAL,
+        help="seconds of silence before a client is pinged, 0 disables keepalives",
+    )
+    parser.add_argument(
+        "--ping-timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help="seconds a pinged client has to answer before it is disconnected",
+    )
+    parser.add_argument(
+        "--compress-threshold",
+        type=int,
+        default=COMPRESS_THRESHOLD,
+        help="bytes in one flush before it is compressed for clients that asked,"
+        " -1 refuses compression",
+    )
+    parser.add_argument(
+        "--drain-seconds",
+        type=float,
+        default=DRAIN_SECONDS,
+        help="on SIGTERM, disconnect clients gradually over this many seconds",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=".",
+        help="where /profile and SIGUSR1 write profiles",
+    )
+    parser.add_argument(
+        "--profile-interval",
+        type=float,
+        default=PROFILE_INTERVAL,
+        help="seconds between two samples of the profiler",
+    )
+    parser.add_argument(
+        "--record-traffic",
+        metavar="FILE",
+        help="append what clients send to this trace file, see traffic.py",
+    )
+    parser.add_argument(
+        "--tls-cert", help="certificate (PEM) for the TLS listener, enables TLS"
+    )
+    parser.add_argument(
+        "--tls-key", help="private key (PEM) if it is not in the --tls-cert file"
+    )
+    parser.add_argument(
+        "--tls-port", type=int, default=6697, help="port of the TLS listener"
+    )
+    parser.add_argument(
+        "--plugin",
+        action="append",
+        default=[],
+        help="import this module and let it register(commands), may be repeated",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+        default="INFO",
+        help="DEBUG logs every received message",
+    )
+    options = parser.parse_args()
+
+    logging.basicConfig(
+        level=options.log_level, format="%(asctime)s %(levelname)s %(message)s"
+    )
+    for plugin in options.plugin:
+        IRCServer.commands.load_plugin(plugin)
+
+    rate_limits = dict(DEFAULT_LIMITS)
+    for name, rate, burst in options.rate_limit:
+        rate_limits[name] = (rate, burst)
+    server_options = dict(
+        high_water=options.high_water,
+        overflow=options.overflow,
+        metrics_port=options.metrics_port,
+        history_depth=options.history,
+        history_bytes=options.history_bytes,
+        log_dir=options.log_dir,
+        search_bytes=options.search_bytes,
+        rate_limits=rate_limits,
+        rate_limit_policy=options.rate_limit_policy,
+        ping_interval=options.ping_interval,
+        ping_timeout=options.ping_timeout,
+        compress_threshold=(
+            None if options.compress_threshold < 0 else options.compress_threshold
+        ),
+        drain_seconds=options.drain_seconds,
+        profile_dir=options.profile_dir,
+        profile_interval=options.profile_interval,
+        record_traffic=options.record_traffic,
+    )
+    if options.tls_cert:
+        # Built once, before any fork, so cluster workers share ticket keys
+        server_options.update(
+            tls_context=server_context(options.tls_cert, options.tls_key),
+            tls_port=options.tls_port,
+        )
+
+    if options.workers > 1:
+        from cluster import run_cluster
+
+        run_cluster(
+            options.host,
+            options.port,
+            options.workers,
+            mode=options.mode,
+            **server_options,
+        )
+        raise SystemExit
+
+    # Started by a hot restart: carry on with the old process's sockets
+    handoff = receive_state()
+    if handoff is None:
+        server = IRCServer(options.host, options.port, **server_options)
+    else:
+        handoff_socket, state, sockets = handoff
+        listeners = sockets[: state["listeners"]]
+        if options.tls_cert and len(listeners) > 1:
+            server_options["tls_socket"] = listeners[1]
+        server = IRCServer(server_socket=listeners[0], **server_options)
+        server.adopt(state, sockets[len(listeners) :], handoff_socket)
+    log.info(
         "IRC Server started. The first client to connect with nickname 'admin' will have admin privileges"
     )
-    server.start()
+    run_server(server, options.mode)
@@ -0,0 +1,327 @@
+"""Durable, append-only log of channel messages and channel metadata.
+
+The log is a directory of segment files, each named after the global byte
+offset it starts at, so a record is addressed by a single integer position.
+Every record carries a CRC and the position of the previous message in the
+same channel; walking those back pointers yields a channel's recent history
+without keeping any of it in memory, only the position of its last message.
+
+Appends only queue the encoded record. A writer thread commits everything
+queued so far with one write and one fdatasync, so disk latency never
+reaches the broadcast path and concurrent appends share a single sync.
+Reads go through mmap.
+
+A snapshot of the channel table (names, history depths and last message
+positions) is written every so many records. Startup loads it and scans only
+the records logged after it, so it stays fast however long the log grows.
+"""
+
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+log = logging.getLogger("pyirc")
+
+SEGMENT_SIZE = 64 * 1024 * 1024  # bytes per segment file before rolling
+SNAPSHOT_EVERY = 100000  # records between snapshots
+SNAPSHOT_FILE = "snapshot.json"
+
+RECORD_MESSAGE = 1
+RECORD_CREATE = 2
+
+# crc32, body length, previous message position + 1 (0 for none), kind,
+# channel length; the CRC covers everything after itself
+HEADER = struct.Struct("<IIQBH")
+DEPTH = struct.Struct("<i")  # body of a create record, -1 for the default
+
+
+def segment_name(base):
+    return f"{base:020d}.log"
+
+
+class MessageLog:
+    """Segmented append-only log with group commit and mmap reads"""
+
+    def __init__(
+        self, directory, segment_size=SEGMENT_SIZE, snapshot_every=SNAPSHOT_EVERY
+    ):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.snapshot_every = snapshot_every
+        self.channels = {}  # {channel: [history depth or None, last position + 1]}
+        self.bases = []  # start position of every segment, ascending
+        self.end = 0  # position of the next record
+        self.committed = 0  # everything before this position is on disk
+        self.commits = 0
+        self.pending = []  # [(segment base, record bytes)] not written yet
+        self.since_snapshot = 0
+        self.condition = threading.Condition(threading.Lock())
+        self.closing = False
+        self.file = None  # active segment, owned by the writer thread
+        self.file_base = None
+        self.maps = {}  # {segment base: mmap}
+        self.maps_lock = threading.Lock()
+        self.writer = None
+
+    # Startup
+
+    def open(self):
+        """Recover the channel table from disk and start the writer thread"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.bases = sorted(
+            int(name[:-4])
+            for name in os.listdir(self.directory)
+            if name.endswith(".log") and name[:-4].isdigit()
+        )
+        if self.bases:
+            self.end = self.bases[-1] + self.recover_tail(self.bases[-1])
+        position = 0
+        try:
+            with open(os.path.join(self.directory, SNAPSHOT_FILE)) as snapshot:
+                state = json.load(snapshot)
+            position = state["position"]
+            self.channels = {
+                name: list(entry) for name, entry in state["channels"].items()
+            }
+        except FileNotFoundError:
+            pass
+
+        replayed = 0
+        for record_position, kind, channel, body, _ in self.scan(position):
+            self.apply(record_position, kind, channel, body)
+            replayed += 1
+        self.committed = self.end
+        self.since_snapshot = replayed
+        log.info(
+            "Message log %s: %d channels, %d records replayed after the snapshot",
+            self.directory,
+            len(self.channels),
+            replayed,
+        )
+        self.writer = threading.Thread(
+            target=self.write_loop, name="message-log", daemon=True
+        )
+        self.writer.start()
+        return self.channels
+
+    def apply(self, position, kind, channel, body):
+        entry = self.channels.setdefault(channel, [None, 0])
+        if kind == RECORD_MESSAGE:
+            entry[1] = position + 1
+        elif kind == RECORD_CREATE:
+            depth = DEPTH.unpack(body)[0]
+            entry[0] = None if depth < 0 else depth
+
+    def recover_tail(self, base):
+        """Cut a torn record off the last segment, return its valid length"""
+        path = os.path.join(self.directory, segment_name(base))
+        size = os.path.getsize(path)
+        valid = 0
+        for position, _, _, _, length in self.scan(base, only=base):
+            valid = position - base + length
+        if valid < size:
+            log.warning("Truncating %d bytes of a torn write in %s", size - valid, path)
+            with self.maps_lock:
+                segment = self.maps.pop(base, None)
+                if segment is not None:
+                    segment.close()
+            with open(path, "r+b") as file:
+                file.truncate(valid)
+        return valid
+
+    def scan(self, start, only=None):
+        """Yield (position, kind, channel, body, length) for records from start"""
+        for base in self.bases:
+            if only is not None and base != only:
+                continue
+            segment = self.segment_map(base)
+            if segment is None or base + len(segment) <= start:
+                continue
+            offset = max(start - base, 0)
+            while offset + HEADER.size <= len(segment):
+                crc, size, _, kind, channel_size = HEADER.unpack_from(segment, offset)
+                end = offset + HEADER.size + channel_size + size
+                if end > len(segment) or zlib.crc32(segment[offset + 4 : end]) != crc:
+                    break
+                channel_end = offset + HEADER.size + channel_size
+                channel = segment[offset + HEADER.size : channel_end].decode("utf-8")
+                body = segment[channel_end:end]
+                yield base + offset, kind, channel, body, end - offset
+                offset = end
+
+    # Appending
+
+    def encode(self, kind, channel, body, previous):
+        name = channel.encode("utf-8")
+        rest = HEADER.pack(0, len(body), previous, kind, len(name))[4:] + name + body
+        return struct.pack("<I", zlib.crc32(rest)) + rest
+
+    def append(self, kind, channel, body):
+        with self.condition:
+            entry = self.channels.setdefault(channel, [None, 0])
+            record = self.encode(kind, channel, body, entry[1])
+            if not self.bases or (
+                self.end > self.bases[-1]
+                and self.end - self.bases[-1] + len(record) > self.segment_size
+            ):
+                self.bases.append(self.end)
+            position = self.end
+            self.apply(position, kind, channel, body)
+            self.pending.append((self.bases[-1], record))
+            self.end += len(record)
+            self.condition.notify()
+        return position
+
+    def append_message(self, channel, payload):
+        """Queue one framed channel message, returns its position"""
+        return self.append(RECORD_MESSAGE, channel, payload)
+
+    def append_create(self, channel, history_depth=None):
+        """Queue the creation of a channel"""
+        depth = -1 if history_depth is None else history_depth
+        return self.append(RECORD_CREATE, channel, DEPTH.pack(depth))
+
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closing:
+                    self.condition.wait()
+                if not self.pending:
+                    break
+                batch = self.pending
+                self.pending = []
+                end = self.end
+                self.since_snapshot += len(batch)
+                state = None
+                if self.since_snapshot >= self.snapshot_every:
+                    state = self.snapshot_state()
+                    self.since_snapshot = 0
+            self.commit(batch)
+            with self.condition:
+                self.committed = end
+                self.commits += 1
+            if state is not None:
+                self.write_snapshot(state)
+        if self.file is not None:
+            self.file.close()
+
+    def commit(self, batch):
+        """Write a batch of records with one write and one sync per segment"""
+        start = 0
+        while start < len(batch):
+            base = batch[start][0]
+            stop = start
+            while stop < len(batch) and batch[stop][0] == base:
+                stop += 1
+            if base != self.file_base:
+                if self.file is not None:
+                    os.fdatasync(self.file.fileno())
+                    self.file.close()
+                self.file = open(os.path.join(self.directory, segment_name(base)), "ab")
+                self.file_base = base
+            self.file.write(b"".join(record for _, record in batch[start:stop]))
+            start = stop
+        self.file.flush()
+        os.fdatasync(self.file.fileno())
+
+    def snapshot_state(self):
+        # Called with self.condition held
+        return {
+            "position": self.end,
+            "channels": {name: list(entry) for name, entry in self.channels.items()},
+        }
+
+    def write_snapshot(self, state):
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        with open(path + ".tmp", "w") as snapshot:
+            json.dump(state, snapshot, separators=(",", ":"))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(path + ".tmp", path)
+
+    def close(self):
+        """Commit everything queued and write a final snapshot
+
+        open() may be called again afterwards, as when a hot restart fails.
+        """
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        self.write_snapshot(self.snapshot_state())
+        self.closing = False
+        self.file = None
+        self.file_base = None
+        with self.maps_lock:
+            for segment in self.maps.values():
+                segment.close()
+            self.maps.clear()
+
+    # Reading
+
+    def segment_map(self, base, need=None):
+        """mmap of a segment, remapped when the active one has grown
+
+        With need, a cached map at least that long is returned as is.
+        """
+        segment = self.maps.get(base)
+        if segment is not None and need is not None and len(segment) >= need:
+            return segment
+        with self.maps_lock:
+            segment = self.maps.get(base)
+            path = os.path.join(self.directory, segment_name(base))
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                return None
+            if segment is not None and len(segment) == size:
+                return segment
+            if size == 0:
+                return None
+            with open(path, "rb") as file:
+                segment = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+            # An outdated map may still be in use by a reader, let it be
+            # collected rather than closing it under that reader
+            self.maps[base] = segment
+            return segment
+
+    def read(self, position):
+        """The (kind, body, previous position + 1) of the record at position"""
+        base = self.bases[bisect.bisect_right(self.bases, position) - 1]
+        offset = position - base
+        segment = self.segment_map(base, offset + HEADER.size)
+        if segment is None or offset + HEADER.size > len(segment):
+            return None
+        _, size, previous, kind, channel_size = HEADER.unpack_from(segment, offset)
+        start = offset + HEADER.size + channel_size
+        if start + size > len(segment):
+            segment = self.segment_map(base, start + size)
+        return kind, segment[start : start + size], previous
+
+    def recent(self, channel, limit):
+        """Up to limit of the last committed messages of channel, oldest first"""
+        entry = self.channels.get(channel)
+        if entry is None or not limit:
+            return []
+        payloads = []
+        position = entry[1]
+        committed = self.committed
+        while position and len(payloads) < limit:
+            if position - 1 >= committed:
+                # Still queued for the writer; these messages are recent
+                # enough to be in the in-memory history anyway
+                break
+            record = self.read(position - 1)
+            if record is None:
+                break
+            _, body, position = record
+            payloads.append(body)
+        payloads.reverse()
+        return payloads
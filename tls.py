@@ -0,0 +1,89 @@
+"""TLS for the PyIRC listener.
+
+The server keeps its plaintext port and can listen for TLS connections on a
+second port (``--tls-port``, with ``--tls-cert`` and ``--tls-key``). The
+handshake never runs on the thread that accepts connections: in async mode
+it is driven by the event loop like any other I/O, and in thread mode each
+connection's own thread performs it before reading the first line.
+
+Clients that reconnect can resume their previous session instead of doing
+a full handshake: TLS 1.3 session tickets, and the TLS 1.2 session cache
+for older clients. The context is built before a cluster forks its
+workers, so they all share the ticket keys and a ticket issued by one
+worker is accepted by the others.
+
+For local testing, ``python tls.py DIRECTORY`` writes a self-signed
+certificate for localhost to DIRECTORY/cert.pem and DIRECTORY/key.pem
+(this needs the ``openssl`` command).
+"""
+
+import os
+import ssl
+import subprocess
+import sys
+
+HANDSHAKE_TIMEOUT = 10.0  # seconds a client has to complete the handshake
+TICKETS = 2  # TLS 1.3 session tickets sent after each full handshake
+
+
+def server_context(certfile, keyfile=None):
+    """SSLContext for the TLS listener, with session resumption enabled"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    # Tickets for TLS 1.3; OpenSSL's server-side session cache, on by
+    # default, covers TLS 1.2
+    context.num_tickets = TICKETS
+    return context
+
+
+def client_context(cafile=None, verify=True):
+    """SSLContext for connecting to the TLS listener
+
+    A self-signed server certificate can be trusted by passing it as cafile.
+    """
+    context = ssl.create_default_context(cafile=cafile)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def self_signed_certificate(directory, hostname="localhost"):
+    """Write a self-signed certificate and key, return their paths"""
+    os.makedirs(directory, exist_ok=True)
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "ec",
+            "-pkeyopt",
+            "ec_paramgen_curve:prime256v1",
+            "-nodes",
+            "-days",
+            "365",
+            "-subj",
+            f"/CN={hostname}",
+            "-addext",
+            f"subjectAltName=DNS:{hostname},IP:127.0.0.1",
+            "-keyout",
+            keyfile,
+            "-out",
+            certfile,
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return certfile, keyfile
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit(f"usage: {sys.argv[0]} DIRECTORY")
+    certfile, keyfile = self_signed_certificate(sys.argv[1])
+    print(f"--tls-cert {certfile} --tls-key {keyfile}")
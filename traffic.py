@@ -0,0 +1,193 @@
+"""Recording what clients send to the server, and replaying it.
+
+With --record-traffic, the server appends every client's input to a trace
+file, as it arrives. Each line is a JSON array:
+
+    [time, connection, "open"]
+    [time, connection, "data", bytes as latin-1 text]
+    [time, connection, "close"]
+
+time is the wall-clock time in seconds. connection is "pid.n", unique
+across restarts and cluster workers, so their traces can be merged.
+Connections taken over in a hot restart are not recorded further, because
+their start is in the previous process's part of the trace. TLS clients
+are recorded after decryption, so they replay as plain TCP clients.
+
+Replaying opens one connection per recorded one and sends the same bytes,
+in the same order, at the recorded pace or a multiple of it. It reads
+everything the server sends back and answers its PINGs:
+
+    python traffic.py replay trace.jsonl --port 9999 --speed 0
+
+With --speed 0 the trace is sent as fast as the server takes it. That makes
+a recorded trace a repeatable load for profiling: ``bench.py profile``
+replays one under the profiler.
+"""
+
+import argparse
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+
+OPEN = "open"
+DATA = "data"
+CLOSE = "close"
+
+REPLAY_TIMEOUT = 30.0  # seconds to wait for the server to finish, once all is sent
+
+
+class TrafficRecorder:
+    """Appends client input to a trace file, called from any thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ids = {}  # {connection: its id in the trace}
+        self.counter = itertools.count()
+        self.prefix = f"{os.getpid()}."
+        self.open()
+
+    def open(self):
+        """(Re)open the trace file, to append to it"""
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def write(self, connection_id, *event):
+        line = json.dumps([round(time.time(), 6), connection_id, *event])
+        with self.lock:
+            if not self.file.closed:  # while the server hands over or exits
+                self.file.write(line + "\n")
+
+    def opened(self, connection):
+        connection_id = self.ids[connection] = f"{self.prefix}{next(self.counter)}"
+        self.write(connection_id, OPEN)
+
+    def received(self, connection, data):
+        connection_id = self.ids.get(connection)
+        if connection_id is not None:
+            self.write(connection_id, DATA, data.decode("latin-1"))
+
+    def closed(self, connection):
+        connection_id = self.ids.pop(connection, None)
+        if connection_id is not None:
+            self.write(connection_id, CLOSE)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_trace(paths):
+    """Events of one or more trace files, merged in time order"""
+    traces = []
+    for path in paths:
+        with open(path, encoding="utf-8") as lines:
+            traces.append([json.loads(line) for line in lines if line.strip()])
+    return list(heapq.merge(*traces, key=lambda event: event[0]))
+
+
+async def read_replies(reader, writer, counts):
+    """Read until the server closes, answering keepalive PINGs"""
+    partial = b""  # the end of the last read, after its last newline
+    while True:
+        try:
+            data = await reader.read(1 << 16)
+        except OSError:
+            return
+        if not data:
+            return
+        counts["received"] += len(data)
+        data = partial + data
+        if b"PING " in data:
+            *lines, partial = data.split(b"\n")
+            for line in lines:
+                if line.startswith(b"PING "):
+                    writer.write(b"/pong " + line[5:] + b"\n")
+        else:
+            partial = data
+        # A PING line is short, compact frames need not be kept whole
+        partial = partial[-64:]
+
+
+async def replay(host, port, events, speed=0.0):
+    """Send the recorded events to host:port, returns counts of what happened
+
+    speed multiplies the recorded pace, 0 sends as fast as possible.
+    Connections the trace leaves open are half-closed at the end; replay
+    returns once the server has closed them all, so it has handled
+    everything sent.
+    """
+    counts = {"connections": 0, "failed": 0, "sent": 0, "received": 0}
+    writers = {}  # {connection id: StreamWriter}
+    readers = []
+    started = time.perf_counter()
+    first = events[0][0] if events else 0.0
+    for recorded, connection_id, kind, *data in events:
+        if speed:
+            delay = (recorded - first) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if kind == OPEN:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError:
+                counts["failed"] += 1
+                continue
+            counts["connections"] += 1
+            writers[connection_id] = writer
+            readers.append(asyncio.ensure_future(read_replies(reader, writer, counts)))
+            continue
+        writer = writers.get(connection_id)
+        if writer is None:
+            continue
+        try:
+            if kind == DATA:
+                payload = data[0].encode("latin-1")
+                writer.write(payload)
+                counts["sent"] += len(payload)
+                await writer.drain()
+            elif kind == CLOSE:
+                del writers[connection_id]
+                writer.write_eof()
+        except OSError:
+            writers.pop(connection_id, None)
+    for writer in writers.values():
+        try:
+            writer.write_eof()
+        except OSError:
+            pass
+    if readers:
+        await asyncio.wait(readers, timeout=REPLAY_TIMEOUT)
+    counts["seconds"] = round(time.perf_counter() - started, 3)
+    return counts
+
+
+def main():
+    from server import raise_fd_limit
+
+    parser = argparse.ArgumentParser(description="Replay recorded client traffic")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    play = subparsers.add_parser("replay", help="send a trace to a server")
+    play.add_argument("trace", nargs="+", help="trace files, merged by time")
+    play.add_argument("--host", default="127.0.0.1")
+    play.add_argument("--port", type=int, default=9999)
+    play.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="multiple of the recorded pace, 0 for as fast as possible",
+    )
+    options = parser.parse_args()
+
+    raise_fd_limit()
+    events = read_trace(options.trace)
+    counts = asyncio.run(replay(options.host, options.port, events, options.speed))
+    for key, value in counts.items():
+        print(f"{key:>12}: {value}")
+
+
+if __name__ == "__main__":
+    main()